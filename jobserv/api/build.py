@@ -3,6 +3,7 @@
 
 from flask import Blueprint, request, url_for
 
+from jobserv.api.run import archive_response
 from jobserv.flask import permissions
 from jobserv.settings import BUILD_URL_FMT
 from jobserv.storage import Storage
@@ -94,6 +95,18 @@ def build_get_project_definition(proj, build_id):
     return pd, 200, {'Content-Type': 'text/yaml'}
 
 
+@blueprint.route(
+    '/builds/<int:build_id>/.artifacts.<any(tar, "tar.gz", zip):fmt>',
+    methods=('GET',))
+def build_get_artifacts_archive(proj, build_id, fmt):
+    p = get_or_404(Project.query.filter(Project.name == proj))
+    b = get_or_404(
+        Build.query.filter(Build.project == p, Build.build_id == build_id))
+    runs = [x for x in b.runs if x.complete]
+    name = '%s-%d' % (proj.replace('/', '-'), build_id)
+    return archive_response(runs, fmt, name, run_dirs=True)
+
+
 @blueprint.route('/builds/latest/', methods=('GET',))
 def build_get_latest(proj):
     '''Return the most recent successful build'''
@@ -6,7 +6,7 @@ from flask import Blueprint, url_for
 from sqlalchemy import func
 
 from jobserv.jsend import ApiError, jsendify
-from jobserv.models import BuildStatus, Run, db
+from jobserv.models import Build, BuildStatus, Project, Run, db
 
 blueprint = Blueprint('api_health', __name__, url_prefix='/health')
 
@@ -51,3 +51,40 @@ def run_health():
             worker = run.worker_name or '?'
             health['RUNNING'].setdefault(worker, []).append(item)
     return jsendify({'health': health})
+
+
+@blueprint.route('/shares/')
+def share_health():
+    '''Show each project's share of the active runs next to the share its
+       weight entitles it to among the projects with runs to do.'''
+    active = (BuildStatus.RUNNING, BuildStatus.UPLOADING,
+              BuildStatus.CANCELLING)
+    counts = db.session.query(
+        Project, Run._status, func.count(Run.id)
+    ).join(
+        Build, Build.proj_id == Project.id
+    ).join(
+        Run, Run.build_id == Build.id
+    ).filter(
+        Run.status.in_(active + (BuildStatus.QUEUED,))
+    ).group_by(Project.id, Run._status)
+
+    projects = {}
+    for p, status, count in counts:
+        item = projects.setdefault(p.name, {
+            'share_weight': p.share_weight or 1,
+            'max_concurrency': p.max_concurrency,
+            'active': 0,
+            'queued': 0,
+        })
+        if status == BuildStatus.QUEUED.value:
+            item['queued'] += count
+        else:
+            item['active'] += count
+
+    total_weight = sum(x['share_weight'] for x in projects.values())
+    total_active = sum(x['active'] for x in projects.values())
+    for item in projects.values():
+        item['fair_share'] = item['share_weight'] / total_weight
+        item['share'] = item['active'] / total_active if total_active else 0
+    return jsendify({'shares': projects})
@@ -6,7 +6,8 @@ from flask import Blueprint, request, url_for
 from jobserv.flask import permissions
 from jobserv.jsend import ApiError, get_or_404, jsendify, paginate_custom
 from jobserv.models import (
-    Build, BuildStatus, Project, ProjectTrigger, Run, TriggerTypes, db)
+    Build, BuildStatus, Project, ProjectTrigger, Run, RunDuration,
+    TriggerTypes, db)
 
 blueprint = Blueprint('api_project', __name__, url_prefix='/projects')
 
@@ -45,6 +46,7 @@ def project_delete(proj):
 
     for t in p.triggers:
         db.session.delete(t)
+    RunDuration.query.filter_by(proj_id=p.id).delete()
     db.session.commit()
 
     for b in p.builds:
@@ -1,11 +1,15 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 
+import datetime
+
 from flask import Blueprint, request
+from sqlalchemy.exc import IntegrityError
 
 from jobserv.flask import permissions
-from jobserv.jsend import jsendify
-from jobserv.models import ProjectTrigger, TriggerTypes
+from jobserv.jsend import ApiError, jsendify
+from jobserv.models import (
+    PollerInstance, PollNudge, ProjectTrigger, TriggerTypes, db)
 
 blueprint = Blueprint(
     'api_project_triggers', __name__, url_prefix='/project-triggers')
@@ -21,3 +25,53 @@ def project_trigger_list():
     else:
         query = ProjectTrigger.query.all()
     return jsendify([x.as_json() for x in query])
+
+
+@blueprint.route('/nudges/', methods=('POST',))
+def poll_nudge_create():
+    '''Ask the git poller to check a repository as soon as it can. This is
+       meant for post-receive hooks of repositories that can't send GitHub
+       or GitLab style webhooks.'''
+    permissions.assert_internal_user()
+    url = (request.get_json() or {}).get('url')
+    if not url:
+        raise ApiError(400, 'Missing required parameter: "url"')
+    pollers = [x.name for x in PollerInstance.live()] or ['']
+    for poller in pollers:
+        if not PollNudge.query.get((url, poller)):
+            db.session.add(PollNudge(url, poller))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # someone else nudged it at the same time
+        db.session.rollback()
+    return jsendify({}, 201)
+
+
+@blueprint.route('/nudges/pop/', methods=('POST',))
+def poll_nudge_pop():
+    '''Used by the git poller to take all pending nudges.'''
+    permissions.assert_internal_user()
+    poller = (request.get_json() or {}).get('poller', '')
+    nudges = PollNudge.query.filter(
+        PollNudge.poller.in_([poller, ''])).with_for_update().all()
+    for n in nudges:
+        db.session.delete(n)
+    db.session.commit()
+    return jsendify([x.url for x in nudges])
+
+
+@blueprint.route('/pollers/<name>/', methods=('POST',))
+def poller_heartbeat(name):
+    '''Record that a git poller instance is alive. Returns the names of
+       all live instances so the poller can work out its share of the
+       triggers.'''
+    permissions.assert_internal_user()
+    now = datetime.datetime.utcnow()
+    p = PollerInstance.query.get(name)
+    if p:
+        p.heartbeat = now
+    else:
+        db.session.add(PollerInstance(name, now))
+    db.session.commit()
+    return jsendify([x.name for x in PollerInstance.live(now)])
@@ -1,19 +1,24 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 
+import datetime
+import fnmatch
 import json
 import re
 
 import yaml
 
 from flask import (
-    Blueprint, current_app, make_response, request, send_file, url_for)
+    Blueprint, Response, current_app, make_response, request, send_file,
+    stream_with_context, url_for)
 
 from jobserv.flask import permissions
 from jobserv.storage import Storage
+from jobserv.storage.archive import FORMATS as ARCHIVE_FORMATS
 from jobserv.jsend import ApiError, get_or_404, jsendify
 from jobserv.models import (
-    db, Build, BuildStatus, Project, Run, Test, TestResult
+    db, Build, BuildStatus, Project, Run, RunDuration, RunEvents, Test,
+    TestResult, Worker
 )
 from jobserv.project import ProjectDefinition
 from jobserv.sendmail import notify_build_complete
@@ -93,7 +98,7 @@ def _handle_build_complete(projdef, storage, build, params, secrets, trigger):
             notify_build_complete(build, email['users'])
 
 
-def _handle_triggers(storage, run):
+def _handle_triggers(storage, run, trigger_url):
     if not run.complete or not run.trigger:
         return
 
@@ -102,7 +107,7 @@ def _handle_triggers(storage, run):
     rundef = json.loads(storage.get_run_definition(run))
     secrets = rundef.get('secrets')
     params = rundef.get('env', {})
-    params['H_TRIGGER_URL'] = request.url
+    params['H_TRIGGER_URL'] = trigger_url
 
     run_trigger = projdef.get_trigger(run.trigger)
     try:
@@ -194,6 +199,31 @@ def _authenticate_runner(run):
         raise ApiError(401, {'message': 'Run has already completed'})
 
 
+def _set_status(storage, run, status, trigger_url):
+    if run.status != status:
+        if status in (BuildStatus.PASSED, BuildStatus.FAILED):
+            if _running_tests(run):
+                status = BuildStatus.RUNNING
+            if _failed_tests(storage, run):
+                status = BuildStatus.FAILED
+            storage.copy_log(run)
+        with run.build.locked():
+            run.set_status(status)
+            if run.complete:
+                _handle_triggers(storage, run, trigger_url)
+
+
+def fail_run(run, message):
+    '''Append "message" to a run's console log and fail the run the same
+       way a runner's update would. This is for the worker monitor, which
+       runs outside of a request.'''
+    storage = Storage()
+    with storage.console_logfd(run, 'ab') as f:
+        f.write(message.encode())
+    # failed runs don't trigger other runs, so there's no H_TRIGGER_URL
+    _set_status(storage, run, BuildStatus.FAILED, None)
+
+
 @blueprint.route('/<run>/', methods=('POST',))
 def run_update(proj, build_id, run):
     r = _get_run(proj, build_id, run)
@@ -211,18 +241,7 @@ def run_update(proj, build_id, run):
 
     status = request.headers.get('X-RUN-STATUS')
     if status:
-        status = BuildStatus[status]
-        if r.status != status:
-            if status in (BuildStatus.PASSED, BuildStatus.FAILED):
-                if _running_tests(r):
-                    status = BuildStatus.RUNNING
-                if _failed_tests(storage, r):
-                    status = BuildStatus.FAILED
-                storage.copy_log(r)
-            with r.build.locked():
-                r.set_status(status)
-                if r.complete:
-                    _handle_triggers(storage, r)
+        _set_status(storage, r, BuildStatus[status], request.url)
 
     resp = jsendify({})
     if r.status == BuildStatus.CANCELLING:
@@ -250,6 +269,74 @@ def run_cancel(proj, build_id, run):
     return jsendify({}), 202
 
 
+def _started(runs):
+    '''Return when each of the runs last went to RUNNING'''
+    rows = db.session.query(
+        RunEvents.run_id, db.func.max(RunEvents.time)
+    ).filter(
+        RunEvents.run_id.in_([x.id for x in runs]),
+        RunEvents._status == BuildStatus.RUNNING.value,
+    ).group_by(RunEvents.run_id)
+    return dict(rows)
+
+
+def _eta(run, now):
+    '''Estimate when the run will start and finish. The runs ahead of a
+       queued run on its host tag, and what's left of the ones running, are
+       assumed to be spread evenly over the workers that can take them.'''
+    def _key(r):
+        return (r.build.proj_id, r.name, r.host_tag)
+
+    active = Run.query.filter(
+        Run.host_tag == run.host_tag,
+        Run._status.in_((BuildStatus.QUEUED.value, BuildStatus.RUNNING.value)),
+    ).all()
+    predictions = RunDuration.predict([_key(x) for x in active + [run]])
+    started = _started([x for x in active if x.status == BuildStatus.RUNNING])
+    predicted = predictions.get(_key(run))
+
+    if run.status == BuildStatus.RUNNING:
+        start = started.get(run.id)
+    else:
+        capacity = 0
+        for w in Worker.query.filter_by(enlisted=True, online=True,
+                                        deleted=False, surges_only=False):
+            tags = [w.name] + [x.strip() for x in w.host_tags.split(',')]
+            if any(fnmatch.fnmatch(t, run.host_tag) for t in tags):
+                capacity += w.concurrent_runs
+        if not capacity:
+            return predicted, None, None
+
+        ahead = 0
+        rank = (-(run.queue_priority or 0), run.build_id, run.id)
+        for r in active:
+            seconds = predictions.get(_key(r), 0)
+            if r.status == BuildStatus.RUNNING:
+                elapsed = (now - started.get(r.id, now)).total_seconds()
+                ahead += max(0, seconds - elapsed)
+            elif (-(r.queue_priority or 0), r.build_id, r.id) < rank:
+                ahead += seconds
+        start = now + datetime.timedelta(seconds=ahead / capacity)
+
+    finish = None
+    if start and predicted is not None:
+        finish = start + datetime.timedelta(seconds=predicted)
+    return predicted, start, finish
+
+
+@blueprint.route('/<run>/eta', methods=('GET',))
+def run_get_eta(proj, build_id, run):
+    r = _get_run(proj, build_id, run)
+    if r.status not in (BuildStatus.QUEUED, BuildStatus.RUNNING):
+        raise ApiError(400, 'Run is not queued or running')
+    predicted, start, finish = _eta(r, datetime.datetime.utcnow())
+    return jsendify({'eta': {
+        'predicted_seconds': predicted,
+        'start': start,
+        'finish': finish,
+    }})
+
+
 def _get_run_def(proj, build_id, run):
     r = _get_run(proj, build_id, run)
     rundef = Storage().get_run_definition(r)
@@ -304,6 +391,28 @@ PYTHONPATH=./runner python3 -m jobserv_runner.simulator -w `pwd` rundef.json
     return script, 200, {'Content-Type': 'text/plain'}
 
 
+def archive_response(runs, fmt, filename, run_dirs=False):
+    '''Stream an archive of the runs' artifacts. Artifacts can be filtered
+       with one or more "glob" query parameters.'''
+    patterns = request.args.getlist('glob')
+    gen = Storage().archive_artifacts(runs, fmt, patterns, run_dirs)
+    resp = Response(stream_with_context(gen), mimetype=ARCHIVE_FORMATS[fmt])
+    resp.headers['Content-Disposition'] = \
+        'attachment; filename=%s.%s' % (filename, fmt)
+    return resp
+
+
+@blueprint.route('/<run>/.artifacts.<any(tar, "tar.gz", zip):fmt>',
+                 methods=('GET',))
+def run_get_artifacts_archive(proj, build_id, run, fmt):
+    r = _get_run(proj, build_id, run)
+    if not r.complete:
+        raise ApiError(
+            404, {'message': 'Run in progress, no artifacts available'})
+    name = '%s-%d-%s' % (proj.replace('/', '-'), build_id, r.name)
+    return archive_response([r], fmt, name)
+
+
 @blueprint.route('/<run>/<path:path>', methods=('GET',))
 def run_get_artifact(proj, build_id, run, path):
     r = _get_run(proj, build_id, run)
@@ -341,6 +450,30 @@ def run_get_artifact(proj, build_id, run, path):
         return Storage().get_download_response(request, r, path)
 
 
+def _parse_uploads(data):
+    '''Uploads are a list of paths or a list of {"file": <path>} items.
+       Items can include a "sha256" hex digest for content-addressed uploads
+       and a "size" to request a URL accepting resumable, chunked uploads.'''
+    paths = []
+    hashes = {}
+    sizes = {}
+    for item in data:
+        if isinstance(item, dict):
+            sha = item.get('sha256')
+            if sha:
+                if not re.fullmatch('[0-9a-f]{64}', sha):
+                    raise ApiError(400, 'Invalid sha256: %s' % sha)
+                hashes[item['file']] = sha
+            size = item.get('size')
+            if size is not None:
+                if not isinstance(size, int) or size < 0:
+                    raise ApiError(400, 'Invalid size: %r' % size)
+                sizes[item['file']] = size
+            item = item['file']
+        paths.append(item)
+    return paths, hashes, sizes
+
+
 @blueprint.route('/<run>/create_signed', methods=('POST',))
 def run_upload(proj, build_id, run):
     r = _get_run(proj, build_id, run)
@@ -351,6 +484,8 @@ def run_upload(proj, build_id, run):
     if data:
         # determine url expiration, default 1800 = 30 minues
         expiration = request.headers.get('X-URL-EXPIRATION', 1800)
-        urls = Storage().generate_signed(r, data, expiration)
+        paths, hashes, sizes = _parse_uploads(data)
+        urls = Storage().generate_signed(
+            r, paths, expiration, hashes, sizes)
 
     return jsendify({'urls': urls})
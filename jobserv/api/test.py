@@ -97,6 +97,6 @@ def test_update(proj, build_id, run, test):
                 with r.build.locked():
                     t.run.set_status(run_status)
                     if r.complete:
-                        _handle_triggers(storage, r)
+                        _handle_triggers(storage, r, request.url)
 
     return jsendify({'complete': t.run.complete})
@@ -4,6 +4,7 @@
 import functools
 import json
 import os
+import time
 import urllib.parse
 
 from flask import Blueprint, request, send_file
@@ -19,6 +20,7 @@ from jobserv.settings import (
     WORKER_SCRIPT_VERSION,
 )
 from jobserv.storage import Storage
+from jobserv.worker_metrics import RESOLUTION
 
 blueprint = Blueprint('api_worker', __name__, url_prefix='/')
 
@@ -74,13 +76,15 @@ def _fix_run_urls(rundef):
 def worker_get(name):
     w = get_or_404(Worker.query.filter_by(name=name))
 
+    authenticated = _is_worker_authenticated(w)
+    if authenticated and w.enlisted:
+        # before the response is built so it reflects this check-in's health
+        w.ping(**request.args)
+
     data = w.as_json(detailed=True)
-    if _is_worker_authenticated(w):
+    if authenticated:
         data['version'] = WORKER_SCRIPT_VERSION
 
-        if w.enlisted:
-            w.ping(**request.args)
-
         runners = int(request.args.get('available_runners', '0'))
         if runners > 0 and w.available:
             r = Run.pop_queued(w)
@@ -100,6 +104,20 @@ def worker_get(name):
     return jsendify({'worker': data})
 
 
+@blueprint.route('workers/<name>/metrics/', methods=('GET',))
+def worker_metrics(name):
+    '''Return the metrics reported by the worker since the given unix time,
+       the last hour by default, averaged over "step" seconds.'''
+    w = get_or_404(Worker.query.filter_by(name=name, deleted=False))
+    try:
+        since = int(request.args.get('since', time.time() - 3600))
+        step = int(request.args.get('step', RESOLUTION))
+    except ValueError:
+        raise ApiError(400, '"since" and "step" must be numeric')
+    times, series = w.metrics.query(since, step)
+    return jsendify({'metrics': {'times': times, 'series': series}})
+
+
 @blueprint.route('workers/<name>/', methods=['POST'])
 def worker_create(name):
     worker = request.get_json() or {}
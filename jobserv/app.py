@@ -19,7 +19,9 @@ from jobserv.flask import create_app
 from jobserv.git_poller import run
 from jobserv.lava_reactor import run_reaper
 from jobserv.models import (
-    Build, BuildStatus, Project, ProjectTrigger, Run, TriggerTypes, Worker, db)
+    Build, BuildStatus, Project, ProjectTrigger, Run, RunDuration,
+    TriggerTypes, Worker, db)
+from jobserv.retention import RetentionReport, apply_retention, purge_builds
 from jobserv.sendmail import email_on_exception
 from jobserv.storage import Storage
 from jobserv.worker import run_monitor_workers
@@ -81,15 +83,67 @@ def project_delete(name):
         db.session.delete(t)
     db.session.commit()
 
-    for b in p.builds:
-        db.session.delete(b)
-    db.session.commit()
+    report = purge_builds(list(p.builds))
 
+    RunDuration.query.filter_by(proj_id=p.id).delete()
     db.session.delete(p)
     db.session.commit()
 
-    click.echo('The project has been deleted from the database.')
-    click.echo('Build artifacts still remain in the datastore and must be removed by hand')  # NOQA
+    click.echo('The project has been deleted: %s' % report)
+
+
+@project.command('set-retention')
+@click.argument('name')
+@click.option('--builds', type=int,
+              help='Keep this many of the newest builds. 0 means no limit')
+@click.option('--days', type=int,
+              help='Keep builds for this many days. 0 means no limit')
+def project_set_retention(name, builds=None, days=None):
+    '''Set the retention policy of a project. Promoted builds are never
+       deleted.'''
+    p = Project.query.filter(Project.name == name).one()
+    if builds is not None:
+        p.retention_builds = builds or None
+    if days is not None:
+        p.retention_days = days or None
+    db.session.commit()
+
+
+@project.command('set-share')
+@click.argument('name')
+@click.option('--weight', type=int,
+              help='The project\'s share of the workers relative to other '
+                   'projects. Only used with QUEUE_FAIR_SHARE. 0 resets it')
+@click.option('--max-concurrency', type=int,
+              help='Run at most this many runs at once. 0 means no limit')
+def project_set_share(name, weight=None, max_concurrency=None):
+    '''Set how a project shares the workers with other projects.'''
+    p = Project.query.filter(Project.name == name).one()
+    if weight is not None:
+        p.share_weight = weight or None
+    if max_concurrency is not None:
+        p.max_concurrency = max_concurrency or None
+    db.session.commit()
+
+
+@app.cli.command('retention')
+@click.option('--dry-run', is_flag=True,
+              help='Report what would be deleted without deleting it')
+@click.option('--project', '-p', 'projects', multiple=True)
+@email_on_exception('jobserv: Retention Failed')
+def retention(dry_run=False, projects=None):
+    '''Delete the builds and artifacts of projects that have aged out of
+       their retention policy.'''
+    total = RetentionReport()
+    for p, report in apply_retention(dry_run, projects):
+        click.echo('%s: %s' % (p.name, report))
+        total.add(report)
+    click.echo('%s: %s' % ('Would delete' if dry_run else 'Deleted', total))
+    if not dry_run:
+        freed = Storage().purge_unreferenced_blobs()
+        if freed:
+            click.echo('Purged %.1f MB of unreferenced blobs and uploads' % (
+                freed / 1024 / 1024))
 
 
 def _register_gitlab_hook(project, url, api_token, hook_token, server_name):
@@ -231,9 +285,10 @@ def worker():
 
 @worker.command('list')
 def worker_list():
-    print('Worker\tEnlisted\tOnline')
+    print('Worker\tEnlisted\tOnline\tUnhealthy')
     for w in Worker.query.all():
-        print('%s\t%s\t%s' % (w.name, w.enlisted, w.online))
+        print('%s\t%s\t%s\t%s' % (
+            w.name, w.enlisted, w.online, w.unhealthy or ''))
 
 
 @worker.command('enlist')
@@ -2,9 +2,12 @@
 # Author: Andy Doan <andy.doan@linaro.org>
 
 import fnmatch
+import hashlib
 import json
 import logging
 import os
+import re
+import threading
 import time
 import xml.etree.ElementTree as ET
 
@@ -13,14 +16,23 @@ import yaml
 
 from urllib.parse import quote_plus, urlparse
 
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass, field
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-from typing import Dict, Iterator, List, Optional, Tuple
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 from jobserv.flask import permissions
 from jobserv.project import ProjectDefinition
-from jobserv.settings import GIT_POLLER_INTERVAL, GITLAB_SERVERS
+from jobserv.settings import (
+    GIT_POLLER_HOST_CONCURRENCY, GIT_POLLER_HOST_LIMITS, GIT_POLLER_INTERVAL,
+    GIT_POLLER_LEASE, GIT_POLLER_MAX_BACKOFF, GIT_POLLER_MAX_INTERVAL,
+    GIT_POLLER_MIN_INTERVAL, GIT_POLLER_NAME, GIT_POLLER_NUDGE_INTERVAL,
+    GIT_POLLER_WORKERS, GITLAB_SERVERS)
+from jobserv.stats import StatsClient
 from jobserv.storage import Storage
+from jobserv.storage.base import GitPollerCache
 
 logging.basicConfig(
     level='INFO', format='%(asctime)s %(levelname)s: %(message)s')
@@ -33,7 +45,35 @@ JOBSERV_URL = os.environ.get('JOBSERV_URL', 'http://lci-web')
 if JOBSERV_URL[-1] == '/':
     JOBSERV_URL = JOBSERV_URL[:-1]
 
+# ref advertisements are parsed as they arrive in chunks of this size
+PKT_CHUNK_SIZE = 64 * 1024
+
+# Commit logs are read this many commits at a time until the old SHA is
+# found. At most LOG_MAX_COMMITS are listed in a build's reason.
+LOG_PAGE_SIZE = 20
+LOG_MAX_COMMITS = 100
+
+# GitHub's compare API lists at most this many files
+GITHUB_COMPARE_MAX_FILES = 300
+# Runs only get GIT_CHANGED_FILES when the list is within these limits. It
+# ends up in the run's environment and Linux won't start a process with an
+# environment string over 128KB.
+CHANGED_FILES_MAX = GITHUB_COMPARE_MAX_FILES
+CHANGED_FILES_MAX_BYTES = 64 * 1024
+
 _cgit_repos: Dict[str, bool] = {}
+_host_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+_host_semaphores_lock = threading.Lock()
+
+# Connections to a host are reused by all triggers. Enough of them are kept
+# for each host's concurrency limit. Cookies are refused so that one
+# trigger's credentials can't leak into another's requests.
+_session = requests.Session()
+_session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+_pool_size = max(
+    [GIT_POLLER_HOST_CONCURRENCY] + list(GIT_POLLER_HOST_LIMITS.values()))
+for _scheme in ('http://', 'https://'):
+    _session.mount(_scheme, HTTPAdapter(pool_maxsize=_pool_size))
 
 
 @dataclass
@@ -55,6 +95,55 @@ class PollerEntry:
     projdef_headers: Dict[str, str] = field(default_factory=dict)
 
 
+def _host_semaphore(url: str) -> threading.BoundedSemaphore:
+    host = urlparse(url).hostname or ''
+    with _host_semaphores_lock:
+        sem = _host_semaphores.get(host)
+        if sem is None:
+            limit = GIT_POLLER_HOST_LIMITS.get(
+                host, GIT_POLLER_HOST_CONCURRENCY)
+            sem = _host_semaphores[host] = threading.BoundedSemaphore(limit)
+        return sem
+
+
+def _http_request(method, url: str, **kwargs) -> requests.Response:
+    '''Make a request limited to GIT_POLLER_HOST_CONCURRENCY at a time per
+       host. A streamed response counts against the limit until it's
+       closed, so callers must close it, e.g. with "with resp:".'''
+    sem = _host_semaphore(url)
+    sem.acquire()
+    try:
+        resp = method(url, **kwargs)
+    except Exception:
+        sem.release()
+        raise
+    if not kwargs.get('stream'):
+        sem.release()  # the body has already been read
+        return resp
+
+    close = resp.close
+    held = [sem]
+
+    def _close():
+        try:
+            close()
+        finally:
+            try:
+                held.pop().release()
+            except IndexError:
+                pass  # closed already
+    resp.close = _close
+    return resp
+
+
+def _http_get(url: str, **kwargs) -> requests.Response:
+    return _http_request(_session.get, url, **kwargs)
+
+
+def _http_post(url: str, **kwargs) -> requests.Response:
+    return _http_request(_session.post, url, **kwargs)
+
+
 def _get_project_triggers() -> Optional[Dict[int, ProjectTrigger]]:
     resp = permissions.internal_get(
         JOBSERV_URL + '/project-triggers/', params={'type': 'git_poller'})
@@ -65,16 +154,111 @@ def _get_project_triggers() -> Optional[Dict[int, ProjectTrigger]]:
     return {x['id']: ProjectTrigger(**x) for x in resp.json()['data']}
 
 
-def _get_projdef(entry: PollerEntry) -> Optional[ProjectDefinition]:
-    repo = entry.trigger.definition_repo or ''
-    defile = entry.trigger.definition_file
-    if not defile:
-        defile = entry.trigger.project + '.yml'
-    gitlab = entry.trigger.secrets.get('gitlabtok')
-    gheader = entry.trigger.secrets.get('git.http.extraheader')
+def _heartbeat() -> Optional[List[str]]:
+    '''Tell jobserv this poller is alive. Returns the names of all live
+       poller instances.'''
+    resp = permissions.internal_post(
+        JOBSERV_URL + '/project-triggers/pollers/%s/' % GIT_POLLER_NAME)
+    if resp.status_code != 200:
+        log.error('Unable to send heartbeat to front-end: %d %s',
+                  resp.status_code, resp.text)
+        return None
+    return resp.json()['data']
+
+
+def _owner(trigger_id: int, pollers: List[str]) -> str:
+    '''Pick the poller instance responsible for a trigger. This is
+       rendezvous hashing: when an instance comes or goes, only the
+       triggers it owns move.'''
+    def weight(poller):
+        key = '%s:%s' % (poller, trigger_id)
+        return hashlib.sha1(key.encode()).digest()
+    return max(pollers, key=weight)
+
+
+def _shard(triggers: Dict[int, ProjectTrigger], pollers: List[str]) \
+        -> Dict[int, ProjectTrigger]:
+    '''Return the triggers this poller instance is responsible for.'''
+    if GIT_POLLER_NAME not in pollers:
+        pollers = pollers + [GIT_POLLER_NAME]
+    return {k: v for k, v in triggers.items()
+            if _owner(k, pollers) == GIT_POLLER_NAME}
 
-    headers = entry.projdef_headers
-    token = entry.trigger.secrets.get('githubtok')
+
+class PollerLease(object):
+    '''Keeps this instance's lease with jobserv alive. Once started, the
+       heartbeat is sent from a background thread so a slow poll cycle
+       can't let the lease lapse while this instance is still triggering
+       builds. Without the thread each call sends its own heartbeat.'''
+    def __init__(self):
+        self._pollers: Optional[List[str]] = None
+        self._renewed = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def renew(self) -> Optional[List[str]]:
+        pollers = _heartbeat()
+        if pollers is not None:
+            with self._lock:
+                self._pollers = pollers
+                self._renewed = time.time()
+        return pollers
+
+    def pollers(self) -> Optional[List[str]]:
+        '''The live poller instances, or None if the lease has lapsed.'''
+        if self._thread is None:
+            return self.renew()
+        with self._lock:
+            if time.time() - self._renewed > GIT_POLLER_LEASE:
+                return None
+            return self._pollers
+
+    def owns(self, trigger_id: int) -> bool:
+        '''Is this instance still responsible for the trigger?'''
+        pollers = self.pollers()
+        if pollers is None:
+            # the other instances have taken over our triggers by now
+            return False
+        if GIT_POLLER_NAME not in pollers:
+            pollers = pollers + [GIT_POLLER_NAME]
+        return _owner(trigger_id, pollers) == GIT_POLLER_NAME
+
+    def start(self, interval: float):
+        self._thread = threading.Thread(
+            target=self._run, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def _run(self, interval: float):
+        while True:
+            try:
+                self.renew()
+            except Exception:
+                log.exception('Unable to send heartbeat to front-end')
+            time.sleep(interval)
+
+
+_lease = PollerLease()
+
+
+def _get_nudges() -> List[str]:
+    '''Take the repository URLs jobserv has been asked to re-poll.'''
+    resp = permissions.internal_post(
+        JOBSERV_URL + '/project-triggers/nudges/pop/',
+        json={'poller': GIT_POLLER_NAME})
+    if resp.status_code != 200:
+        log.error('Unable to get poll nudges from front-end: %d %s',
+                  resp.status_code, resp.text)
+        return []
+    return resp.json()['data']
+
+
+def _projdef_url(trigger: ProjectTrigger, headers: Dict[str, str]) -> str:
+    repo = trigger.definition_repo or ''
+    defile = trigger.definition_file
+    if not defile:
+        defile = trigger.project + '.yml'
+    gitlab = trigger.secrets.get('gitlabtok')
+    token = trigger.secrets.get('githubtok')
 
     if gitlab:
         headers['PRIVATE-TOKEN'] = gitlab
@@ -92,25 +276,60 @@ def _get_projdef(entry: PollerEntry) -> Optional[ProjectDefinition]:
             url += '.git'
         url = repo + '/plain/' + defile
         log.info('Assuming CGit style URL to file: %s', url)
+    return url
+
+
+def _get_projdef(entry: PollerEntry, cache: Dict[str, str]) \
+        -> Optional[ProjectDefinition]:
+    '''Return the trigger's current project definition. "cache" is the
+       trigger's persisted copy of the definition and the ETag and
+       Last-Modified headers it was served with, so that a restarted
+       poller can make conditional requests and skip validating it again.
+    '''
+    headers = entry.projdef_headers
+    url = _projdef_url(entry.trigger, headers)
+    gheader = entry.trigger.secrets.get('git.http.extraheader')
+
+    if cache.get('url') != url:
+        cache.clear()
+    if entry.definition is None and cache.get('content'):
+        # It was validated before it was cached
+        entry.definition = ProjectDefinition(
+            yaml.safe_load(cache['content']))
+
+    cond_headers = dict(headers)
+    if entry.definition is not None:
+        if cache.get('etag'):
+            cond_headers['If-None-Match'] = cache['etag']
+        if cache.get('last_modified'):
+            cond_headers['If-Modified-Since'] = cache['last_modified']
 
-    r = requests.get(url, headers=headers)
+    r = _http_get(url, headers=cond_headers)
     if r.status_code == 401 and gheader:
         log.info('Authorization required using git header in secrets')
         key, val = gheader.split(':', 1)
         headers[key.strip()] = val.strip()
-        r = requests.get(url, headers=headers)
+        cond_headers[key.strip()] = val.strip()
+        r = _http_get(url, headers=cond_headers)
 
     if r.status_code == 200:
-        try:
-            log.info('New version of project definition found for %s', url)
-            data = yaml.safe_load(r.text)
-            ProjectDefinition.validate_data(data)
-            entry.definition = ProjectDefinition(data)
-            # allows us to cache the resp
-            headers['If-None-Match'] = r.headers['ETAG']
-        except Exception:
-            log.exception('Validation failed for %s ...skipping', url)
-            return None
+        sha = hashlib.sha256(r.content).hexdigest()
+        if entry.definition is None or sha != cache.get('sha256'):
+            try:
+                log.info('New version of project definition found for %s',
+                         url)
+                data = yaml.safe_load(r.text)
+                ProjectDefinition.validate_data(data)
+                entry.definition = ProjectDefinition(data)
+            except Exception:
+                log.exception('Validation failed for %s ...skipping', url)
+                return None
+            cache.update({'url': url, 'sha256': sha, 'content': r.text})
+        else:
+            log.debug('Content unchanged for %s', url)
+        # allows us to make conditional requests
+        cache['etag'] = r.headers.get('ETag')
+        cache['last_modified'] = r.headers.get('Last-Modified')
     elif r.status_code == 304:
         # it hasn't changed
         log.debug('Cache hit for %s', url)
@@ -121,13 +340,87 @@ def _get_projdef(entry: PollerEntry) -> Optional[ProjectDefinition]:
     return entry.definition
 
 
-def _get_refs(repo_url: str, trigger: ProjectTrigger) \
+class RefsError(Exception):
+    pass
+
+
+def _pkt_lines(chunks: Iterator[bytes]) -> Iterator[Optional[bytes]]:
+    '''Parse a stream of git pkt-lines as it arrives. Yields the payload of
+       each line or None for the special flush/delimiter packets.'''
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= 4:
+            size = int(buf[:4], 16)
+            if size < 4:
+                del buf[:4]
+                yield None
+                continue
+            if len(buf) < size:
+                break
+            line = bytes(buf[4:size])
+            del buf[:size]
+            yield line
+
+
+def _pkt_line(data: bytes) -> bytes:
+    return b'%04x' % (len(data) + 4) + data
+
+
+def _ref_prefixes(patterns: List[str]) -> List[str]:
+    '''Return the ls-refs "ref-prefix" values that cover all the fnmatch
+       patterns. An empty list means a pattern could match any ref.'''
+    prefixes: List[str] = []
+    for pattern in patterns:
+        prefix = re.split(r'[*?[]', pattern, 1)[0]
+        if not prefix:
+            return []
+        prefixes.append(prefix)
+    # drop prefixes already covered by a shorter one
+    covered: List[str] = []
+    for prefix in sorted(prefixes):
+        if not covered or not prefix.startswith(covered[-1]):
+            covered.append(prefix)
+    return covered
+
+
+def _ls_refs(url: str, prefixes: List[str], **kwargs) \
+        -> Iterator[Tuple[str, str]]:
+    '''Run a git protocol v2 ls-refs command. The server only sends the
+       refs starting with one of the prefixes.'''
+    body = _pkt_line(b'command=ls-refs\n') + b'0001'
+    for prefix in prefixes:
+        body += _pkt_line(b'ref-prefix %s\n' % prefix.encode())
+    body += b'0000'
+
+    headers = dict(kwargs.pop('headers', None) or {})
+    headers.update({
+        'Git-Protocol': 'version=2',
+        'Content-Type': 'application/x-git-upload-pack-request',
+        'Accept': 'application/x-git-upload-pack-result',
+    })
+    resp = _http_post(url, data=body, headers=headers, stream=True, **kwargs)
+    try:
+        if resp.status_code != 200:
+            raise RefsError('Unable to list refs of %s: %d %s' % (
+                url, resp.status_code, resp.reason))
+        for line in _pkt_lines(resp.iter_content(PKT_CHUNK_SIZE)):
+            if line is None:
+                break
+            # <sha> <ref>[ <attribute>...]
+            sha, ref = line.rstrip(b'\n').split(b' ')[:2]
+            yield sha.decode(), ref.decode()
+    finally:
+        resp.close()
+
+
+def _get_refs(repo_url: str, trigger: ProjectTrigger, patterns: List[str]) \
               -> Iterator[Tuple[str, str]]:
     secrets = trigger.secrets
-    auth = None
+    kwargs: Dict = {'headers': {'Git-Protocol': 'version=2'}}
     ghtok = secrets.get('githubtok')
     if ghtok:
-        auth = HTTPBasicAuth(trigger.user, ghtok)
+        kwargs['auth'] = HTTPBasicAuth(trigger.user, ghtok)
 
     gltok = secrets.get('gitlabtok')
     git_header = secrets.get('git.http.extraheader')
@@ -138,8 +431,8 @@ def _get_refs(repo_url: str, trigger: ProjectTrigger) \
         repo_url += '.git'
     if repo_url[-1] != '/':
         repo_url += '/'
-    repo_url += 'info/refs?service=git-upload-pack'
-    resp = requests.get(repo_url, auth=auth)
+    resp = _http_get(
+        repo_url + 'info/refs?service=git-upload-pack', stream=True, **kwargs)
     if gltok and resp.status_code == 401:
         # this might be a gitlab repo, try with the token
         # we have to try unauthenticated first, because it could be a non-git
@@ -147,35 +440,185 @@ def _get_refs(repo_url: str, trigger: ProjectTrigger) \
         log.debug('Trying repo(%s) with gitlab credentials', repo_url)
         user = secrets.get('gitlabuser')
         repo_url = repo_url.replace('://', '://%s:%s@' % (user, gltok))
-        resp = requests.get(repo_url)
+        kwargs.pop('auth', None)
+        resp.close()
+        resp = _http_get(repo_url + 'info/refs?service=git-upload-pack',
+                         stream=True, **kwargs)
         # TODO flag this as a gitlab repo and then add in logic like
         # _github_log below
     elif git_header and resp.status_code == 401:
         key, val = git_header.split(':', 1)
-        headers = {
+        kwargs['headers'].update({
             key.strip(): val.strip(),
             'User-Agent': 'git',
-        }
-        resp = requests.get(repo_url, headers=headers)
+        })
+        resp.close()
+        resp = _http_get(repo_url + 'info/refs?service=git-upload-pack',
+                         stream=True, **kwargs)
+
+    try:
+        if resp.status_code != 200:
+            raise RefsError('Unable to check %s for changes: %d %s' % (
+                repo_url, resp.status_code, resp.reason))
+        lines = _pkt_lines(resp.iter_content(PKT_CHUNK_SIZE))
+        line = next(lines, None)
+        if line and line.startswith(b'# service='):
+            next(lines, None)  # the flush packet after the service line
+            line = next(lines, None)
+
+        if line == b'version 2\n':
+            # Protocol v2 only advertises capabilities. ls-refs lets us ask
+            # for just the refs we're interested in rather than every tag.
+            caps = []
+            for line in lines:
+                if line is None:
+                    break
+                caps.append(line.rstrip(b'\n').split(b'=')[0])
+            resp.close()
+            if b'ls-refs' not in caps:
+                raise RefsError('%s does not support ls-refs' % repo_url)
+            yield from _ls_refs(
+                repo_url + 'git-upload-pack', _ref_prefixes(patterns),
+                **kwargs)
+            return
+
+        # An older server sends its entire ref advertisement, which we parse
+        # as it streams in. The first ref carries the capability list.
+        while line is not None:
+            sha, ref = line.rstrip(b'\n').split(b'\0')[0].split(b' ', 1)
+            if ref != b'capabilities^{}':  # an empty repository
+                log.debug('Looking at ref: %s', ref)
+                yield sha.decode(), ref.decode()
+            line = next(lines, None)
+    finally:
+        resp.close()
+
+
+class RefSnapshots(object):
+    '''The refs of each repository fetched during one poll cycle. They're
+       keyed by URL and the credentials used to read them, so triggers that
+       watch the same repository share a single request.'''
+    def __init__(self):
+        self.requests = 0
+        self.lookups = 0
+        # the URLs that were read, couldn't be read, and that had changes
+        self.polled: Set[str] = set()
+        self.failed: Set[str] = set()
+        self.changed: Set[str] = set()
+        self._refs: Dict[tuple, List[Tuple[str, str]]] = {}
+        self._locks: Dict[tuple, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(url: str, trigger: ProjectTrigger, patterns: List[str]) \
+            -> tuple:
+        secrets = trigger.secrets
+        creds = tuple(secrets.get(x) for x in (
+            'githubtok', 'gitlabuser', 'gitlabtok', 'git.http.extraheader'))
+        user = trigger.user if secrets.get('githubtok') else None
+        # servers speaking protocol v2 only return the refs we ask for
+        return (url, user, tuple(_ref_prefixes(patterns))) + creds
+
+    def get(self, url: str, trigger: ProjectTrigger, patterns: List[str]) \
+            -> List[Tuple[str, str]]:
+        key = self._key(url, trigger, patterns)
+        with self._lock:
+            self.lookups += 1
+            lock = self._locks.setdefault(key, threading.Lock())
+        # triggers for the same repo wait here for the first one's request
+        with lock:
+            refs = self._refs.get(key)
+            if refs is None:
+                self.polled.add(url)
+                self.requests += 1
+                try:
+                    refs = list(_get_refs(url, trigger, patterns))
+                except RefsError as e:
+                    log.error('%s', e)
+                    self.failed.add(url)
+                    refs = []
+                except Exception:
+                    log.exception('Unable to check %s for changes', url)
+                    self.failed.add(url)
+                    refs = []
+                self._refs[key] = refs
+        return refs
 
-    if resp.status_code != 200:
-        log.error('Unable to check %s for changes: %d %s',
-                  repo_url, resp.status_code, resp.reason)
-    else:
-        for line in resp.text.splitlines()[2:]:
-            if line == '0000':
-                break
-            line = line[4:]  # strip off git protocol stuff
-            log.debug('Looking at ref: %s', line)
-            sha, ref = line.split(' ', 1)
-            yield sha, ref
+
+def _normalize_url(url: str) -> str:
+    url = url.rstrip('/')
+    if url.endswith('.git'):
+        url = url[:-4]
+    return url
+
+
+@dataclass
+class RepoSchedule:
+    interval: float
+    next_due: float
+    failures: int = 0
+
+
+class PollScheduler(object):
+    '''Decides when each repository is polled next. A repository's interval
+       halves when it changes and grows by a quarter each time it hasn't,
+       staying between GIT_POLLER_MIN_INTERVAL and GIT_POLLER_MAX_INTERVAL.
+       Repositories that can't be read back off exponentially up to
+       GIT_POLLER_MAX_BACKOFF.'''
+    def __init__(self):
+        self.repos: Dict[str, RepoSchedule] = {}
+
+    def is_due(self, url: str, now: float) -> bool:
+        repo = self.repos.get(url)
+        return repo is None or repo.next_due <= now
+
+    def next_due(self) -> Optional[float]:
+        return min((x.next_due for x in self.repos.values()), default=None)
+
+    def record(self, url: str, now: float, changed: bool, failed: bool):
+        repo = self.repos.get(url)
+        if repo is None:
+            repo = RepoSchedule(GIT_POLLER_INTERVAL, now)
+            self.repos[url] = repo
+        if failed:
+            repo.failures += 1
+            delay = min(GIT_POLLER_MAX_BACKOFF,
+                        repo.interval * 2 ** repo.failures)
+        else:
+            repo.failures = 0
+            if changed:
+                repo.interval /= 2
+            else:
+                repo.interval *= 1.25
+            repo.interval = min(GIT_POLLER_MAX_INTERVAL,
+                                max(GIT_POLLER_MIN_INTERVAL, repo.interval))
+            delay = repo.interval
+        repo.next_due = now + delay
+
+    def nudge(self, url: str, now: float) -> bool:
+        '''Make a repository due now. Returns False if it isn't polled.'''
+        url = _normalize_url(url)
+        found = False
+        for key, repo in self.repos.items():
+            if _normalize_url(key) == url:
+                repo.next_due = min(repo.next_due, now)
+                found = True
+        return found
+
+    def forget_unpolled(self, now: float, polled: Set[str]):
+        '''Forget the repositories that were due at "now" but not polled.
+           No trigger watches them anymore.'''
+        for url, repo in list(self.repos.items()):
+            if repo.next_due <= now and url not in polled:
+                del self.repos[url]
 
 
 def _get_repo_changes(refs_cache, url: str, refs: List[str],
-                      trigger: ProjectTrigger) -> Iterator[dict]:
+                      trigger: ProjectTrigger,
+                      snapshots: RefSnapshots) -> Iterator[dict]:
     log.info('Looking for changes to: %s', url)
     cur_refs = refs_cache.setdefault(url, {})
-    for sha, ref in _get_refs(url, trigger):
+    for sha, ref in snapshots.get(url, trigger, refs):
         for pattern in refs:
             if fnmatch.fnmatch(ref, pattern):
                 cur = cur_refs.get(ref)
@@ -219,25 +662,35 @@ def _github_log(
         auth = HTTPBasicAuth(trigger.user, ghtok)
 
     gitlog = ''
-    try:
-        r = requests.get(url, auth=auth)
-    except Exception as e:
-        log.exception('Unable to get %s', url)
-        return 'Unable to get %s\n%s' % (url, str(e)), skip
-    if r.status_code == 200:
-        for commit in r.json():
+    count = 0
+    page = 1
+    while True:
+        params = {'per_page': LOG_PAGE_SIZE, 'page': page}
+        try:
+            r = _http_get(url, auth=auth, params=params)
+        except Exception as e:
+            log.exception('Unable to get %s', url)
+            return 'Unable to get %s\n%s' % (url, str(e)), skip
+        if r.status_code != 200:
+            gitlog += 'Unable to get github log(%s): %d %s' % (
+                url, r.status_code, r.text)
+            return gitlog, skip
+        commits = r.json()
+        for commit in commits:
             sha = commit['sha']
             if sha == base:
-                break
+                return gitlog, skip
             msg = commit['commit']['message']
             if sha == head:
                 skip = _is_skipped(msg)
             gitlog += '%s %s\n' % (
                 sha[:7], msg.splitlines()[0])
-    else:
-        gitlog += 'Unable to get github log(%s): %d %s' % (
-            url, r.status_code, r.text)
-    return gitlog, skip
+            count += 1
+        if len(commits) < LOG_PAGE_SIZE:
+            return gitlog, skip
+        if count >= LOG_MAX_COMMITS:
+            return gitlog + '...\n', skip
+        page += 1
 
 
 def _gitlab_log(
@@ -256,28 +709,38 @@ def _gitlab_log(
     tok = trigger.secrets.get('gitlabtok')
     if tok:
         headers = {'PRIVATE-TOKEN': tok}
-    try:
-        r = requests.get(url, headers=headers, params={'ref_name': head})
-    except Exception as e:
-        log.exception('Unable to get %s', url)
-        return 'Unable to get %s\n%s' % (url, str(e)), skip
 
     gitlog = ''
-    if r.status_code == 200:
-        for commit in r.json():
+    count = 0
+    page = 1
+    while True:
+        params = {'ref_name': head, 'per_page': LOG_PAGE_SIZE, 'page': page}
+        try:
+            r = _http_get(url, headers=headers, params=params)
+        except Exception as e:
+            log.exception('Unable to get %s', url)
+            return 'Unable to get %s\n%s' % (url, str(e)), skip
+        if r.status_code != 200:
+            gitlog += 'Unable to get gitlab log(%s): %d %s' % (
+                url, r.status_code, r.text)
+            return gitlog, skip
+        commits = r.json()
+        for commit in commits:
             sha = commit['id']
             if sha == base:
-                break
+                return gitlog, skip
             title = commit['title']
             gitlog += '%s %s\n' % (
                 commit['short_id'], title)
             if sha == head:
                 msg = commit['message']
                 skip = _is_skipped(msg, title)
-    else:
-        gitlog += 'Unable to get gitlab log(%s): %d %s' % (
-            url, r.status_code, r.text)
-    return gitlog, skip
+            count += 1
+        if len(commits) < LOG_PAGE_SIZE:
+            return gitlog, skip
+        if count >= LOG_MAX_COMMITS:
+            return gitlog + '...\n', skip
+        page += 1
 
 
 def _cgit_log(
@@ -295,12 +758,12 @@ def _cgit_log(
 
     try:
         params = {'h': head}
-        r = requests.get(url, params=params)
+        r = _http_get(url, params=params)
         if r.status_code == 401 and gheader:
             log.info('Authorization required using git header in secrets')
             key, val = gheader.split(':', 1)
             headers = {key.strip(): val.strip()}
-            r = requests.get(url, headers=headers, params=params)
+            r = _http_get(url, headers=headers, params=params)
     except Exception as e:
         log.exception('Unable to get %s', url)
         return 'Unable to get %s\n%s' % (url, str(e)), skip
@@ -330,8 +793,195 @@ def _cgit_log(
     return gitlog, skip
 
 
+def _github_changed_files(
+        trigger: ProjectTrigger,
+        change_params: Dict[str, str]
+) -> Optional[List[str]]:
+    url = change_params['GIT_URL'].replace(
+        '.git', ''
+    ).replace(
+        'github.com', 'api.github.com/repos'
+    ) + '/compare/%s...%s' % (
+        change_params['GIT_OLD_SHA'], change_params['GIT_SHA'])
+
+    auth = None
+    ghtok = trigger.secrets.get('githubtok')
+    if ghtok:
+        auth = HTTPBasicAuth(trigger.user, ghtok)
+    r = _http_get(url, auth=auth)
+    if r.status_code != 200:
+        log.error('Unable to get github changes(%s): %d %s',
+                  url, r.status_code, r.text)
+        return None
+    files = r.json().get('files', [])
+    if len(files) >= GITHUB_COMPARE_MAX_FILES:
+        return None  # github truncated the list
+    changed = []
+    for f in files:
+        changed.append(f['filename'])
+        if f.get('previous_filename'):
+            changed.append(f['previous_filename'])
+    return changed
+
+
+def _gitlab_changed_files(
+        trigger: ProjectTrigger,
+        change_params: Dict[str, str]
+) -> Optional[List[str]]:
+    p = urlparse(change_params['GIT_URL'])
+    proj_enc = quote_plus(p.path[1:].replace('.git', ''))
+    url = p.scheme + '://' + p.netloc + '/api/v4/projects/' + proj_enc + \
+        '/repository/compare'
+    params = {
+        'from': change_params['GIT_OLD_SHA'],
+        'to': change_params['GIT_SHA'],
+    }
+    headers = None
+    tok = trigger.secrets.get('gitlabtok')
+    if tok:
+        headers = {'PRIVATE-TOKEN': tok}
+    r = _http_get(url, headers=headers, params=params)
+    if r.status_code != 200:
+        log.error('Unable to get gitlab changes(%s): %d %s',
+                  url, r.status_code, r.text)
+        return None
+    data = r.json()
+    if data.get('compare_timeout'):
+        return None
+    changed = set()
+    for diff in data.get('diffs', []):
+        changed.add(diff['old_path'])
+        changed.add(diff['new_path'])
+    return sorted(changed)
+
+
+def _cgit_changed_files(
+        trigger: ProjectTrigger,
+        change_params: Dict[str, str]
+) -> Optional[List[str]]:
+    gheader = trigger.secrets.get('git.http.extraheader')
+    url = change_params['GIT_URL']
+    if url[-4:] != '.git':
+        url += '.git'
+    url += '/rawdiff/'
+    params = {'id': change_params['GIT_SHA'],
+              'id2': change_params['GIT_OLD_SHA']}
+    headers = {}
+    if gheader:
+        key, val = gheader.split(':', 1)
+        headers[key.strip()] = val.strip()
+
+    # The diff itself can be huge, so only its headers are kept
+    r = _http_get(url, headers=headers, params=params, stream=True)
+    try:
+        if r.status_code != 200:
+            log.error('Unable to get cgit changes(%s): %d',
+                      url, r.status_code)
+            return None
+        changed = set()
+        for line in r.iter_lines():
+            if line.startswith(b'diff --git '):
+                m = re.match(r'diff --git a/(.+) b/(.+)$',
+                             line.decode(errors='replace'))
+                if m:
+                    changed.update(m.groups())
+        if not changed:
+            # Not a diff. This could be a page from something other than
+            # cgit, so we can't say nothing changed.
+            return None
+        return sorted(changed)
+    finally:
+        r.close()
+
+
+def _changed_files(
+        trigger: ProjectTrigger,
+        change_params: Dict[str, str]
+) -> Optional[List[str]]:
+    '''Return the files changed between GIT_OLD_SHA and GIT_SHA, or None
+       if they can't be determined.'''
+    p = urlparse(change_params['GIT_URL'])
+    url = p.scheme + '://' + p.netloc
+    try:
+        if url == 'https://github.com':
+            return _github_changed_files(trigger, change_params)
+        elif url in GITLAB_SERVERS:
+            return _gitlab_changed_files(trigger, change_params)
+        elif _cgit_repos.get(url, True):
+            return _cgit_changed_files(trigger, change_params)
+        return None
+    except Exception:
+        log.exception('Unable to get changed files of %s',
+                      change_params['GIT_URL'])
+        return None
+
+
+def _match_paths(files: List[str], paths: Dict[str, List[str]]) \
+        -> List[str]:
+    '''Return the files matching a trigger's "paths" include and exclude
+       globs. No include list means every file is included.'''
+    include = paths.get('include') or ['*']
+    exclude = paths.get('exclude') or []
+    return [f for f in files
+            if any(fnmatch.fnmatch(f, x) for x in include)
+            if not any(fnmatch.fnmatch(f, x) for x in exclude)]
+
+
+def _commit_log(
+        trigger: ProjectTrigger,
+        change_params: Dict[str, str]
+) -> Tuple[str, bool]:
+    '''Return a summary of the commits in a change and whether its head
+       commit asks for CI to be skipped.'''
+    p = urlparse(change_params['GIT_URL'])
+    url = p.scheme + '://' + p.netloc
+    if url == 'https://github.com':
+        return _github_log(trigger, change_params)
+    elif url in GITLAB_SERVERS:
+        return _gitlab_log(trigger, change_params)
+    elif _cgit_repos.get(url, True):
+        summary, skipped = _cgit_log(trigger, change_params)
+        if not summary:
+            _cgit_repos[url] = False
+        return summary, skipped
+    return '', False
+
+
+class CommitLogs(object):
+    '''The commit logs of the changes found during a poll. Each change is
+       fetched once, in the background, however many refs or triggers
+       found it. As with RefSnapshots, triggers only share a log when they
+       use the same credentials.'''
+    def __init__(self, pool: ThreadPoolExecutor):
+        self._pool = pool
+        self._logs: Dict[Tuple, Future] = {}
+        self._lock = threading.Lock()
+        self.fetches = 0
+
+    @staticmethod
+    def _key(trigger: ProjectTrigger, change_params: Dict[str, str]):
+        secrets = trigger.secrets
+        return (change_params['GIT_URL'], change_params['GIT_OLD_SHA'],
+                change_params['GIT_SHA'], trigger.user,
+                secrets.get('githubtok'), secrets.get('gitlabtok'),
+                secrets.get('git.http.extraheader'))
+
+    def get(self, trigger: ProjectTrigger, change_params: Dict[str, str]) \
+            -> Future:
+        key = self._key(trigger, change_params)
+        with self._lock:
+            future = self._logs.get(key)
+            if future is None:
+                self.fetches += 1
+                future = self._pool.submit(
+                    _commit_log, trigger, change_params)
+                self._logs[key] = future
+        return future
+
+
 def _trigger(entry: PollerEntry, trigger_name: str,
-             change_params: Dict[str, str]):
+             change_params: Dict[str, str],
+             logs: Optional[CommitLogs] = None):
     log.info('Trigger build for %s with params: %r',
              entry.trigger.project, change_params)
     assert entry.definition
@@ -343,29 +993,36 @@ def _trigger(entry: PollerEntry, trigger_name: str,
         'reason': json.dumps(change_params, indent=2),
         'queue-priority': entry.trigger.queue_priority,
     }
-    p = urlparse(change_params['GIT_URL'])
-    url = p.scheme + '://' + p.netloc
-    skipped = False
-    if url == 'https://github.com':
-        summary, skipped = _github_log(entry.trigger, change_params)
-        data['reason'] += '\n' + summary
-    elif url in GITLAB_SERVERS:
-        summary, skipped = _gitlab_log(entry.trigger, change_params)
-        data['reason'] += '\n' + summary
+    if logs:
+        summary, skipped = logs.get(entry.trigger, change_params).result()
     else:
-        capable = _cgit_repos.get(url, True)
-        if capable:
-            summary, skipped = _cgit_log(entry.trigger, change_params)
-            if summary:
-                data['reason'] += '\n' + summary
-            else:
-                _cgit_repos[url] = False
+        summary, skipped = _commit_log(entry.trigger, change_params)
+    if summary:
+        data['reason'] += '\n' + summary
     if skipped:
         log.info(
             'Skipping build for %s because of skip-ci message',
             entry.trigger.project)
         return
 
+    paths = (entry.definition.get_trigger(trigger_name) or {}).get('paths')
+    if paths:
+        # if the changes can't be listed, we build to be safe
+        files = _changed_files(entry.trigger, change_params)
+        if files is not None:
+            if not _match_paths(files, paths):
+                log.info('Skipping build for %s, no changes to its paths',
+                         entry.trigger.project)
+                return
+            changed = '\n'.join(files)
+            if len(files) <= CHANGED_FILES_MAX and \
+                    len(changed.encode()) <= CHANGED_FILES_MAX_BYTES:
+                data['params'] = dict(
+                    change_params, GIT_CHANGED_FILES=changed)
+            else:
+                log.info('Not setting GIT_CHANGED_FILES for %s, %d files '
+                         'changed', entry.trigger.project, len(files))
+
     log.debug('Data for build is: %r', data)
     url = '%s/projects/%s/builds/' % (JOBSERV_URL, entry.trigger.project)
     resp = permissions.internal_post(url, json=data)
@@ -376,10 +1033,12 @@ def _trigger(entry: PollerEntry, trigger_name: str,
         log.info('Build created: %s', resp.text)
 
 
-def _poll_project(refs_cache, entry: PollerEntry):
+def _poll_project(refs_cache, entry: PollerEntry, snapshots: RefSnapshots,
+                  logs: CommitLogs, is_due: Callable[[str], bool]) -> bool:
     triggers: List[Dict] = []
     if entry.definition:
         triggers = entry.definition.triggers
+    found = []
     for trigger in triggers:
         if trigger['type'] == 'git_poller':
             params = trigger.get('params', {})
@@ -390,18 +1049,58 @@ def _poll_project(refs_cache, entry: PollerEntry):
                           entry.trigger.project)
                 continue
             for url in urls:
-                for changes in _get_repo_changes(refs_cache, url, refs, entry.trigger):  # NOQA
-                    _trigger(entry, trigger['name'], changes)
+                if not is_due(url):
+                    continue
+                for changes in _get_repo_changes(
+                        refs_cache, url, refs, entry.trigger, snapshots):
+                    snapshots.changed.add(url)
+                    found.append((trigger['name'], changes))
+
+    # start fetching all the commit logs before creating the first build
+    for _, changes in found:
+        logs.get(entry.trigger, changes)
+    # the triggers may have moved to another instance while this one was
+    # busy, the new owner will find these changes
+    if found and not _lease.owns(entry.trigger.id):
+        log.warning('%s moved to another poller, not triggering builds',
+                    entry.trigger.project)
+        return False
+    for name, changes in found:
+        _trigger(entry, name, changes, logs)
+    return True
+
+
+def _poll_entry(refs_cache: GitPollerCache, snapshots: RefSnapshots,
+                logs: CommitLogs, is_due: Callable[[str], bool],
+                refresh: bool, entry: PollerEntry):
+    log.debug('Checking project: %s %d',
+              entry.trigger.project, entry.trigger.id)
+    projdef = entry.definition
+    if refresh:
+        projdef = _get_projdef(
+            entry, refs_cache.get_projdef(entry.trigger.id))
+    if projdef and not _poll_project(refs_cache.get(entry.trigger.id), entry,
+                                     snapshots, logs, is_due):
+        # forget the refs it found so they aren't written as seen
+        refs_cache.discard(entry.trigger.id)
+        return
+    # only writes the shards if a ref or the definition changed
+    refs_cache.persist(entry.trigger.id)
 
 
-def _poll(entries: Dict[int, PollerEntry]):
+def _sync_triggers(entries: Dict[int, PollerEntry],
+                   refs_cache: GitPollerCache) -> bool:
     try:
+        pollers = _lease.pollers()
         triggers = _get_project_triggers()
-        if triggers is None:
-            return
+        if pollers is None or triggers is None:
+            return False
     except Exception:
         logging.exception('Unable to get project list from JobServ')
-        return
+        return False
+    triggers = _shard(triggers, pollers)
+    log.debug('Polling %d triggers as one of %d pollers',
+              len(triggers), len(pollers))
 
     names = set(triggers.keys())
     cur_names = set(entries.keys())
@@ -409,6 +1108,7 @@ def _poll(entries: Dict[int, PollerEntry]):
     for n in cur_names - names:
         log.info('Removing %s from poller list', n)
         del entries[n]
+        refs_cache.discard(n)
 
     for n in names - cur_names:
         log.info('Adding %s to poller list', n)
@@ -418,29 +1118,106 @@ def _poll(entries: Dict[int, PollerEntry]):
         if entries[n].trigger != triggers[n]:
             log.info('Updating %s', n)
             entries[n].trigger = triggers[n]
+    return True
+
+
+def _poll(entries: Dict[int, PollerEntry], refs_cache: GitPollerCache,
+          scheduler: PollScheduler, refresh: bool = True):
+    '''Poll the repositories the scheduler says are due. With refresh, the
+       list of triggers and their project definitions are read first.'''
+    if refresh and not _sync_triggers(entries, refs_cache):
+        return
 
-    with Storage().git_poller_cache() as refs_cache:
-        for entry in entries.values():
-            log.debug('Checking project: %s %d',
-                      entry.trigger.project, entry.trigger.id)
-            projdef = _get_projdef(entry)
-            proj_refs = refs_cache.setdefault(str(entry.trigger.id), {})
-            if projdef:
-                _poll_project(proj_refs, entry)
+    now = time.time()
+    snapshots = RefSnapshots()
+
+    def is_due(url: str) -> bool:
+        return scheduler.is_due(url, now)
+
+    with ThreadPoolExecutor(GIT_POLLER_WORKERS) as pool, \
+            ThreadPoolExecutor(GIT_POLLER_WORKERS) as log_pool:
+        logs = CommitLogs(log_pool)
+        futures = {
+            pool.submit(_poll_entry, refs_cache, snapshots, logs, is_due,
+                        refresh, x): x
+            for x in entries.values()
+        }
+        for f in as_completed(futures):
+            try:
+                f.result()
+            except Exception:
+                log.exception('Unable to poll %s', futures[f].trigger.project)
+
+    done = time.time()
+    for url in snapshots.polled:
+        scheduler.record(
+            url, done, url in snapshots.changed, url in snapshots.failed)
+    scheduler.forget_unpolled(now, snapshots.polled)
+    log.info('Read refs %d times for %d repository checks',
+             snapshots.requests, snapshots.lookups)
+    if logs.fetches:
+        log.info('Read %d commit logs', logs.fetches)
+
+
+def _wait(scheduler: PollScheduler, until: float):
+    '''Sleep until "until", checking jobserv for poll nudges while waiting.
+       Returns early when a nudge makes a repository due.'''
+    while True:
+        remaining = until - time.time()
+        if remaining <= 0:
+            return
+        if GIT_POLLER_NUDGE_INTERVAL <= 0:
+            time.sleep(remaining)
+            return
+        time.sleep(min(remaining, GIT_POLLER_NUDGE_INTERVAL))
+        try:
+            urls = _get_nudges()
+        except Exception:
+            log.exception('Unable to get poll nudges from JobServ')
+            continue
+        now = time.time()
+        nudged = False
+        for url in urls:
+            if scheduler.nudge(url, now):
+                log.info('Nudged to poll %s', url)
+                nudged = True
+            else:
+                log.info('Ignoring nudge for unknown repository %s', url)
+        if nudged:
+            return
 
 
 def run():
-    last_run = time.time() - 15  # Wait a few seconds before polling jobserv
     entries = {}
+    refs_cache = None
+    scheduler = PollScheduler()
+    _lease.start(GIT_POLLER_INTERVAL)
+    # Wait a few seconds before polling jobserv
+    next_refresh = time.time() + 15
     while True:
-        sleep = GIT_POLLER_INTERVAL - (time.time() - last_run)
-        if sleep > 0:
-            log.debug('Waiting %d before running again', sleep)
-            time.sleep(sleep)
-        last_run = time.time()
+        # sleep until a repository is due or it's time to re-read triggers
+        wake = scheduler.next_due()
+        if wake is None or wake > next_refresh:
+            wake = next_refresh
+        log.debug('Waiting %d before running again', wake - time.time())
+        _wait(scheduler, wake)
+        start = time.time()
+        refresh = start >= next_refresh
+        if refresh:
+            next_refresh = start + GIT_POLLER_INTERVAL
         try:
-            _poll(entries)
+            if refs_cache is None:
+                # kept in memory between polls, only changes get written
+                refs_cache = Storage().git_poller_cache()
+            _poll(entries, refs_cache, scheduler, refresh)
             with open('/tmp/git-poller.timestamp', 'w') as f:
                 f.write('%d' % time.time())
+            if refresh:
+                duration = time.time() - start
+                if duration > GIT_POLLER_INTERVAL:
+                    log.warning('Poll took %ds, longer than the %ds interval',
+                                duration, GIT_POLLER_INTERVAL)
+                with StatsClient() as c:
+                    c.git_poller_cycle(duration, GIT_POLLER_INTERVAL)
         except Exception:
             log.exception('Error getting cache, retrying in a bit')
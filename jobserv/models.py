@@ -12,6 +12,7 @@ import os
 import random
 import string
 import time
+from collections import Counter
 from typing import Dict
 
 import bcrypt
@@ -24,8 +25,12 @@ from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.hybrid import Comparator, hybrid_property
 
 from jobserv.settings import (
-    BUILD_URL_FMT, JOBS_DIR, RUN_URL_FMT, SECRETS_FERNET_KEY, WORKER_DIR)
+    BUILD_URL_FMT, GIT_POLLER_LEASE, JOBS_DIR, QUEUE_FAIR_SHARE, QUEUE_POLICY,
+    QUEUE_SJF_AGING, RUN_URL_FMT, SECRETS_FERNET_KEY, SURGE_CACHE_SECONDS,
+    WORKER_DIR, WORKER_MAX_LOAD, WORKER_MIN_DISK_FREE, WORKER_MIN_MEM_FREE,
+    WORKER_ROTATE_PINGS_LOG)
 from jobserv.stats import StatsClient
+from jobserv.worker_metrics import PingMetrics
 
 db = SQLAlchemy()
 
@@ -77,6 +82,17 @@ class Project(db.Model):
 
     synchronous_builds = db.Column(db.Boolean, default=False)
 
+    # Retention policy, see jobserv.retention. Promoted builds are always
+    # kept. A null value means no limit.
+    retention_builds = db.Column(db.Integer)
+    retention_days = db.Column(db.Integer)
+
+    # Scheduling. With QUEUE_FAIR_SHARE, the project's share of the active
+    # runs is proportional to its weight, 1 if null. A null max_concurrency
+    # means no limit on the project's active runs.
+    share_weight = db.Column(db.Integer)
+    max_concurrency = db.Column(db.Integer)
+
     builds = db.relationship('Build', order_by='-Build.id')
     triggers = db.relationship('ProjectTrigger')
 
@@ -91,6 +107,16 @@ class Project(db.Model):
             'url': url_for(
                 'api_project.project_get', proj=self.name, _external=True),
         }
+        if self.retention_builds or self.retention_days:
+            data['retention'] = {
+                'builds': self.retention_builds,
+                'days': self.retention_days,
+            }
+        if self.share_weight or self.max_concurrency:
+            data['scheduling'] = {
+                'share-weight': self.share_weight or 1,
+                'max-concurrency': self.max_concurrency,
+            }
         if detailed:
             data['builds_url'] = url_for(
                 'api_build.build_list', proj=self.name, _external=True)
@@ -181,6 +207,46 @@ class ProjectTrigger(db.Model):
             self.project.name, TriggerTypes(self.type).name)
 
 
+class PollerInstance(db.Model):
+    '''A running git poller. The git_poller triggers are split between the
+       instances whose heartbeat is within GIT_POLLER_LEASE seconds.'''
+    __tablename__ = 'git_pollers'
+    name = db.Column(db.String(128), primary_key=True)
+    heartbeat = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, name, heartbeat):
+        self.name = name
+        self.heartbeat = heartbeat
+
+    @classmethod
+    def live(clazz, now=None):
+        now = now or datetime.datetime.utcnow()
+        expires = now - datetime.timedelta(seconds=GIT_POLLER_LEASE)
+        return clazz.query.filter(
+            clazz.heartbeat >= expires).order_by(clazz.name)
+
+    def __repr__(self):
+        return '<PollerInstance %s>' % self.name
+
+
+class PollNudge(db.Model):
+    '''A request for the git poller to check a repository now rather than
+       waiting for its next scheduled poll. Each poller instance gets its
+       own copy since only the instance watching the repository knows it.
+    '''
+    __tablename__ = 'poll_nudges'
+    url = db.Column(db.String(512), primary_key=True)
+    poller = db.Column(db.String(128), primary_key=True, default='')
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    def __init__(self, url, poller=''):
+        self.url = url
+        self.poller = poller
+
+    def __repr__(self):
+        return '<PollNudge %s>' % self.url
+
+
 class BuildStatus(enum.Enum):
     QUEUED = 1
     RUNNING = 2
@@ -374,9 +440,14 @@ class Run(db.Model, StatusMixin):
 
     worker_name = db.Column(db.String(512), db.ForeignKey('workers.name'))
     queue_priority = db.Column(db.Integer)  # bigger is more important
+    queued_at = db.Column(db.DateTime)
 
     host_tag = db.Column(db.String(1024))
 
+    # the resources the run reserves on its worker
+    cpus = db.Column(db.Float)
+    memory = db.Column(db.Integer)  # in megabytes
+
     build = db.relationship(Build)
     status_events = db.relationship('RunEvents', order_by='RunEvents.id',
                                     cascade='save-update, merge, delete')
@@ -396,6 +467,7 @@ class Run(db.Model, StatusMixin):
         self.trigger = trigger
         self.status = BuildStatus.QUEUED
         self.queue_priority = queue_priority
+        self.queued_at = datetime.datetime.utcnow()
         self.api_key = ''.join(random.SystemRandom().choice(
             string.ascii_lowercase + string.ascii_uppercase + string.digits)
             for _ in range(32))
@@ -438,9 +510,13 @@ class Run(db.Model, StatusMixin):
             status = BuildStatus[status]
         if self.status != status:
             self.status = status
+            if status == BuildStatus.QUEUED:
+                self.queued_at = datetime.datetime.utcnow()
             db.session.flush()
             self.build.refresh_status()
             db.session.add(RunEvents(self, status))
+            if self.complete:
+                RunDuration.record(self)
 
     def __repr__(self):
         return '<Run %s: %s>' % (
@@ -466,12 +542,15 @@ class Run(db.Model, StatusMixin):
         cursor.execute('''
             SELECT
               runs.id, runs.build_id, runs._status,
-              projects.id, projects.synchronous_builds, runs.host_tag
+              projects.id, projects.synchronous_builds, runs.host_tag,
+              runs.cpus, runs.memory,
+              runs.name, runs.queue_priority, runs.queued_at,
+              projects.share_weight, projects.max_concurrency
             FROM runs
             JOIN builds on builds.id = runs.build_id
             JOIN projects on projects.id = builds.proj_id
             WHERE
-                runs._status in (1, 2)
+                runs._status in (1, 2, 6, 9)
               ORDER BY
                 runs._status DESC, runs.queue_priority DESC,
                 runs.build_id ASC, runs.id ASC
@@ -484,8 +563,17 @@ class Run(db.Model, StatusMixin):
         # to schedule
         sync_projects = {}
         okay_sync_builds = {}
+        used = worker.resources_used()
+        candidates = []
+        # The active (RUNNING, UPLOADING, CANCELLING) runs of each project
+        active = Counter()
+        weights = {}
         rows = cursor.fetchall()
-        for (run_id, build_id, status, proj_id, sync, tag) in rows:
+        for (run_id, build_id, status, proj_id, sync, tag, cpus, mem,
+             name, priority, queued_at, weight, max_concurrency) in rows:
+            weights[proj_id] = weight
+            if status != 1:
+                active[proj_id] += 1
             if status == 2 and sync:
                 sync_projects[proj_id] = True
                 okay_sync_builds[build_id] = True
@@ -495,13 +583,28 @@ class Run(db.Model, StatusMixin):
                         break
                 else:
                     continue
+                if not worker.fits(used, cpus, mem):
+                    # leave it for a worker with more room and see if a
+                    # smaller run can use what's left of this one
+                    continue
+                if max_concurrency and active[proj_id] >= max_concurrency:
+                    continue
                 if not sync or \
                         build_id in okay_sync_builds or \
                         proj_id not in sync_projects:
-                    break
-        else:
+                    candidates.append(
+                        (run_id, proj_id, name, tag, priority, queued_at))
+                    if QUEUE_POLICY != 'sjf' and not QUEUE_FAIR_SHARE:
+                        break  # the first suitable run is the one
+        if not candidates:
             # No run found to schedule
             return
+        if QUEUE_FAIR_SHARE:
+            candidates = fair_share(candidates, active, weights)
+        if QUEUE_POLICY == 'sjf':
+            run_id = shortest_job_first(candidates)
+        else:
+            run_id = candidates[0][0]
 
         # We have a suitable run, try and schedule it. This check helps
         # fight the race condition where two threads might schedule the same
@@ -526,6 +629,129 @@ class Run(db.Model, StatusMixin):
             return r
 
 
+class RunDuration(db.Model):
+    '''How long runs with a given project, name and host tag are predicted
+       to take. The prediction is a moving average of how long they took
+       from RUNNING to completion.'''
+    __tablename__ = 'run_durations'
+    id = db.Column(db.Integer, primary_key=True)
+    proj_id = db.Column(db.Integer, db.ForeignKey(Project.id), nullable=False)
+    run_name = db.Column(db.String(80), nullable=False)
+    host_tag = db.Column(db.String(1024))
+    seconds = db.Column(db.Float, nullable=False)
+    samples = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        # host_tag is too long for a complete MySQL index key
+        db.Index('run_durations_uc', 'proj_id', 'run_name', 'host_tag',
+                 unique=True, mysql_length={'host_tag': 255}),
+    )
+
+    # the weight of the latest duration in the moving average
+    ALPHA = 0.3
+
+    def __init__(self, proj_id, run_name, host_tag, seconds):
+        self.proj_id = proj_id
+        self.run_name = run_name
+        self.host_tag = host_tag
+        self.seconds = seconds
+        self.samples = 1
+
+    @classmethod
+    def record(clazz, run):
+        '''Update the prediction with how long the completed run took. Only
+           runs that passed count, failures often stop early.'''
+        if run.status != BuildStatus.PASSED:
+            return
+        for x in reversed(run.status_events):
+            if x.status == BuildStatus.CANCELLING:
+                return  # it didn't run to completion
+            if x.status == BuildStatus.RUNNING:
+                started = x.time
+                break
+        else:
+            return  # it never ran
+        seconds = (datetime.datetime.utcnow() - started).total_seconds()
+
+        # The average is updated in a single statement, so concurrent
+        # completions of the same run can't lose each other's update.
+        q = clazz.query.filter_by(
+            proj_id=run.build.proj_id, run_name=run.name,
+            host_tag=run.host_tag)
+        values = {
+            clazz.seconds: clazz.seconds + clazz.ALPHA * (
+                seconds - clazz.seconds),
+            clazz.samples: clazz.samples + 1,
+        }
+        if q.update(values, synchronize_session=False):
+            return
+        try:
+            with db.session.begin_nested():
+                db.session.add(clazz(
+                    run.build.proj_id, run.name, run.host_tag, seconds))
+        except IntegrityError:
+            # another run with this name completed at the same time
+            q.update(values, synchronize_session=False)
+
+    @classmethod
+    def predict(clazz, keys):
+        '''Return a dict of the predictions for the given keys, which are
+           (proj_id, run_name, host_tag) tuples. Keys without history are
+           left out.'''
+        if not keys:
+            return {}
+        q = db.session.query(
+            clazz.proj_id, clazz.run_name, clazz.host_tag, clazz.seconds
+        ).filter(
+            clazz.proj_id.in_(set(x[0] for x in keys)),
+            clazz.run_name.in_(set(x[1] for x in keys)),
+        )
+        keys = set(keys)
+        return {x[:3]: x[3] for x in q if x[:3] in keys}
+
+
+def fair_share(candidates, active, weights):
+    '''Return the candidates, as passed to shortest_job_first, of the
+       project furthest below its share: the one with the fewest active
+       runs per unit of share_weight. Queue priority comes first and ties
+       go to the project with the oldest candidate.'''
+    top = max(x[4] or 0 for x in candidates)
+    candidates = [x for x in candidates if (x[4] or 0) == top]
+
+    def usage(candidate):
+        proj_id = candidate[1]
+        return active.get(proj_id, 0) / (weights.get(proj_id) or 1)
+
+    proj_id = min(candidates, key=usage)[1]
+    return [x for x in candidates if x[1] == proj_id]
+
+
+def shortest_job_first(candidates, now=None):
+    '''Pick the run to schedule from the (run_id, proj_id, name, host_tag,
+       queue_priority, queued_at) candidates. Queue priority comes first.
+       Among the runs with the top priority, the one with the shortest
+       predicted duration wins. To keep long runs from starving, each
+       second a run waits takes QUEUE_SJF_AGING seconds off its prediction.
+       Runs without a prediction are assumed to take the average time.'''
+    top = max(x[4] or 0 for x in candidates)
+    candidates = [x for x in candidates if (x[4] or 0) == top]
+    if len(candidates) == 1:
+        return candidates[0][0]
+
+    predictions = RunDuration.predict([x[1:4] for x in candidates])
+    known = [predictions[x[1:4]] for x in candidates
+             if x[1:4] in predictions]
+    average = sum(known) / len(known) if known else 0
+    now = now or datetime.datetime.utcnow()
+
+    def score(candidate):
+        predicted = predictions.get(candidate[1:4], average)
+        waited = (now - (candidate[5] or now)).total_seconds()
+        return predicted - QUEUE_SJF_AGING * waited
+
+    return min(candidates, key=score)[0]
+
+
 class RunEvents(db.Model, StatusMixin):
     __tablename__ = 'run_events'
 
@@ -636,6 +862,42 @@ class TestResult(db.Model, StatusMixin):
             self.name, self.status.name)
 
 
+class Surge(db.Model):
+    '''A host tag with more queued runs than its regular workers can keep up
+       with, so surges_only workers with the tag should take runs too. The
+       worker monitor is the only writer. Every check-in of a surge worker
+       reads them, so they are cached for SURGE_CACHE_SECONDS.'''
+    __tablename__ = 'surges'
+    id = db.Column(db.Integer, primary_key=True)
+    tag = db.Column(db.String(1024), nullable=False)
+    started = db.Column(
+        db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    # the id of the "surge started" email so the "ended" one can reply to it
+    msg_id = db.Column(db.String(1024))
+
+    _cache = None  # (expires, tags)
+
+    def __init__(self, tag, msg_id):
+        self.tag = tag
+        self.msg_id = msg_id
+
+    @classmethod
+    def active_tags(clazz):
+        now = time.time()
+        cache = clazz._cache
+        if cache is None or cache[0] < now:
+            tags = tuple(x for x, in db.session.query(clazz.tag))
+            cache = clazz._cache = (now + SURGE_CACHE_SECONDS, tags)
+        return cache[1]
+
+    @classmethod
+    def invalidate_cache(clazz):
+        clazz._cache = None
+
+    def __repr__(self):
+        return '<Surge %s>' % self.tag
+
+
 class Worker(db.Model):
     __tablename__ = 'workers'
 
@@ -650,6 +912,10 @@ class Worker(db.Model):
     host_tags = db.Column(db.String(1024))
     online = db.Column(db.Boolean)
     surges_only = db.Column(db.Boolean, default=False)
+    # the time of the worker's last check-in
+    last_seen = db.Column(db.DateTime, index=True)
+    # why the worker's last check-in was over an admission threshold
+    unhealthy = db.Column(db.String(1024))
 
     # we can't delete workers because the Run has foreign keys to them. This
     # flag allows us to exclude them from the api
@@ -693,21 +959,46 @@ class Worker(db.Model):
             'host_tags': [x for x in self.host_tags.split(',')],
             'online': self.online,
             'surges_only': self.surges_only,
+            'unhealthy': self.unhealthy,
         }
 
     def in_queue_surge(self):
         '''We have some workers that we only want to use when the backlog
         gets big.'''
-        for tag in self.host_tags.split(','):
-            surge = os.path.join(WORKER_DIR, 'enable_surge-' + tag.strip())
-            if os.path.exists(surge):
+        tags = [self.name] + [x.strip() for x in self.host_tags.split(',')]
+        # surges are named after the runs' host tags which can be wildcards
+        for surge in Surge.active_tags():
+            if any(fnmatch.fnmatch(t, surge) for t in tags):
                 return True
         return False
 
+    def resources_used(self):
+        '''Return the cpus and megabytes of memory reserved by the runs
+           active on this worker.'''
+        active = (BuildStatus.RUNNING, BuildStatus.UPLOADING,
+                  BuildStatus.CANCELLING)
+        cpus, memory = db.session.query(
+            db.func.sum(Run.cpus), db.func.sum(Run.memory)
+        ).filter(
+            Run.worker_name == self.name,
+            Run._status.in_([x.value for x in active]),
+        ).one()
+        return cpus or 0, memory or 0
+
+    def fits(self, used, cpus, memory):
+        '''Return True if a run needing the given cpus and megabytes of
+           memory fits in what's left of the worker after "used". Runs
+           without a request only take one of the worker's run slots.'''
+        if cpus and used[0] + cpus > self.cpu_total:
+            return False
+        if memory and (used[1] + memory) * 1024 * 1024 > self.mem_total:
+            return False
+        return True
+
     @property
     def available(self):
         '''Returns True if the worker should be able to accept runs.'''
-        if self.enlisted and not self.deleted:
+        if self.enlisted and not self.deleted and not self.unhealthy:
             if not self.surges_only or self.in_queue_surge():
                 return True
         return False
@@ -723,19 +1014,72 @@ class Worker(db.Model):
     def pings_log(self):
         return os.path.join(WORKER_DIR, self.name, 'pings.log')
 
+    @property
+    def metrics(self):
+        return PingMetrics(os.path.join(WORKER_DIR, self.name, 'metrics.bin'))
+
+    def _log_ping(self, now, vals):
+        path = self.pings_log
+        try:
+            f = open(path, 'a')
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = open(path, 'a')
+        with f:
+            f.write('%d: %s\n' % (now, vals))
+            size = f.tell()
+        # based on rough calculations a 1M file is about 9000 entries which is
+        # about 2 days worth of information
+        if size > 1024 * 1024:
+            rotated = path + '.%d' % now
+            logging.info('rotating pings log to: %s', rotated)
+            os.rename(path, rotated)
+
+    def _health_problems(self, metrics):
+        problems = []
+
+        def _check(name, limit, too_low):
+            try:
+                val = float(metrics[name])
+            except (KeyError, TypeError, ValueError):
+                return  # older workers don't report everything
+            if too_low and val < limit:
+                problems.append('%s=%d < %d' % (name, val, limit))
+            elif not too_low and val > limit:
+                problems.append('%s=%.2f > %.2f' % (name, val, limit))
+
+        if WORKER_MIN_MEM_FREE:
+            _check('mem_free', WORKER_MIN_MEM_FREE, True)
+        if WORKER_MIN_DISK_FREE:
+            _check('disk_free', WORKER_MIN_DISK_FREE, True)
+        if WORKER_MAX_LOAD:
+            # the load average is relative to the worker's number of CPUs
+            _check('load_avg_5', WORKER_MAX_LOAD * self.cpu_total, False)
+        return ', '.join(problems) or None
+
     def ping(self, **kwargs):
-        if not self.online:
-            self.online = True
-            db.session.commit()
+        came_online = not self.online
+        self.online = True
+        self.last_seen = datetime.datetime.utcnow()
+        unhealthy = self._health_problems(kwargs)
+        if unhealthy != self.unhealthy:
+            if unhealthy:
+                logging.warning(
+                    'Worker %s is unhealthy: %s', self.name, unhealthy)
+            else:
+                logging.info('Worker %s is healthy again', self.name)
+            self.unhealthy = unhealthy
+        db.session.commit()
+        if came_online:
             with StatsClient() as c:
                 c.worker_online(self)
-        path = self.pings_log
-        if not os.path.exists(path):
-            os.makedirs(os.path.dirname(path))
+
         now = time.time()
-        vals = ','.join(['%s=%s' % (k, v) for k, v in kwargs.items()])
-        with open(path, 'a') as f:
-            f.write('%d: %s\n' % (now, vals))
+        self.metrics.add(now, kwargs)
+        if WORKER_ROTATE_PINGS_LOG:
+            vals = ','.join(['%s=%s' % (k, v) for k, v in kwargs.items()])
+            self._log_ping(now, vals)
+
         try:
             # this is a no-op if unconfigured
             with StatsClient() as c:
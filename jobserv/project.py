@@ -13,7 +13,7 @@ from pykwalify.errors import SchemaError
 
 from jobserv.models import TriggerTypes
 from jobserv.jsend import ApiError
-from jobserv.settings import RUN_URL_FMT
+from jobserv.settings import ARTIFACT_DEDUP, RUN_URL_FMT
 
 
 class ProjectDefinition(object):
@@ -120,9 +120,12 @@ class ProjectDefinition(object):
             'shared-volumes': run.get('shared-volumes'),
             'host-tag': run.get('host-tag'),
             'console-progress': run.get('console-progress'),
+            'resources': run.get('resources'),
         }
 
         rundef['host-tag'] = run['host-tag'].lower()
+        if ARTIFACT_DEDUP:
+            rundef['artifact-dedup'] = True
         if 'script' in run:
             rundef['script'] = self.scripts[run['script']]
         else:
@@ -161,6 +164,9 @@ class ProjectDefinition(object):
         rundef['env']['H_BUILD'] = str(dbrun.build.build_id)
         rundef['env']['H_RUN'] = dbrun.name
         dbrun.host_tag = rundef['host-tag']
+        resources = rundef['resources'] or {}
+        dbrun.cpus = resources.get('cpus')
+        dbrun.memory = resources.get('memory')
         return json.dumps(rundef, indent=2)
 
     @classmethod
@@ -0,0 +1,194 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import datetime
+import logging
+import threading
+import time
+
+from dataclasses import dataclass
+from multiprocessing.pool import ThreadPool
+
+from jobserv.models import (
+    Build, BuildEvents, BuildStatus, Project, Run, RunEvents, Test,
+    TestResult, db)
+from jobserv.settings import RETENTION_DELETE_RATE, RETENTION_DELETE_THREADS
+from jobserv.storage import Storage
+
+# Rows are deleted by primary key in statements of this size so that no
+# single transaction locks a large part of a table.
+DELETE_CHUNK_SIZE = 500
+# Builds are purged in batches of this size, so an interrupted purge has
+# made progress and the next pass picks up the rest.
+BUILD_BATCH_SIZE = 20
+
+# Only completed builds are eligible. PROMOTED builds are kept forever.
+EXPIRABLE = (BuildStatus.PASSED, BuildStatus.FAILED, BuildStatus.SKIPPED)
+
+log = logging.getLogger('jobserv.flask')
+
+
+@dataclass
+class RetentionReport:
+    builds: int = 0
+    runs: int = 0
+    tests: int = 0
+    test_results: int = 0
+    artifacts: int = 0
+    artifact_bytes: int = 0
+
+    def add(self, other):
+        for k in self.__dataclass_fields__:
+            setattr(self, k, getattr(self, k) + getattr(other, k))
+
+    def __str__(self):
+        return '%d builds, %d runs, %d tests, %d test results, ' \
+               '%d artifacts (%.1f MB)' % (
+                   self.builds, self.runs, self.tests, self.test_results,
+                   self.artifacts, self.artifact_bytes / 1024 / 1024)
+
+
+class _RateLimiter(object):
+    '''Space out calls to wait() from any number of threads so they happen
+       at most "rate" times a second.'''
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _chunks(items, size=DELETE_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _child_ids(pk, fk, parent_ids):
+    ids = []
+    for chunk in _chunks(parent_ids):
+        ids.extend(x for x, in db.session.query(pk).filter(fk.in_(chunk)))
+    return ids
+
+
+def _delete_rows(pk, ids):
+    table = pk.class_.__table__
+    for chunk in _chunks(ids):
+        db.session.execute(table.delete().where(pk.in_(chunk)))
+        db.session.commit()
+
+
+def _delete_objects(storage, paths):
+    limiter = _RateLimiter(RETENTION_DELETE_RATE)
+
+    def _delete(path):
+        limiter.wait()
+        try:
+            storage._delete(path)
+        except FileNotFoundError:
+            pass
+
+    with ThreadPool(RETENTION_DELETE_THREADS) as p:
+        p.map(_delete, paths)
+
+
+def expired_builds(project, now=None):
+    '''Return the builds the project's retention policy no longer keeps.
+       These are the builds older than retention_days and the builds beyond
+       the newest retention_builds.'''
+    expired = []
+    if project.retention_builds:
+        oldest_kept = db.session.query(Build.id).filter(
+            Build.proj_id == project.id
+        ).order_by(
+            Build.id.desc()
+        ).offset(project.retention_builds - 1).limit(1).scalar()
+        if oldest_kept:
+            expired.append(Build.id < oldest_kept)
+    if project.retention_days:
+        now = now or datetime.datetime.utcnow()
+        cutoff = now - datetime.timedelta(days=project.retention_days)
+        old = db.session.query(BuildEvents.build_id).group_by(
+            BuildEvents.build_id
+        ).having(
+            db.func.min(BuildEvents.time) < cutoff
+        )
+        expired.append(Build.id.in_(old))
+    if not expired:
+        return []
+    return Build.query.filter(
+        Build.proj_id == project.id,
+        Build.status.in_(EXPIRABLE),
+        db.or_(*expired),
+    ).order_by(Build.id).all()
+
+
+def delete_builds(builds, dry_run=False, storage=None):
+    '''Delete the builds' artifacts and database rows. Returns a report of
+       what was, or with dry_run would be, reclaimed.'''
+    storage = storage or Storage()
+    report = RetentionReport(builds=len(builds))
+    prefixes = [storage.get_build_prefix(b) for b in builds]
+    objects = []
+    for prefix in prefixes:
+        for path, size in storage._list_tree(prefix):
+            objects.append(path)
+            report.artifact_bytes += size
+    report.artifacts = len(objects)
+
+    build_ids = [x.id for x in builds]
+    run_ids = _child_ids(Run.id, Run.build_id, build_ids)
+    test_ids = _child_ids(Test.id, Test.run_id, run_ids)
+    result_ids = _child_ids(TestResult.id, TestResult.test_id, test_ids)
+    report.runs = len(run_ids)
+    report.tests = len(test_ids)
+    report.test_results = len(result_ids)
+    if dry_run:
+        return report
+
+    # Storage goes first. If we're interrupted, the builds are still in the
+    # database and the next pass will find them again.
+    log.info('Deleting %d artifacts of %d builds', len(objects), len(builds))
+    _delete_objects(storage, objects)
+    for prefix in prefixes:
+        storage._prune(prefix)
+
+    _delete_rows(TestResult.id, result_ids)
+    _delete_rows(Test.id, test_ids)
+    _delete_rows(
+        RunEvents.id, _child_ids(RunEvents.id, RunEvents.run_id, run_ids))
+    _delete_rows(Run.id, run_ids)
+    _delete_rows(
+        BuildEvents.id,
+        _child_ids(BuildEvents.id, BuildEvents.build_id, build_ids))
+    _delete_rows(Build.id, build_ids)
+    return report
+
+
+def purge_builds(builds, dry_run=False):
+    '''Delete builds in batches. Returns the total RetentionReport.'''
+    storage = Storage()
+    total = RetentionReport()
+    for i in range(0, len(builds), BUILD_BATCH_SIZE):
+        batch = builds[i:i + BUILD_BATCH_SIZE]
+        total.add(delete_builds(batch, dry_run, storage))
+    return total
+
+
+def apply_retention(dry_run=False, project_names=None):
+    '''Apply each project's retention policy. Yields a (project, report)
+       for each project with a policy.'''
+    q = Project.query.filter(db.or_(
+        Project.retention_builds.isnot(None),
+        Project.retention_days.isnot(None),
+    )).order_by(Project.name)
+    if project_names:
+        q = q.filter(Project.name.in_(project_names))
+    for p in q.all():
+        yield p, purge_builds(expired_builds(p), dry_run)
@@ -3,6 +3,7 @@
 
 import os
 import hashlib
+import socket
 
 DEBUG = 1
 
@@ -26,15 +27,55 @@ JOBS_DIR = os.environ.get('JOBS_DIR', '/data/ci_jobs')
 WORKER_DIR = os.environ.get('WORKER_DIR', '/data/workers')
 
 LOCAL_ARTIFACTS_DIR = os.environ.get('LOCAL_ARTIFACTS_DIR', '/data/artifacts')
+# Partial uploads to local storage untouched for this many days are
+# considered abandoned and purged along with unreferenced blobs.
+LOCAL_UPLOAD_MAX_AGE = int(os.environ.get('LOCAL_UPLOAD_MAX_AGE', '2'))
 GCE_BUCKET = os.environ.get('GCE_BUCKET')
+# GCS can't share an object's storage between runs, so its content-addressed
+# blobs are a cache of uploads that expires when not linked for this long.
+GCE_BLOB_MAX_AGE = int(os.environ.get('GCE_BLOB_MAX_AGE', '7'))
+# The first link of a GCS blob hashes it while the runner waits on the
+# request. Bigger artifacts are uploaded normally rather than as blobs.
+GCE_BLOB_VERIFY_MAX_BYTES = int(
+    os.environ.get('GCE_BLOB_VERIFY_MAX_BYTES', str(64 * 1024 * 1024)))
+# Have runners send a sha256 of each artifact so content already in storage
+# is referenced rather than uploaded again.
+ARTIFACT_DEDUP = os.environ.get('ARTIFACT_DEDUP', '0') != '0'
 STORAGE_BACKEND = os.environ.get(
     'STORAGE_BACKEND', 'jobserv.storage.gce_storage')
 
+# Limit how hard the retention engine hits storage when purging artifacts.
+# The rate is in deletes per second across all threads.
+RETENTION_DELETE_RATE = int(os.environ.get('RETENTION_DELETE_RATE', '50'))
+RETENTION_DELETE_THREADS = int(os.environ.get('RETENTION_DELETE_THREADS', '8'))
+
 # The SURGE_SUPPORT_RATIO is defined as the number of Runs in QUEUED for a
 # given host_tag divided by the number of online and enlisted non-surge
 # workers that can service that host_tag. If this ratio is exceeded, the
 # JobServ will enter surge support mode and use surge workers for QUEUED run.
 SURGE_SUPPORT_RATIO = int(os.environ.get('SURGE_SUPPORT_RATIO', '3'))
+# How long, in seconds, the API caches the list of surges. Surge workers
+# check in every 90s, so a short delay in seeing a surge doesn't matter.
+SURGE_CACHE_SECONDS = int(os.environ.get('SURGE_CACHE_SECONDS', '15'))
+
+# How a worker's next run is picked from the queued runs it can take:
+#  fifo - the oldest build with the highest queue priority
+#  sjf - the run with the highest queue priority and the shortest predicted
+#        duration. Each second a run waits counts as QUEUE_SJF_AGING seconds
+#        less duration, so long runs don't starve.
+QUEUE_POLICY = os.environ.get('QUEUE_POLICY', 'fifo')
+QUEUE_SJF_AGING = float(os.environ.get('QUEUE_SJF_AGING', '1'))
+# Enable to share workers between projects in proportion to the projects'
+# share_weight rather than letting the oldest builds take every worker. The
+# next run comes from the project with the fewest active runs per weight.
+QUEUE_FAIR_SHARE = os.environ.get('QUEUE_FAIR_SHARE', '0') != '0'
+
+# A worker gets no new runs while its last check-in reports less free memory
+# or disk, in bytes, or a higher 5 minute load average per CPU than these.
+# 0 disables a check.
+WORKER_MIN_MEM_FREE = int(os.environ.get('WORKER_MIN_MEM_FREE', '0'))
+WORKER_MIN_DISK_FREE = int(os.environ.get('WORKER_MIN_DISK_FREE', '0'))
+WORKER_MAX_LOAD = float(os.environ.get('WORKER_MAX_LOAD', '0'))
 
 # Allow this to be deployed in a way that builds and runs can provide links
 # to a custom web frontend
@@ -58,8 +99,36 @@ NOTIFICATION_EMAILS = os.environ.get('NOTIFICATION_EMAILS')
 LAVA_URLBASE = os.environ.get(
     'LAVA_URLBASE', 'https://lava.foundries.io')
 
-# every 90 seconds
+# Triggers and project definitions are re-read every 90 seconds. Each
+# repository is polled on its own schedule that starts at this interval and
+# then adapts to how often the repository changes.
 GIT_POLLER_INTERVAL = int(os.environ.get('GIT_POLLER_INTERVAL', '90'))
+GIT_POLLER_MIN_INTERVAL = int(os.environ.get('GIT_POLLER_MIN_INTERVAL', '30'))
+GIT_POLLER_MAX_INTERVAL = int(
+    os.environ.get('GIT_POLLER_MAX_INTERVAL', '900'))
+# repositories that can't be read are retried with exponential backoff
+GIT_POLLER_MAX_BACKOFF = int(os.environ.get('GIT_POLLER_MAX_BACKOFF', '3600'))
+# Several pollers can share the git_poller triggers. Each one sends a
+# heartbeat every GIT_POLLER_INTERVAL and the triggers are rebalanced when an
+# instance hasn't been heard from for GIT_POLLER_LEASE seconds.
+GIT_POLLER_NAME = os.environ.get('GIT_POLLER_NAME', socket.gethostname())
+GIT_POLLER_LEASE = int(
+    os.environ.get('GIT_POLLER_LEASE', str(GIT_POLLER_INTERVAL * 3)))
+# How often the poller asks jobserv for repositories that have been nudged
+# by a post-receive hook. 0 disables nudges.
+GIT_POLLER_NUDGE_INTERVAL = int(
+    os.environ.get('GIT_POLLER_NUDGE_INTERVAL', '5'))
+# The poller checks this many triggers at once, but makes no more than
+# GIT_POLLER_HOST_CONCURRENCY requests at a time to any one host. Hosts can
+# be given their own limit with: GIT_POLLER_HOST_LIMITS="github.com=8,foo=2"
+GIT_POLLER_WORKERS = int(os.environ.get('GIT_POLLER_WORKERS', '16'))
+GIT_POLLER_HOST_CONCURRENCY = int(
+    os.environ.get('GIT_POLLER_HOST_CONCURRENCY', '4'))
+GIT_POLLER_HOST_LIMITS = {}
+for _limit in os.environ.get('GIT_POLLER_HOST_LIMITS', '').split(','):
+    if _limit.strip():
+        _host, _val = _limit.split('=')
+        GIT_POLLER_HOST_LIMITS[_host.strip()] = int(_val)
 GITLAB_SERVERS = [
     x.strip() for x in
     os.environ.get('GITLAB_SERVERS', 'https://gitlab.com').split(',')
@@ -81,8 +150,8 @@ CARBON_PREFIX = os.environ.get('CARBON_PREFIX', 'jobserv')
 if CARBON_PREFIX and CARBON_PREFIX[-1] != '.':
     CARBON_PREFIX += '.'
 
-# Enable to let the worker monitor rotate the pings log and keep a long term
-# record of all worker pings.
+# Recent worker metrics are kept in a fixed size buffer. Enable to also keep
+# a long term record of all worker pings in rotated text logs.
 WORKER_ROTATE_PINGS_LOG = os.environ.get('ROTATE_PINGS_LOG', '0') != '0'
 
 RUNNER = os.path.join(os.path.dirname(__file__),
@@ -69,3 +69,14 @@ class CarbonClient(object):
     def surge_ended(self, tag):
         '''Track when a surge has ended for a given host-tag'''
         self.send('workers.surge.%s' % tag, 0)
+
+    def git_poller_cycle(self, duration, interval):
+        '''Track how long a git poller cycle took and how much of the poll
+           interval it used. A utilization over 1 means changes are being
+           detected late.'''
+        self.send('git_poller.cycle_seconds', duration)
+        self.send('git_poller.cycle_utilization', duration / interval)
+
+    def worker_monitor_check(self, check, duration):
+        '''Track how long one of the worker monitor's checks took'''
+        self.send('worker_monitor.%s_seconds' % check, duration)
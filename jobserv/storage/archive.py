@@ -0,0 +1,101 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import tarfile
+import time
+import zipfile
+import zlib
+
+FORMATS = {
+    'tar': 'application/x-tar',
+    'tar.gz': 'application/gzip',
+    'zip': 'application/zip',
+}
+
+
+def _sized(chunks, size):
+    '''Yield exactly "size" bytes from chunks. An archive member's header has
+       already promised this size, so an object that changed underneath us
+       is truncated or zero padded rather than corrupting the archive.'''
+    remaining = size
+    for chunk in chunks:
+        if len(chunk) > remaining:
+            chunk = chunk[:remaining]
+        remaining -= len(chunk)
+        yield chunk
+        if not remaining:
+            break
+    if remaining:
+        yield b'\0' * remaining
+
+
+def tar_stream(entries):
+    '''Generate a tar archive for entries of (name, size, chunks_func) where
+       chunks_func() returns an iterator of the member's content.'''
+    mtime = int(time.time())
+    for name, size, chunks_func in entries:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        info.mode = 0o644
+        yield info.tobuf(tarfile.PAX_FORMAT)
+        yield from _sized(chunks_func(), size)
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+    yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+
+def gzip_stream(chunks):
+    c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = c.compress(chunk)
+        if data:
+            yield data
+    yield c.flush()
+
+
+class _Sink(object):
+    '''A write-only file object zipfile can stream into. Whatever has been
+       written since the last drain() is handed back to the response.'''
+    def __init__(self):
+        self._buffers = []
+
+    def write(self, data):
+        self._buffers.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._buffers)
+        self._buffers = []
+        return data
+
+
+def zip_stream(entries):
+    sink = _Sink()
+    date_time = time.gmtime()[:6]
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, size, chunks_func in entries:
+            info = zipfile.ZipInfo(name, date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            zip64 = size >= zipfile.ZIP64_LIMIT
+            with zf.open(info, 'w', force_zip64=zip64) as dst:
+                for chunk in _sized(chunks_func(), size):
+                    dst.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            yield sink.drain()
+    yield sink.drain()
+
+
+def archive_stream(fmt, entries):
+    if fmt == 'zip':
+        return zip_stream(entries)
+    if fmt == 'tar.gz':
+        return gzip_stream(tar_stream(entries))
+    return tar_stream(entries)
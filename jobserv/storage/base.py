@@ -1,14 +1,17 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 
-import contextlib
 import datetime
+import fnmatch
+import functools
 import json
 import os
 import logging
+import threading
 import mimetypes
 
 from jobserv.settings import JOBS_DIR
+from jobserv.storage.archive import archive_stream
 
 log = logging.getLogger('jobserv.flask')
 
@@ -16,6 +19,11 @@ log = logging.getLogger('jobserv.flask')
 class BaseStorage(object):
     blueprint = None
 
+    # How _generate_resumable_url's URLs accept content in parts:
+    #  "ranges" - parts can be PUT in any order and in parallel
+    #  "session" - parts must be PUT in order (a GCS resumable session)
+    RESUMABLE_PROTOCOL = None
+
     def __init__(self):
         mimetypes.add_type('text/plain', '.log')
 
@@ -34,6 +42,53 @@ class BaseStorage(object):
     def _generate_put_url(self, run, path, expiration, content_type):
         raise NotImplementedError()
 
+    def _generate_blob_put_url(self, run, path, sha256, expiration,
+                               content_type):
+        return self._generate_put_url(run, path, expiration, content_type)
+
+    def _generate_resumable_url(self, run, path, sha256, size, expiration,
+                                content_type):
+        '''Return a URL that can receive size bytes in Content-Range parts,
+           or None if the backend has no resumable protocol.'''
+        return None
+
+    def _accepts_blob(self, size):
+        '''Can an upload of size bytes, or None if the runner didn't say,
+           go through the content-addressed blob store?'''
+        return True
+
+    def _link_blob(self, run, path, sha256):
+        '''Make a run's artifact path reference the content-addressed blob
+           for sha256. Blobs are private to the run's project and only ever
+           linked once the server has verified their content hashes to
+           sha256. Returns False if no such blob is stored.'''
+        return False
+
+    def purge_unreferenced_blobs(self, now=None):
+        '''Delete content-addressed blobs no run references. Returns the
+           number of bytes freed.'''
+        return 0
+
+    def _iter_raw(self, storage_path):
+        '''Return an iterator over the object's content in chunks.'''
+        raise NotImplementedError()
+
+    def _list_artifact_sizes(self, run):
+        '''Return an iterator of (path, size) for the run's artifacts.'''
+        raise NotImplementedError()
+
+    def _list_tree(self, prefix):
+        '''Return an iterator of (storage_path, size) for every object
+           under prefix.'''
+        raise NotImplementedError()
+
+    def _delete(self, storage_path):
+        raise NotImplementedError()
+
+    def _prune(self, prefix):
+        '''Called once everything under prefix has been deleted.'''
+        pass
+
     def list_artifacts(self, run):
         raise NotImplementedError()
 
@@ -49,6 +104,26 @@ class BaseStorage(object):
             return name + path
         return name
 
+    def archive_artifacts(self, runs, fmt, patterns=None, run_dirs=False):
+        '''Return a generator that streams a "tar", "tar.gz" or "zip" of the
+           runs' artifacts. Only matching artifacts are included when glob
+           patterns are given. Content is read from storage as the archive is
+           generated so nothing gets materialized in memory or on disk.'''
+        entries = []
+        for run in runs:
+            for path, size in self._list_artifact_sizes(run):
+                name = run.name + '/' + path if run_dirs else path
+                if patterns and \
+                        not any(fnmatch.fnmatch(name, x) for x in patterns):
+                    continue
+                reader = functools.partial(
+                    self._iter_raw, self._get_run_path(run, path))
+                entries.append((name, size, reader))
+        return archive_stream(fmt, entries)
+
+    def get_build_prefix(self, build):
+        return '%s/%s/' % (build.project.name, build.build_id)
+
     def create_project_definition(self, build, projdef):
         name = '%s/%s/project.yml' % (build.project.name, build.build_id)
         self._create_from_string(name, projdef)
@@ -104,31 +179,128 @@ class BaseStorage(object):
         except:
             pass  # another run is still in progress
 
-    def generate_signed(self, run, paths, expiration):
+    def generate_signed(self, run, paths, expiration, hashes=None,
+                        sizes=None):
         urls = {}
+        hashes = hashes or {}
+        sizes = sizes or {}
         expiration = datetime.timedelta(seconds=expiration)
         for p in paths:
             ct = mimetypes.guess_type(p)[0]
             if not ct:
                 ct = ''
-            url = self._generate_put_url(
-                run, p, expiration=expiration, content_type=ct)
+            sha = hashes.get(p)
+            if sha and not self._accepts_blob(sizes.get(p)):
+                sha = None  # a normal upload, so the runner won't link it
+            if sha and self._link_blob(run, p, sha):
+                # identical content is already stored, nothing to upload
+                urls[p] = {'content-type': ct, 'exists': True}
+                continue
+            url = resumable = None
+            if p in sizes:
+                url = self._generate_resumable_url(
+                    run, p, sha, sizes[p], expiration=expiration,
+                    content_type=ct)
+            if url:
+                resumable = self.RESUMABLE_PROTOCOL
+            elif sha:
+                url = self._generate_blob_put_url(
+                    run, p, sha, expiration=expiration, content_type=ct)
+            else:
+                url = self._generate_put_url(
+                    run, p, expiration=expiration, content_type=ct)
             urls[p] = {
                 'url': url,
                 'content-type': ct,
             }
+            if resumable:
+                urls[p]['resumable'] = resumable
+            if sha:
+                urls[p]['sha256'] = sha
         return urls
 
-    @contextlib.contextmanager
     def git_poller_cache(self):
-        path = 'git_poller_cache.json'
-        data = {}
+        return GitPollerCache(self)
+
+
+class GitPollerCache(object):
+    '''The refs each git_poller trigger has seen, as {url: {ref: sha}}.
+       Each trigger is a shard stored in git_poller_cache/<id>.json. Shards
+       are loaded on first use and kept in memory. persist() only writes
+       the shards that changed since they were loaded or last written.
+
+       The poller also keeps each trigger's last project definition and its
+       cache headers in a git_poller_cache/<id>.projdef.json shard.
+    '''
+    LEGACY_PATH = 'git_poller_cache.json'
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._shards = {}
+        self._persisted = {}
+        self._migrated = False
+        # the poller checks triggers concurrently
+        self._lock = threading.Lock()
+
+    def _shard_path(self, key):
+        return 'git_poller_cache/%s.json' % key
+
+    def _keys(self, trigger_id):
+        return (str(trigger_id), '%s.projdef' % trigger_id)
+
+    def _migrate(self):
+        # Older versions kept every trigger in a single file. The legacy
+        # file is only removed once all of its shards have been written, so
+        # an interrupted migration starts over on the next run.
+        self._migrated = True
         try:
-            data = json.loads(self._get_as_string(path))
+            legacy = json.loads(self.storage._get_as_string(self.LEGACY_PATH))
         except FileNotFoundError:
-            log.warn('Cache not found, assuming initial run with no data')
+            return
+        log.info('Migrating the git_poller cache into shards')
+        for trigger_id, refs in legacy.items():
+            self.storage._create_from_string(
+                self._shard_path(trigger_id), json.dumps(refs, sort_keys=True))
+        self.storage._delete(self.LEGACY_PATH)
 
-        try:
-            yield data
-        finally:
-            self._create_from_string(path, json.dumps(data))
+    def _load(self, key):
+        with self._lock:
+            if not self._migrated:
+                self._migrate()
+        shard = self._shards.get(key)
+        if shard is None:
+            try:
+                content = self.storage._get_as_string(self._shard_path(key))
+                shard = json.loads(content)
+                self._persisted[key] = content
+            except FileNotFoundError:
+                log.info('No cache for %s, assuming initial run', key)
+                shard = {}
+            self._shards[key] = shard
+        return shard
+
+    def get(self, trigger_id):
+        return self._load(self._keys(trigger_id)[0])
+
+    def get_projdef(self, trigger_id):
+        '''The dictionary the poller keeps the trigger's project definition
+           and HTTP cache headers in.'''
+        return self._load(self._keys(trigger_id)[1])
+
+    def discard(self, trigger_id):
+        '''Stop holding a trigger's shards in memory.'''
+        for key in self._keys(trigger_id):
+            self._shards.pop(key, None)
+            self._persisted.pop(key, None)
+
+    def persist(self, trigger_id=None):
+        '''Write the changed shards, or just one trigger's shards.'''
+        if trigger_id is None:
+            keys = list(self._shards.keys())
+        else:
+            keys = [x for x in self._keys(trigger_id) if x in self._shards]
+        for x in keys:
+            content = json.dumps(self._shards[x], sort_keys=True)
+            if content != self._persisted.get(x):
+                self.storage._create_from_string(self._shard_path(x), content)
+                self._persisted[x] = content
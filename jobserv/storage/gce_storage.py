@@ -3,19 +3,34 @@
 
 import os
 import datetime
+import hashlib
+import hmac
 import logging
 
 from flask import redirect
 from google.cloud import storage
 from google.cloud.exceptions import NotFound
 
-from jobserv.settings import GCE_BUCKET
+from jobserv.settings import (
+    GCE_BLOB_MAX_AGE, GCE_BLOB_VERIFY_MAX_BYTES, GCE_BUCKET)
 from jobserv.storage.base import BaseStorage
 
+# size of the ranged reads used when streaming objects out of the bucket
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# linking a blob refreshes its age at most this often
+BLOB_TOUCH_INTERVAL = datetime.timedelta(days=1)
+
 log = logging.getLogger('jobserv.flask')
 
 
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
 class Storage(BaseStorage):
+    RESUMABLE_PROTOCOL = 'session'
+
     def __init__(self):
         super().__init__()
         creds_file = os.environ.get('GCE_CREDS')
@@ -43,6 +58,14 @@ class Storage(BaseStorage):
     def _get_as_string(self, storage_path):
         return self._get_raw(storage_path).decode()
 
+    def _iter_raw(self, storage_path):
+        b = self.bucket.get_blob(storage_path)
+        if b is None:
+            raise FileNotFoundError(storage_path)
+        for start in range(0, b.size, DOWNLOAD_CHUNK_SIZE):
+            end = min(start + DOWNLOAD_CHUNK_SIZE, b.size) - 1
+            yield b.download_as_string(start=start, end=end)
+
     def list_artifacts(self, run):
         name = '%s/%s/%s/' % (
             run.build.project.name, run.build.build_id, run.name)
@@ -50,11 +73,103 @@ class Storage(BaseStorage):
                 for x in self.bucket.list_blobs(prefix=name)
                 if not x.name.endswith('.rundef.json')]
 
+    def _list_artifact_sizes(self, run):
+        name = self._get_run_path(run)
+        return [(x.name[len(name):], x.size)
+                for x in self.bucket.list_blobs(prefix=name)
+                if not x.name.endswith('.rundef.json')]
+
+    def _list_tree(self, prefix):
+        blobs = self.bucket.list_blobs(prefix=prefix)
+        return [(x.name, x.size) for x in blobs]
+
+    def _delete(self, storage_path):
+        try:
+            self.bucket.delete_blob(storage_path)
+        except NotFound:
+            pass
+
     def _generate_put_url(self, run, path, expiration, content_type):
         b = self.bucket.blob(self._get_run_path(run, path))
         return b.generate_signed_url(
             expiration=expiration, method='PUT', content_type=content_type)
 
+    def _blob_path(self, run, sha256):
+        return 'blobs/%s/%s' % (run.build.project.name, sha256)
+
+    def _generate_blob_put_url(self, run, path, sha256, expiration,
+                               content_type):
+        b = self.bucket.blob(self._blob_path(run, sha256))
+        return b.generate_signed_url(
+            expiration=expiration, method='PUT', content_type=content_type)
+
+    def _generate_resumable_url(self, run, path, sha256, size, expiration,
+                                content_type):
+        # The session URI authorizes the upload itself and is valid for a
+        # week, so expiration doesn't apply.
+        if sha256:
+            b = self.bucket.blob(self._blob_path(run, sha256))
+        else:
+            b = self.bucket.blob(self._get_run_path(run, path))
+        return b.create_resumable_upload_session(
+            content_type=content_type, size=size)
+
+    def _accepts_blob(self, size):
+        # verifying the blob is part of the request that links it
+        return size is None or size <= GCE_BLOB_VERIFY_MAX_BYTES
+
+    def _verify_blob(self, b, sha256):
+        '''GCS only knows an object's md5 and crc32c, so the first link of
+           an uploaded blob hashes it here. The result is kept in the
+           object's metadata along with the generation it applies to, so
+           an upload overwriting the blob gets verified again.'''
+        meta = b.metadata or {}
+        generation = str(b.generation)
+        if meta.get('sha256') == sha256 and \
+                meta.get('sha256-generation') == generation:
+            return True
+        if b.size > GCE_BLOB_VERIFY_MAX_BYTES:
+            log.warning('Not linking %s, it is too big to verify', b.name)
+            return False
+        hasher = hashlib.sha256()
+        for start in range(0, b.size, DOWNLOAD_CHUNK_SIZE):
+            end = min(start + DOWNLOAD_CHUNK_SIZE, b.size) - 1
+            hasher.update(b.download_as_string(start=start, end=end))
+        if not hmac.compare_digest(hasher.hexdigest(), sha256):
+            log.warning('Deleting %s, its content does not match', b.name)
+            self._delete(b.name)
+            return False
+        b.metadata = {'sha256': sha256, 'sha256-generation': generation}
+        b.patch()
+        return True
+
+    def _link_blob(self, run, path, sha256):
+        b = self.bucket.get_blob(self._blob_path(run, sha256))
+        if b is None or not self._verify_blob(b, sha256):
+            return False
+        # a server-side copy of the generation that was verified, the bytes
+        # never travel through the runner
+        self.bucket.copy_blob(b, self.bucket, self._get_run_path(run, path),
+                              source_generation=b.generation)
+        now = _utcnow()
+        if b.updated < now - BLOB_TOUCH_INTERVAL:
+            # bump "updated" so the blob doesn't expire while it's in use
+            b.metadata = {'linked': now.isoformat()}
+            b.patch()
+        return True
+
+    def purge_unreferenced_blobs(self, now=None):
+        '''Runs hold their own copies of the content, so no run references
+           a blob. Blobs not linked for GCE_BLOB_MAX_AGE days are deleted.'''
+        cutoff = (now or _utcnow()) - datetime.timedelta(
+            days=GCE_BLOB_MAX_AGE)
+        purged = 0
+        for b in self.bucket.list_blobs(prefix='blobs/'):
+            if b.updated < cutoff:
+                self._delete(b.name)
+                purged += b.size
+        return purged
+
     def get_download_response(self, request, run, path):
         expiration = int(request.headers.get('X-EXPIRATION', '90'))
         b = self.bucket.blob(self._get_run_path(run, path))
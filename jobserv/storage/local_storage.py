@@ -1,26 +1,42 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 
+import fcntl
+import hashlib
 import hmac
+import json
 import os
 import mimetypes
+import re
 import shutil
+import tempfile
+import time
+import uuid
 
 from flask import Blueprint, make_response, request, send_file, url_for
 
 from jobserv.jsend import get_or_404
 from jobserv.models import Build, Project, Run
-from jobserv.settings import LOCAL_ARTIFACTS_DIR
+from jobserv.settings import LOCAL_ARTIFACTS_DIR, LOCAL_UPLOAD_MAX_AGE
 from jobserv.storage.base import BaseStorage
 
 SIGNING_KEY = os.environ.get('LOCAL_STORAGE_KEY', '').encode()
 
+# Uploads are streamed to disk through a single buffer of this size. Large
+# reads keep multi-GB uploads from spending their time in per-chunk overhead.
+UPLOAD_CHUNK_SIZE = int(
+    os.environ.get('LOCAL_STORAGE_CHUNK_SIZE', str(1024 * 1024)))
+
 
 blueprint = Blueprint('local_storage', __name__, url_prefix='/local-storage')
 
+# "bytes <start>-<end>/<total>" for a part or "bytes */<total>" for a query
+_CONTENT_RANGE = re.compile(r'bytes (?:(\d+)-(\d+)|\*)/(\d+)')
+
 
 class Storage(BaseStorage):
     blueprint = blueprint
+    RESUMABLE_PROTOCOL = 'ranges'
 
     def __init__(self):
         super().__init__()
@@ -36,8 +52,13 @@ class Storage(BaseStorage):
 
     def _create_from_string(self, storage_path, contents):
         path = self._get_local(storage_path)
-        with open(path, 'w') as f:
+        # write to a temporary file and rename it into place so that a
+        # crash can't leave a truncated file behind
+        fd, tmp = tempfile.mkstemp(dir=self._get_local('.uploads/'))
+        with open(fd, 'w') as f:
             f.write(contents)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
 
     def _create_from_file(self, storage_path, filename, content_type):
         path = self._get_local(storage_path)
@@ -56,6 +77,103 @@ class Storage(BaseStorage):
         with open(path, 'r') as f:
             return f.read()
 
+    def _blob_path(self, run, sha256):
+        return '.blobs/%s/%s/%s' % (
+            run.build.project.name, sha256[:2], sha256)
+
+    def _store_blob(self, path, blob):
+        '''Hardlink a freshly uploaded artifact into the blob store. Only
+           uploads whose X-Content-SHA256 was verified get stored.'''
+        try:
+            os.link(path, self._get_local(blob))
+        except FileExistsError:
+            pass  # identical content uploaded concurrently
+
+    def _generate_resumable_url(self, run, path, sha256, size, expiration,
+                                content_type):
+        # Parts are PUT to the normal upload URL with a Content-Range header.
+        # The upload ID keeps parts from different attempts, like a rerun,
+        # from being mixed together.
+        url = self._generate_put_url(run, path, expiration, content_type)
+        return url + '?upload=' + uuid.uuid4().hex
+
+    def _link_blob(self, run, path, sha256):
+        blob = os.path.join(self.artifacts, self._blob_path(run, sha256))
+        dst = os.path.join(self.artifacts, self._get_run_path(run, path))
+        try:
+            if os.path.samefile(blob, dst):
+                return True
+            os.unlink(dst)
+        except FileNotFoundError:
+            if not os.path.exists(blob):
+                return False
+        self._get_local(self._get_run_path(run, path))  # create parent dir
+        try:
+            os.link(blob, dst)
+        except FileNotFoundError:
+            return False  # blob was purged while we were linking it
+        except FileExistsError:
+            pass  # a concurrent request linked it
+        return True
+
+    def purge_unreferenced_blobs(self, now=None):
+        '''Delete blobs no run references any longer. The hardlink count
+           of a blob is its reference count. Uploads that were never
+           finished and haven't been written to for LOCAL_UPLOAD_MAX_AGE
+           days are deleted as well.'''
+        purged = 0
+        blobs = os.path.join(self.artifacts, '.blobs')
+        for base, _, names in os.walk(blobs):
+            for name in names:
+                path = os.path.join(base, name)
+                st = os.stat(path)
+                if st.st_nlink == 1:
+                    os.unlink(path)
+                    purged += st.st_size
+
+        cutoff = (now or time.time()) - LOCAL_UPLOAD_MAX_AGE * 24 * 3600
+        uploads = os.path.join(self.artifacts, '.uploads')
+        for entry in os.scandir(uploads) if os.path.isdir(uploads) else []:
+            try:
+                st = entry.stat()
+                if st.st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    purged += st.st_size
+            except FileNotFoundError:
+                pass  # the upload just completed
+        return purged
+
+    def _iter_raw(self, storage_path):
+        assert storage_path[0] != '/'
+        path = os.path.join(self.artifacts, storage_path)
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def _list_tree(self, prefix):
+        path = os.path.join(self.artifacts, prefix)
+        for base, _, names in os.walk(path):
+            for name in names:
+                name = os.path.join(base, name)
+                size = os.stat(name).st_size
+                yield os.path.relpath(name, self.artifacts), size
+
+    def _delete(self, storage_path):
+        assert storage_path[0] != '/'
+        os.unlink(os.path.join(self.artifacts, storage_path))
+
+    def _prune(self, prefix):
+        # remove the now empty directories below and including prefix
+        path = os.path.join(self.artifacts, prefix)
+        for base, _, _ in os.walk(path, topdown=False):
+            try:
+                os.rmdir(base)
+            except OSError:
+                pass  # something was uploaded while we were deleting
+
     def list_artifacts(self, run):
         path = '%s/%s/%s/' % (
             run.build.project.name, run.build.build_id, run.name)
@@ -65,6 +183,11 @@ class Storage(BaseStorage):
                 if name != '.rundef.json':
                     yield os.path.join(base, name)[len(path):]
 
+    def _list_artifact_sizes(self, run):
+        path = os.path.join(self.artifacts, self._get_run_path(run))
+        for name in self.list_artifacts(run):
+            yield name, os.stat(os.path.join(path, name)).st_size
+
     def get_download_response(self, request, run, path):
         try:
             p = os.path.join(self.artifacts, self._get_run_path(run), path)
@@ -95,6 +218,126 @@ def _get_run(proj, build_id, run):
     ).first_or_404()
 
 
+def _stream_to_file(stream, f, hasher=None):
+    """Copy a WSGI input stream into f using one preallocated buffer.
+
+    Streams offering readinto() are read without allocating a new bytes
+    object per chunk. Others (eg werkzeug's LimitedStream) fall back to
+    large read() calls.
+    """
+    buf = bytearray(UPLOAD_CHUNK_SIZE)
+    view = memoryview(buf)
+    readinto = getattr(stream, 'readinto', None)
+    total = 0
+    while True:
+        if readinto:
+            n = readinto(buf)
+            chunk = view[:n]
+        else:
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            n = len(chunk)
+        if not n:
+            break
+        if hasher:
+            hasher.update(chunk)
+        f.write(chunk)
+        total += n
+    return total
+
+
+def _move_into_place(ls, tmp, p, blob=None):
+    os.chmod(tmp, 0o644)
+    dirname = os.path.dirname(p)
+    try:
+        # we could have 2 uploads trying this, so just do it this way to
+        # avoid race conditions
+        os.makedirs(dirname)
+    except FileExistsError:
+        pass
+    os.rename(tmp, p)
+    if blob:
+        ls._store_blob(p, blob)
+
+
+def _merge_range(ranges, start, end):
+    '''Add the inclusive range start-end to a sorted list of disjoint
+       [start, end] ranges.'''
+    merged = []
+    for s, e in sorted(ranges + [[start, end]]):
+        if merged and s <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], e)
+        else:
+            merged.append([s, e])
+    return merged
+
+
+def _upload_range(ls, run, p, content_range, expected):
+    '''Handle one part of a resumable upload. Parts are written at their
+       offset into a partial file, so they can arrive in any order and in
+       parallel. The byte ranges received so far are tracked in a sidecar
+       file. Once they cover the whole artifact it's moved into place.
+       Otherwise a "308 Resume Incomplete" lists what's been received.'''
+    m = _CONTENT_RANGE.fullmatch(content_range)
+    if not m:
+        return 'Invalid Content-Range: ' + content_range, 400
+    start, end, total = m.groups()
+    total = int(total)
+    key = '%s,%s' % (p, request.args.get('upload', ''))
+    partial = ls._get_local(
+        '.uploads/%s.part' % hashlib.sha1(key.encode()).hexdigest())
+    ranges_file = partial[:-5] + '.ranges'
+
+    if start is not None:
+        start, end = int(start), int(end)
+        if start > end or end >= total:
+            return 'Invalid Content-Range: ' + content_range, 400
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT, 0o644)
+        with open(fd, 'wb') as f:
+            f.seek(start)
+            received = _stream_to_file(request.stream, f)
+        if received != end - start + 1:
+            return 'Expected %d bytes, received %d' % (
+                end - start + 1, received), 400
+    elif not os.path.exists(ranges_file):
+        return '', 308  # nothing received yet
+
+    with open(ranges_file, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        state = json.loads(f.read() or '{"ranges": []}')
+        if state.setdefault('total', total) != total:
+            return 'Upload in progress has a size of %d' % state['total'], 400
+        if start is not None:
+            state['ranges'] = _merge_range(state['ranges'], start, end)
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+            f.flush()
+
+        ranges = state['ranges']
+        if ranges == [[0, total - 1]]:
+            # this request has the lock, so only it can complete the upload
+            os.unlink(f.name)
+            if expected:
+                hasher = hashlib.sha256()
+                with open(partial, 'rb') as pf:
+                    for chunk in iter(lambda: pf.read(UPLOAD_CHUNK_SIZE), b''):
+                        hasher.update(chunk)
+                if not hmac.compare_digest(hasher.hexdigest(), expected):
+                    os.unlink(partial)
+                    return 'Content does not match X-Content-SHA256', 400
+            blob = expected and ls._blob_path(run, expected)
+            _move_into_place(ls, partial, p, blob)
+            return 'ok', 201
+
+    resp = make_response('', 308)
+    if ranges and ranges[0][0] == 0:
+        resp.headers['Range'] = 'bytes=0-%d' % ranges[0][1]
+    resp.headers['X-Received-Ranges'] = ','.join(
+        '%d-%d' % (s, e) for s, e in ranges)
+    return resp
+
+
 @blueprint.route(
     '/<sig>/<project:proj>/builds/<int:build_id>/runs/<run>/<path:path>',
     methods=('PUT',))
@@ -111,20 +354,26 @@ def run_upload_artifact(sig, proj, build_id, run, path):
     if not hmac.compare_digest(sig, computed):
         return 'Invalid signature', 401
 
-    dirname = os.path.dirname(p)
-    try:
-        # we could have 2 uploads trying this, so just do it this way to avoid
-        # race conditions
-        os.makedirs(dirname)
-    except FileExistsError:
-        pass
+    expected = request.headers.get('X-Content-SHA256')
+    content_range = request.headers.get('Content-Range')
+    if content_range:
+        return _upload_range(ls, run, p, content_range, expected)
+    hasher = hashlib.sha256() if expected else None
 
-    # stream the contents to disk
-    with open(p, 'wb') as f:
-        chunk_size = 4096
-        while True:
-            chunk = request.stream.read(chunk_size)
-            if len(chunk) == 0:
-                break
-            f.write(chunk)
+    # stream the contents to a temporary file and rename it into place so
+    # readers never see a partially uploaded artifact
+    tmpdir = ls._get_local('.uploads/')
+    fd, tmp = tempfile.mkstemp(dir=tmpdir, suffix='.tmp')
+    try:
+        with open(fd, 'wb') as f:
+            _stream_to_file(request.stream, f, hasher)
+        if hasher and not hmac.compare_digest(hasher.hexdigest(), expected):
+            os.unlink(tmp)
+            return 'Content does not match X-Content-SHA256', 400
+        blob = expected and ls._blob_path(run, expected)
+        _move_into_place(ls, tmp, p, blob)
+    except Exception:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
     return 'ok'
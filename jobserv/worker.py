@@ -2,220 +2,299 @@
 # Author: Andy Doan <andy.doan@linaro.org>
 
 import datetime
+import fnmatch
 import logging
-import os
 import time
 
-import requests
+from collections import Counter
 
-from jobserv.models import db, BuildStatus, Run, Worker, WORKER_DIR
+from jobserv.api.run import fail_run
+from jobserv.models import db, BuildStatus, Run, RunEvents, Surge, Worker
 from jobserv.sendmail import (
     notify_run_terminated, notify_surge_started, notify_surge_ended)
-from jobserv.settings import SURGE_SUPPORT_RATIO, WORKER_ROTATE_PINGS_LOG
+from jobserv.settings import SURGE_SUPPORT_RATIO
 from jobserv.stats import StatsClient
 
-SURGE_FILE = os.path.join(WORKER_DIR, 'enable_surge')
 DETECT_FLAPPING = True  # useful for unit testing
 
+# How often, in seconds, each of the monitor's checks runs
+CHECK_INTERVALS = {
+    'workers': 30,
+    'queue': 120,
+    'stuck': 600,
+    'cancelled': 30,
+}
+# The database is checked this often for changes to the queue. A change
+# triggers a queue check, but no sooner than QUEUE_MIN_INTERVAL after the
+# last one.
+QUEUE_POLL_INTERVAL = 5
+QUEUE_MIN_INTERVAL = 10
+
 logging.basicConfig(
     level='INFO', format='%(asctime)s %(levelname)s: %(message)s')
 log = logging.getLogger()
 
 
-def _check_worker(w):
-    log.debug('checking worker(%s) online(%s)', w.name, w.enlisted)
-    pings_log = w.pings_log
+def _check_workers():
+    # Workers check in every 20s, so 80s means they've missed 4 check-ins.
+    # Surge workers check in every 90s, so they get a little more slack.
+    now = datetime.datetime.utcnow()
+    late = db.or_(
+        Worker.last_seen.is_(None),
+        Worker.last_seen < now - datetime.timedelta(seconds=120),
+        db.and_(Worker.surges_only.isnot(True),
+                Worker.last_seen < now - datetime.timedelta(seconds=80)),
+    )
+    for w in Worker.query.filter(Worker.enlisted == 1, Worker.deleted == 0,
+                                 Worker.online == 1, late):
+        log.info('marking %s offline, last check-in: %s', w.name, w.last_seen)
+        w.online = False
+        with StatsClient() as c:
+            c.worker_offline(w)
+    db.session.commit()
 
-    try:
-        now = time.time()
-        st = os.stat(pings_log)
-        diff = now - st.st_mtime
-        threshold = 80
-        if w.surges_only:
-            # surge workers check in every 90s so let them miss 3 check-ins
-            threshold = 120
-        if diff > threshold and w.online:
-            # the worker checks in every 20s. This means its missed 4 check-ins
-            log.info('marking %s offline %ds without a check-in', w.name, diff)
-            w.online = False
-            with StatsClient() as c:
-                c.worker_offline(w)
-
-        # based on rough calculations a 1M file is about 9000 entries which is
-        # about 2 days worth of information
-        if st.st_size > (1024 * 1024):
-            if WORKER_ROTATE_PINGS_LOG:
-                # rotate log file
-                rotated = pings_log + '.%d' % now
-                log.info('rotating pings log to: %s', rotated)
-                os.rename(pings_log, rotated)
-            else:
-                log.info('truncating the pings log')
-                os.unlink(pings_log)
-
-            # the pings log won't exist now, so we need to touch an empty file
-            # with the proper mtime so we won't mark it offline on the next run
-            # this is technically racy, pings.log could exist at this moment,
-            # so we open in append mode, our st_mtime could be faulty because
-            # of this race condition, but this is one of the reasons why we
-            # give the worker some grace periods to check in
-            open(pings_log, 'a').close()
-            os.utime(pings_log, (st.st_atime, st.st_mtime))
-    except FileNotFoundError:
-        # its never checked in
-        if w.online:
-            w.online = False
-            log.info('marking %s offline (no pings log)', w.name)
-            with StatsClient() as c:
-                c.worker_offline(w)
 
+def _surges(queued, hosts, slots):
+    '''Return how many of the queued runs of each host tag the hosts can't
+       take.
 
-def _check_workers():
-    for w in Worker.query.filter(Worker.enlisted == 1, Worker.deleted == 0):
-        _check_worker(w)
-    db.session.commit()
+       "queued" maps a run's host tag, which can be a wildcard, to its
+       number of queued runs. "hosts" are the tags of each available worker
+       and each worker can take "slots" runs. Workers with the same tags are
+       pooled, so the work depends on the number of distinct tags rather
+       than on the number of runs and workers. The tags with the least
+       capacity claim theirs first. Runs without a host tag can't be
+       matched to a worker and are left out.'''
+    queued = {k: v for k, v in queued.items() if k is not None}
+    capacity = Counter()
+    for tags in hosts:
+        capacity[frozenset(x for x in tags if x is not None)] += slots
+
+    eligible = {}
+    for pattern in queued:
+        eligible[pattern] = [
+            pool for pool in capacity
+            if any(fnmatch.fnmatch(t, pattern) for t in pool)]
+    # pools that fewer tags can use are drawn from first
+    users = Counter(pool for pools in eligible.values() for pool in pools)
+
+    def total(pattern):
+        return sum(capacity[x] for x in eligible[pattern])
+
+    surges = {}
+    for pattern in sorted(queued, key=lambda x: (total(x), x)):
+        needed = queued[pattern]
+        for pool in sorted(eligible[pattern], key=lambda x: users[x]):
+            taken = min(needed, capacity[pool])
+            capacity[pool] -= taken
+            needed -= taken
+            if not needed:
+                break
+        if needed:
+            surges[pattern] = needed
+    return surges
+
+
+def _check_oversized():
+    """Fail queued runs requesting more cpus or memory than any worker that
+       could take them has. Offline workers count, so a run isn't failed
+       just because its only big enough worker is being rebooted."""
+    sized = Run.query.filter(
+        Run.status == BuildStatus.QUEUED,
+        Run.host_tag.isnot(None),
+        db.or_(Run.cpus.isnot(None), Run.memory.isnot(None)),
+    ).all()
+    if not sized:
+        return
+    workers = Worker.query.filter(
+        Worker.enlisted == True,  # NOQA (flake8 doesn't like == True)
+        Worker.deleted == False,  # NOQA
+    ).all()
+    for r in sized:
+        eligible = [
+            w for w in workers
+            if any(fnmatch.fnmatch(t.strip(), r.host_tag)
+                   for t in [w.name] + (w.host_tags or '').split(','))]
+        if not eligible:
+            continue  # surge support covers host tags no worker has
+        if any(w.fits((0, 0), r.cpus, r.memory) for w in eligible):
+            continue
+        wanted = []
+        if r.cpus:
+            wanted.append('%g cpus' % r.cpus)
+        if r.memory:
+            wanted.append('%dMB of memory' % r.memory)
+        wanted = ' and '.join(wanted)
+        log.error('Failing run %s/%s/%s, no worker has %s',
+                  r.build.project.name, r.build.build_id, r.name, wanted)
+        m = '\n' + '=' * 72 + '\n'
+        m += 'ERROR: No worker for host-tag %s has the %s requested\n' % (
+            r.host_tag, wanted)
+        m += '=' * 72 + '\n'
+        fail_run(r, m)
 
 
 def _check_queue():
+    _check_oversized()
+
     # find out queue by host_tags
-    queued = Run.query.filter(
+    queued = dict(db.session.query(
+        Run.host_tag, db.func.count(Run.id)
+    ).filter(
         Run.status == BuildStatus.QUEUED
-    ).order_by(
-        Run.id
-    )
-    queued = [[x.host_tag, True] for x in queued]
+    ).group_by(
+        Run.host_tag
+    ))
     with StatsClient() as c:
-        c.queued_runs(len(queued))
+        c.queued_runs(sum(queued.values()))
 
-    # now get a list of available slots for runs
-    workers = Worker.query.filter(
+    # now get the tags of the workers that can take runs
+    # pop_queued won't give unhealthy workers runs, so they're no capacity
+    workers = db.session.query(Worker.name, Worker.host_tags).filter(
         Worker.enlisted == True,  # NOQA (flake8 doesn't like == True)
-        Worker.online == True,
-        Worker.surges_only == False,
-        Worker.deleted == False,
+        Worker.online == True,  # NOQA
+        Worker.surges_only == False,  # NOQA
+        Worker.deleted == False,  # NOQA
+        Worker.unhealthy.is_(None),
     )
-    hosts = {}
-    for w in workers:
-        hosts[w.name] = {
-            'slots': SURGE_SUPPORT_RATIO,
-            'tags': [x.strip() for x in w.host_tags.split(',')],
-        }
-
-    # try and figure out runs/host in a round-robin fashion
-    matches_found = True
-    while matches_found:
-        matches_found = False
-        for name in list(hosts.keys()):
-            host = hosts[name]
-            if host['slots']:
-                for run in queued:
-                    # run = host_tag, not-claimed by a host
-                    # TODO support wildcard tag=arm%
-                    if run[1] and run[0] in host['tags']:
-                        matches_found = True
-                        run[1] = False  # claim it
-                        host['slots'] -= 1
-                        if host['slots'] == 0:
-                            del hosts[name]
-                        break  # move to the next host for round-robin
-    surges = {}
-    for tag, unclaimed in queued:
-        if unclaimed:
-            surges[tag] = surges.setdefault(tag, 0) + 1
+    hosts = [[name] + [x.strip() for x in (tags or '').split(',')]
+             for name, tags in workers]
+    surges = _surges(queued, hosts, SURGE_SUPPORT_RATIO)
 
     # clean up old surges no longer in place
-    path, base = os.path.split(SURGE_FILE)
-    prev_surges = [x[len(base) + 1:] for x in os.listdir(path)
-                   if x.startswith(base)]
+    now = datetime.datetime.utcnow()
+    prev_surges = Surge.query.all()
     log.debug('surges(%r), prev(%r)', surges, prev_surges)
-    for tag in prev_surges:
-        surge_file = SURGE_FILE + '-' + tag
-        if tag not in surges:
-            if time.time() - os.stat(surge_file).st_mtime < 300:
+    for surge in prev_surges:
+        if surge.tag not in surges:
+            if (now - surge.started).total_seconds() < 300:
                 # surges can sort of "flap". ie - you get bunches of emails
                 # when its right on the threshold. This just keeps us inside
                 # a surge for at least 5 minutes to help make sure we don't
                 # "flap"
                 if DETECT_FLAPPING:
                     continue
-            log.info('Exiting surge support for %s', tag)
-            with open(surge_file) as f:
-                msg_id = f.read().strip()
-                notify_surge_ended(tag, msg_id)
+            log.info('Exiting surge support for %s', surge.tag)
+            notify_surge_ended(surge.tag, surge.msg_id)
             with StatsClient() as c:
-                c.surge_ended(tag)
-            os.unlink(surge_file)
+                c.surge_ended(surge.tag)
+            db.session.delete(surge)
+            db.session.commit()
 
     # now check for new surges
+    prev_tags = set(x.tag for x in prev_surges)
     for tag, count in surges.items():
-        surge_file = SURGE_FILE + '-' + tag
-        if not os.path.exists(surge_file):
+        if tag not in prev_tags:
             log.info('Entering surge support for %s: count=%d', tag, count)
-            with open(surge_file, 'w') as f:
-                msgid = notify_surge_started(tag)
-                f.write(msgid)
+            msgid = notify_surge_started(tag)
+            db.session.add(Surge(tag, msgid))
+            db.session.commit()
             with StatsClient() as c:
                 c.surge_started(tag)
-
-
-def _update_run(run, status, message):
-    url = 'http://lci-web/projects/%s/builds/%s/runs/%s/' % (
-        run.build.project.name, run.build.build_id, run.name)
-    headers = {
-        'content-type': 'text/plain',
-        'Authorization': 'Token ' + run.api_key,
-        'X-RUN-STATUS': status,
-    }
-    for x in range(3):
-        r = requests.post(url, data=message.encode(), headers=headers)
-        if r.status_code == 200:
-            break
-        log.error('Unable to update run, trying again in 2 seconds')
-        time.sleep(2)
-    else:
-        log.error('Unable to update run: HTTP_%d\n%s', r.status_code, r.text)
-        r.raise_for_status()
+    Surge.invalidate_cache()
 
 
 def _check_stuck():
     cut_off = datetime.datetime.utcnow() - datetime.timedelta(hours=12)
-    for r in Run.query.filter(
-            Run.status.in_((BuildStatus.RUNNING, BuildStatus.CANCELLING))):
-        if len(r.status_events) > 0 and r.status_events[-1].time < cut_off:
-            period = cut_off - r.status_events[-1].time
-            log.error('Found stuck run %s/%s/%s on worker %s',
-                      r.build.project.name, r.build.build_id, r.name, r.worker)
-            m = '\n' + '=' * 72 + '\n'
-            m += '%s ERROR: Run appears to be stuck after %s\n' % (
-                datetime.datetime.utcnow(), period)
-            m += '=' * 72 + '\n'
-            _update_run(r, status=BuildStatus.FAILED.name, message=m)
-            notify_run_terminated(r, period)
+    active = (BuildStatus.RUNNING, BuildStatus.CANCELLING)
+    last_event = db.session.query(
+        RunEvents.run_id, db.func.max(RunEvents.time).label('time')
+    ).join(
+        Run, Run.id == RunEvents.run_id
+    ).filter(
+        Run.status.in_(active)
+    ).group_by(
+        RunEvents.run_id
+    ).subquery()
+    stuck = db.session.query(Run, last_event.c.time).join(
+        last_event, last_event.c.run_id == Run.id
+    ).filter(
+        Run.status.in_(active),
+        last_event.c.time < cut_off,
+    )
+    for r, last in stuck.all():
+        period = cut_off - last
+        log.error('Found stuck run %s/%s/%s on worker %s',
+                  r.build.project.name, r.build.build_id, r.name, r.worker)
+        m = '\n' + '=' * 72 + '\n'
+        m += '%s ERROR: Run appears to be stuck after %s\n' % (
+            datetime.datetime.utcnow(), period)
+        m += '=' * 72 + '\n'
+        fail_run(r, m)
+        notify_run_terminated(r, period)
 
 
 def _check_cancelled():
     """Find runs that were cancelled and have no worker assigned."""
     qs = Run.query.filter(
         Run.status == BuildStatus.CANCELLING, Run.worker == None)  # NOQA
-    for run in qs:
+    for run in qs.all():
         log.error('Failing cancelled run: %s/%s/%s',
                   run.build.project.name, run.build.build_id, run.name)
         m = '\n' + '=' * 72 + '\n' + 'CANCELLED\n'
-        _update_run(run, status=BuildStatus.FAILED.name, message=m)
+        fail_run(run, m)
+
+
+class Monitor(object):
+    '''Runs each check on its own schedule. The queue is also checked soon
+       after runs are created, dispatched or completed, so surges start
+       without waiting for its next scheduled check.'''
+    def __init__(self):
+        self.checks = {
+            'workers': _check_workers,
+            'queue': _check_queue,
+            'stuck': _check_stuck,
+            'cancelled': _check_cancelled,
+        }
+        self.next_due = {x: 0 for x in self.checks}
+        self.queue_checked = 0
+        self.queue_version = None
+
+    def _queue_changed(self):
+        # Creating a run adds a row to runs and every status change adds a
+        # run_events row. The max of a primary key is cheap to read.
+        db.session.rollback()  # don't read from a stale transaction
+        version = (db.session.query(db.func.max(Run.id)).scalar(),
+                   db.session.query(db.func.max(RunEvents.id)).scalar())
+        changed = version != self.queue_version
+        self.queue_version = version
+        return changed
+
+    def _run(self, name):
+        log.debug('checking %s', name)
+        start = time.time()
+        try:
+            self.checks[name]()
+        except Exception:
+            log.exception('Unable to check %s', name)
+            db.session.rollback()
+        duration = time.time() - start
+        with StatsClient() as c:
+            c.worker_monitor_check(name, duration)
+
+    def tick(self):
+        '''Run the checks that are due. Returns how long to sleep before
+           the next tick.'''
+        if self._queue_changed():
+            self.next_due['queue'] = min(
+                self.next_due['queue'],
+                self.queue_checked + QUEUE_MIN_INTERVAL)
+        for name in self.checks:
+            now = time.time()
+            if self.next_due[name] <= now:
+                if name == 'queue':
+                    self.queue_checked = now
+                self._run(name)
+                self.next_due[name] = now + CHECK_INTERVALS[name]
+        wake = min(self.next_due.values())
+        return max(0, min(wake - time.time(), QUEUE_POLL_INTERVAL))
 
 
 def run_monitor_workers():
     log.info('worker monitor has started')
+    monitor = Monitor()
     try:
         while True:
-            log.debug('checking workers')
-            _check_workers()
-            log.debug('checking queue')
-            _check_queue()
-            log.debug('checking stuck jobs')
-            _check_stuck()
-            log.debug('checking cancelled jobs')
-            _check_cancelled()
-            time.sleep(120)  # run every 2 minutes
+            time.sleep(monitor.tick())
     except Exception:
         log.exception('unexpected error in run_monitor_workers')
@@ -0,0 +1,120 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import math
+import os
+import struct
+import time
+
+# The metrics a worker reports when it checks in
+FIELDS = ('available_runners', 'mem_free', 'disk_free',
+          'load_avg_1', 'load_avg_5', 'load_avg_15')
+
+# Workers check in every 20s. Each 20s slot of the buffer holds the latest
+# check-in within it, so a week of metrics takes about 1.6MB per worker.
+RESOLUTION = 20
+SLOTS = 7 * 24 * 3600 // RESOLUTION
+
+_record = struct.Struct('<I%dd' % len(FIELDS))
+
+
+class PingMetrics(object):
+    '''A fixed size ring buffer of a worker's check-in metrics.
+
+       A record's slot is derived from its timestamp, so writing is a single
+       pwrite with no header to maintain and reading a time range only
+       touches the slots in it. Records left over from a previous trip
+       around the ring are recognized by their timestamps.'''
+    def __init__(self, path, slots=SLOTS):
+        self.path = path
+        self.slots = slots
+
+    def _offset(self, timestamp):
+        return (timestamp // RESOLUTION % self.slots) * _record.size
+
+    def add(self, timestamp, values):
+        '''Record the values, a dict of FIELDS, reported at timestamp.
+           Missing or non-numeric values are stored as NaN.'''
+        row = []
+        for field in FIELDS:
+            try:
+                row.append(float(values[field]))
+            except (KeyError, TypeError, ValueError):
+                row.append(math.nan)
+        timestamp = int(timestamp)
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT)
+        try:
+            os.pwrite(fd, _record.pack(timestamp, *row),
+                      self._offset(timestamp))
+        finally:
+            os.close(fd)
+
+    def _read(self, fd, start, end):
+        '''Read the slots holding timestamps start through end'''
+        first = start // RESOLUTION
+        count = min(end // RESOLUTION - first + 1, self.slots)
+        offset = self._offset(start)
+        size = count * _record.size
+        ring = self.slots * _record.size
+        buf = os.pread(fd, min(size, ring - offset), offset)
+        if offset + size > ring:
+            # wrap around to the start of the buffer
+            if len(buf) < ring - offset:
+                # the buffer is sparse and hasn't been filled to the end
+                buf += bytes(ring - offset - len(buf))
+            buf += os.pread(fd, offset + size - ring, 0)
+        buf = buf[:len(buf) - len(buf) % _record.size]
+        return _record.iter_unpack(buf)
+
+    def query(self, since=0, step=RESOLUTION, now=None):
+        '''Return the metrics recorded since the given time as a list of
+           timestamps and a dict of FIELDS to lists of values. Metrics are
+           averaged over buckets of "step" seconds. Missing values are None.
+        '''
+        now = int(now or time.time())
+        oldest = (now // RESOLUTION - self.slots + 1) * RESOLUTION
+        since = max(int(since), oldest)
+        step = max(RESOLUTION, int(step))
+        times = []
+        series = {x: [] for x in FIELDS}
+        if since > now:
+            return times, series
+
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return times, series
+        try:
+            records = self._read(fd, since, now)
+            # records come out in time order and buckets are consecutive
+            bucket = None
+            sums = counts = None
+            for ts, *values in records:
+                if not ts or ts < since or ts > now:
+                    continue  # an unused slot or one from a previous lap
+                cur = ts - ts % step
+                if cur != bucket:
+                    if bucket is not None:
+                        self._append(times, series, bucket, sums, counts)
+                    bucket = cur
+                    sums = [0.0] * len(FIELDS)
+                    counts = [0] * len(FIELDS)
+                for i, val in enumerate(values):
+                    if not math.isnan(val):
+                        sums[i] += val
+                        counts[i] += 1
+            if bucket is not None:
+                self._append(times, series, bucket, sums, counts)
+        finally:
+            os.close(fd)
+        return times, series
+
+    @staticmethod
+    def _append(times, series, bucket, sums, counts):
+        times.append(bucket)
+        for i, field in enumerate(FIELDS):
+            series[field].append(sums[i] / counts[i] if counts[i] else None)
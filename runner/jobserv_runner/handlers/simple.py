@@ -17,7 +17,8 @@ import urllib.parse
 import uuid
 
 from jobserv_runner.cmd import stream_cmd
-from jobserv_runner.jobserv import JobServApi, RunCancelledError
+from jobserv_runner.jobserv import (
+    JobServApi, RunCancelledError, sha256_file)
 from jobserv_runner.logging import ContextLogger
 
 passed_msg = r'''Runner has completed
@@ -209,6 +210,14 @@ class SimpleHandler(object):
                 ep = self.rundef.get('container-entrypoint')
                 log.info('Overriding container entrypointpoint to be: %s', ep)
                 cmd.extend(['--entrypoint', ep])
+            resources = self.rundef.get('resources') or {}
+            if resources.get('cpus'):
+                log.info('Limiting container to %s CPUs', resources['cpus'])
+                cmd.extend(['--cpus', str(resources['cpus'])])
+            if resources.get('memory'):
+                log.info('Limiting container to %dMB of memory',
+                         resources['memory'])
+                cmd.extend(['--memory', '%dm' % resources['memory']])
             cmd.extend(['-v' + ':'.join(x) for x in mounts])
             cmd.extend(
                 [self.rundef['container'], self._container_command])
@@ -460,13 +469,18 @@ class SimpleHandler(object):
         archive = os.path.join(self.run_dir, 'archive')
         total_size = 0
         uploads = []
+        dedup = self.rundef.get('artifact-dedup')
         for root, dirs, files in os.walk(archive):
             rel = root[len(archive) + 1:]
             for f in files:
                 if f:
                     f = os.path.join(rel, f)
-                    size = os.stat(os.path.join(archive, f)).st_size
-                    uploads.append({'file': f, 'size': size})
+                    path = os.path.join(archive, f)
+                    size = os.stat(path).st_size
+                    upload = {'file': f, 'size': size}
+                    if dedup:
+                        upload['sha256'] = sha256_file(path)
+                    uploads.append(upload)
                     total_size += size
 
         msg = 'Uploading %d items %d bytes\n' % (len(uploads), total_size)
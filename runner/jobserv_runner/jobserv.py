@@ -2,10 +2,12 @@
 # Author: Andy Doan <andy.doan@linaro.org>
 
 import datetime
+import hashlib
 import json
 import logging
 import mimetypes
 import os
+import threading
 import time
 import urllib.error
 import urllib.request
@@ -17,11 +19,99 @@ from multiprocessing.pool import ThreadPool
 
 import requests
 
+# Artifacts at least this large are uploaded in parts using the storage
+# backend's resumable protocol, so a network error only costs the part that
+# was in flight rather than the whole file.
+RESUMABLE_THRESHOLD = 64 * 1024 * 1024
+# GCS resumable sessions need parts to be a multiple of 256KiB
+PART_SIZE = 32 * 1024 * 1024
+PART_CONCURRENCY = 4
+
 
 def split(items, group_size):
     return [items[i:i + group_size] for i in range(0, len(items), group_size)]
 
 
+def sha256_file(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+class FilePart(object):
+    '''A read-only, file-like view of length bytes of a file starting at
+       offset. requests streams it rather than loading the part in memory.
+    '''
+    def __init__(self, path, offset, length):
+        self.length = length
+        self._remaining = length
+        self._f = open(path, 'rb')
+        self._f.seek(offset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._f.close()
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(lambda: self.read(1024 * 1024), b'')
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        buf = self._f.read(size)
+        self._remaining -= len(buf)
+        return buf
+
+
+def _parse_ranges(resp):
+    '''Return the [start, end] byte ranges a "308 Resume Incomplete"
+       response says the server has received.'''
+    received = resp.headers.get('X-Received-Ranges')
+    if received is None:
+        # GCS only reports the contiguous range from byte 0
+        received = resp.headers.get('Range', '')[len('bytes='):]
+    return [[int(y) for y in x.split('-')] for x in received.split(',') if x]
+
+
+class UploadProgress(object):
+    '''Report the progress of a large upload in 10% steps.'''
+    def __init__(self, jobserv, name, size, sent=0):
+        self.jobserv = jobserv
+        self.name = name
+        self.size = size
+        self.sent = sent
+        self.reported = self._step()
+        self._lock = threading.Lock()
+        if sent:
+            self.jobserv.update_status(
+                'UPLOADING', 'Resuming %s at %d%%' % (name, self.reported))
+
+    def _step(self):
+        return 100 * self.sent // self.size // 10 * 10
+
+    def __call__(self, nbytes):
+        with self._lock:
+            self.sent += nbytes
+            step = self._step()
+            if step <= self.reported:
+                return
+            self.reported = step
+        self.jobserv.update_status(
+            'UPLOADING', '%s %d%% uploaded' % (self.name, step))
+
+
 class PostError(Exception):
     pass
 
@@ -128,7 +218,14 @@ class JobServApi(object):
             url += '/'
         url += 'create_signed'
 
-        urls = [x['file'] for x in uploads]
+        urls = []
+        for x in uploads:
+            item = {'file': x['file']}
+            if x.get('sha256'):
+                item['sha256'] = x['sha256']
+            if x.get('size', 0) >= RESUMABLE_THRESHOLD:
+                item['size'] = x['size']
+            urls.append(item if len(item) > 1 else x['file'])
         data = json.dumps(urls).encode()
         for i in range(1, 5):
             try:
@@ -140,17 +237,97 @@ class JobServApi(object):
                 logging.exception('Unable to get urls, sleeping and retrying')
                 time.sleep(2 * i)
 
+    def _put_part(self, url, headers, path, start, end, size):
+        headers = dict(headers)
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        with FilePart(path, start, end - start + 1) as f:
+            return requests.put(url, data=f, headers=headers)
+
+    def _query_upload(self, url, headers, size):
+        '''Ask the server which ranges of a resumable upload it has.
+           Returns None if the upload is already complete.'''
+        headers = dict(headers)
+        headers['Content-Range'] = 'bytes */%d' % size
+        r = requests.put(url, data=b'', headers=headers)
+        if r.status_code in (200, 201):
+            return None
+        if r.status_code != 308:
+            raise PostError('HTTP_%d\n%s' % (r.status_code, r.text))
+        return _parse_ranges(r)
+
+    def _upload_ranges(self, path, artifact, urldata, headers):
+        '''The parts of a "ranges" upload can be sent in any order, so send
+           them in parallel and only the ones the server doesn't have.'''
+        size = os.stat(path).st_size
+        received = self._query_upload(urldata['url'], headers, size)
+        if received is None:
+            return
+        parts = []
+        for start in range(0, size, PART_SIZE):
+            end = min(start + PART_SIZE, size) - 1
+            if not any(s <= start and end <= e for s, e in received):
+                parts.append((start, end))
+        progress = UploadProgress(
+            self, artifact, size, size - sum(e - s + 1 for s, e in parts))
+
+        def _put(part):
+            try:
+                r = self._put_part(urldata['url'], headers, path, *part, size)
+            except Exception as e:
+                return str(e)
+            if r.status_code not in (200, 201, 308):
+                return 'HTTP_%d\n%s' % (r.status_code, r.text)
+            progress(part[1] - part[0] + 1)
+
+        with ThreadPool(PART_CONCURRENCY) as p:
+            errors = [x for x in p.map(_put, parts) if x]
+        if errors:
+            return 'Unable to upload %s: %s' % (artifact, errors[0])
+
+    def _upload_session(self, path, artifact, urldata, headers):
+        '''A "session" upload (GCS) must be sent in order. The server tells
+           us how much it has, so we pick up from there.'''
+        size = os.stat(path).st_size
+        received = self._query_upload(urldata['url'], headers, size)
+        if received is None:
+            return
+        offset = received[0][1] + 1 if received else 0
+        progress = UploadProgress(self, artifact, size, offset)
+        while offset < size:
+            end = min(offset + PART_SIZE, size) - 1
+            r = self._put_part(
+                urldata['url'], headers, path, offset, end, size)
+            if r.status_code in (200, 201):
+                break
+            if r.status_code != 308:
+                return 'Unable to upload %s: HTTP_%d\n%s' % (
+                    artifact, r.status_code, r.text)
+            received = _parse_ranges(r)
+            sent = received[0][1] + 1 if received else 0
+            if sent <= offset:
+                return 'Unable to upload %s: no progress at byte %d' % (
+                    artifact, offset)
+            progress(sent - offset)
+            offset = sent
+
     def _upload_item(self, artifacts_dir, artifact, urldata):
         # http://stackoverflow.com/questions/2502596/
-        with open(os.path.join(artifacts_dir, artifact), 'rb') as f:
-            try:
-                headers = {'Content-Type': urldata['content-type']}
+        path = os.path.join(artifacts_dir, artifact)
+        headers = {'Content-Type': urldata['content-type']}
+        if urldata.get('sha256'):
+            headers['X-Content-SHA256'] = urldata['sha256']
+        try:
+            if urldata.get('resumable') == 'ranges':
+                return self._upload_ranges(path, artifact, urldata, headers)
+            if urldata.get('resumable') == 'session':
+                return self._upload_session(path, artifact, urldata, headers)
+            with open(path, 'rb') as f:
                 r = requests.put(urldata['url'], data=f, headers=headers)
                 if r.status_code not in (200, 201):
                     return 'Unable to upload %s: HTTP_%d\n%s' % (
                         artifact, r.status_code, r.text)
-            except Exception as e:
-                return 'Unexpected error for %s: %s' % (artifact, str(e))
+        except Exception as e:
+            return 'Unexpected error for %s: %s' % (artifact, str(e))
 
     def upload(self, artifacts_dir, uploads):
         def _upload_cb(data):
@@ -168,16 +345,42 @@ class JobServApi(object):
         # request, so we'll split up our uploads array into groups of 75 to
         # be safe and upload them in bunches
         errors = []
+        deduplicated = 0
         upload_groups = split(uploads, 75)
         for i, upload_group in enumerate(upload_groups):
             if self.SIMULATED:
                 self.update_status('UPLOADING', 'simulate %s' % upload_group)
                 continue
             urls = self._get_urls(upload_group)
+            pending = [x for x in urls.items() if not x[1].get('exists')]
+            deduplicated += len(urls) - len(pending)
             p = ThreadPool(4)
-            errors.extend([x for x in p.map(_upload_cb, urls.items()) if x])
+            failed = set()
+            for (name, _), e in zip(pending, p.map(_upload_cb, pending)):
+                if e:
+                    failed.add(name)
+                    errors.append(e)
+
+            uploaded = {x[0] for x in pending} - failed
+            hashed = [x for x in upload_group if x['file'] in uploaded
+                      if urls[x['file']].get('sha256')]
+            if hashed:
+                # Content-addressed uploads land in the blob store. Asking
+                # again lets the server verify them and reference them from
+                # this run. The server can opt files out of the blob store
+                # by not returning their sha256.
+                linked = self._get_urls(hashed)
+                for x in hashed:
+                    if not linked.get(x['file'], {}).get('exists'):
+                        errors.append(
+                            'Unable to link %s: the server did not accept '
+                            'its upload' % x['file'])
             if len(upload_groups) > 2:  # lets give some status messages
                 msg = 'Uploading %d%% complete' % (
                     100 * (i + 1) / len(upload_groups))
                 self.update_status('UPLOADING', msg)
+        if deduplicated:
+            self.update_status(
+                'UPLOADING', '%d artifacts were already stored, skipped '
+                'uploading them' % deduplicated)
         return errors
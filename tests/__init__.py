@@ -8,7 +8,7 @@ from flask_testing import TestCase
 
 from jobserv import permissions, settings
 from jobserv.jsend import _status_str
-from jobserv.models import db, Project, ProjectTrigger
+from jobserv.models import db, Project, ProjectTrigger, Surge
 from jobserv.flask import create_app
 from jobserv.storage import local_storage
 
@@ -26,6 +26,7 @@ class JobServTest(TestCase):
     def setUp(self):
         super().setUp()
         db.create_all()
+        Surge.invalidate_cache()
 
     def tearDown(self):
         db.session.remove()
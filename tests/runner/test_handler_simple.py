@@ -201,6 +201,19 @@ class SimpleHandlerTest(TestCase):
         }
         self.handler.prepare_mounts()
 
+    def test_docker_run_resources(self):
+        self.handler.rundef = {
+            'container': 'busybox',
+            'resources': {'cpus': 1.5, 'memory': 512},
+        }
+        self.handler._container_command = '/script'
+        self.handler.log_context = mock.MagicMock()
+        self.handler.docker_run([])
+        log = self.handler.log_context().__enter__()
+        cmd = log.exec.call_args[0][0]
+        self.assertEqual('1.5', cmd[cmd.index('--cpus') + 1])
+        self.assertEqual('512m', cmd[cmd.index('--memory') + 1])
+
     @skipIf(not os.path.exists('/var/lib/docker'), 'Docker not available')
     def test_docker_run(self):
         """Sort of a long test, but it really executes the whole thing."""
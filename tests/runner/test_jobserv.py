@@ -0,0 +1,173 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase, mock
+
+from jobserv_runner.jobserv import (
+    RESUMABLE_THRESHOLD, JobServApi, sha256_file)
+
+
+class JobServApiTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.api = JobServApi('http://localhost/run/', 'key')
+
+    def test_sha256_file(self):
+        path = os.path.join(self.tmpdir, 'f')
+        data = os.urandom(1024 * 1024 * 2 + 5)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.assertEqual(hashlib.sha256(data).hexdigest(), sha256_file(path))
+
+    @mock.patch('jobserv_runner.jobserv.requests')
+    def test_upload_dedup(self, requests):
+        for name in ('a', 'b'):
+            with open(os.path.join(self.tmpdir, name), 'w') as f:
+                f.write(name)
+        uploads = [
+            {'file': 'a', 'size': 1, 'sha256': 'a' * 64},
+            {'file': 'b', 'size': 1, 'sha256': 'b' * 64},
+        ]
+        urls = {
+            'a': {'content-type': '', 'exists': True},
+            'b': {'url': 'http://b', 'content-type': '', 'sha256': 'b' * 64},
+        }
+        requests.put().status_code = 200
+        requests.put.reset_mock()
+        linked = {'b': {'content-type': '', 'exists': True}}
+        with mock.patch.object(self.api, '_get_urls') as get_urls, \
+                mock.patch.object(self.api, 'update_status'):
+            get_urls.side_effect = [urls, linked]
+            self.assertEqual([], self.api.upload(self.tmpdir, uploads))
+
+            # only "b" gets uploaded, and then committed to the run
+            self.assertEqual(1, requests.put.call_count)
+            self.assertEqual('http://b', requests.put.call_args[0][0])
+            headers = requests.put.call_args[1]['headers']
+            self.assertEqual('b' * 64, headers['X-Content-SHA256'])
+            self.assertEqual([uploads[1]], get_urls.call_args[0][0])
+
+    @mock.patch('jobserv_runner.jobserv.time')
+    @mock.patch('jobserv_runner.jobserv.requests')
+    def test_upload_link(self, requests, time):
+        for name in ('a', 'b', 'c'):
+            with open(os.path.join(self.tmpdir, name), 'w') as f:
+                f.write(name)
+        uploads = [{'file': x, 'size': 1, 'sha256': x * 64} for x in 'abc']
+        urls = {x: {'url': 'http://' + x, 'content-type': '',
+                    'sha256': x * 64} for x in 'abc'}
+
+        def put(url, data, headers):
+            return mock.Mock(status_code=500 if url == 'http://a' else 200)
+        requests.put.side_effect = put
+
+        # "a" fails to upload, "b" and "c" still get linked and the server
+        # rejects "c"
+        linked = {'b': {'content-type': '', 'exists': True},
+                  'c': {'url': 'http://c', 'content-type': ''}}
+        with mock.patch.object(self.api, '_get_urls') as get_urls, \
+                mock.patch.object(self.api, 'update_status'):
+            get_urls.side_effect = [urls, linked]
+            errors = self.api.upload(self.tmpdir, uploads)
+        self.assertEqual(uploads[1:], get_urls.call_args[0][0])
+        self.assertEqual(2, len(errors))
+        self.assertIn('Unable to upload a', errors[0])
+        self.assertEqual(
+            'Unable to link c: the server did not accept its upload',
+            errors[1])
+
+    @mock.patch('jobserv_runner.jobserv.requests')
+    def test_upload_not_blob(self, requests):
+        with open(os.path.join(self.tmpdir, 'a'), 'w') as f:
+            f.write('a')
+        uploads = [{'file': 'a', 'size': 1, 'sha256': 'a' * 64}]
+        # the server wants a normal upload, so there's nothing to link
+        urls = {'a': {'url': 'http://a', 'content-type': ''}}
+        requests.put().status_code = 200
+        with mock.patch.object(self.api, '_get_urls') as get_urls, \
+                mock.patch.object(self.api, 'update_status'):
+            get_urls.return_value = urls
+            self.assertEqual([], self.api.upload(self.tmpdir, uploads))
+            self.assertEqual(1, get_urls.call_count)
+
+    def _resumable_upload(self, requests, protocol, responses):
+        data = os.urandom(35)
+        with open(os.path.join(self.tmpdir, 'big'), 'wb') as f:
+            f.write(data)
+        sent = {}
+
+        def put(url, data, headers):
+            crange = headers['Content-Range']
+            sent[crange] = data.read() if hasattr(data, 'read') else data
+            return responses(crange)
+        requests.put.side_effect = put
+        urldata = {'url': 'http://big', 'content-type': '',
+                   'resumable': protocol}
+        with mock.patch.object(self.api, 'update_status') as status:
+            err = self.api._upload_item(self.tmpdir, 'big', urldata)
+        return data, sent, err, status
+
+    @mock.patch('jobserv_runner.jobserv.PART_SIZE', 10)
+    @mock.patch('jobserv_runner.jobserv.requests')
+    def test_upload_ranges(self, requests):
+        def responses(crange):
+            if crange == 'bytes */35':
+                # the server already has the first part
+                return mock.Mock(status_code=308,
+                                 headers={'X-Received-Ranges': '0-9'})
+            return mock.Mock(status_code=308, headers={})
+        data, sent, err, status = self._resumable_upload(
+            requests, 'ranges', responses)
+        self.assertIsNone(err)
+        self.assertEqual({
+            'bytes */35': b'',
+            'bytes 10-19/35': data[10:20],
+            'bytes 20-29/35': data[20:30],
+            'bytes 30-34/35': data[30:],
+        }, sent)
+        msgs = [x[0][1] for x in status.call_args_list]
+        self.assertEqual('Resuming big at 20%', msgs[0])
+        self.assertEqual('big 100% uploaded', msgs[-1])
+
+    @mock.patch('jobserv_runner.jobserv.PART_SIZE', 10)
+    @mock.patch('jobserv_runner.jobserv.requests')
+    def test_upload_session(self, requests):
+        def responses(crange):
+            if crange == 'bytes */35':
+                return mock.Mock(status_code=308,
+                                 headers={'Range': 'bytes=0-9'})
+            if crange == 'bytes 10-19/35':
+                # only part of the chunk was persisted
+                return mock.Mock(status_code=308,
+                                 headers={'Range': 'bytes=0-14'})
+            if crange == 'bytes 15-24/35':
+                return mock.Mock(status_code=308,
+                                 headers={'Range': 'bytes=0-24'})
+            return mock.Mock(status_code=200, headers={})
+        data, sent, err, status = self._resumable_upload(
+            requests, 'session', responses)
+        self.assertIsNone(err)
+        self.assertEqual(
+            ['bytes */35', 'bytes 10-19/35', 'bytes 15-24/35',
+             'bytes 25-34/35'], list(sent.keys()))
+        self.assertEqual(data[25:], sent['bytes 25-34/35'])
+
+    def test_get_urls_resumable(self):
+        uploads = [
+            {'file': 'small', 'size': 1},
+            {'file': 'big', 'size': RESUMABLE_THRESHOLD},
+        ]
+        with mock.patch('jobserv_runner.jobserv._post') as post:
+            post().read.return_value = b'{"data": {"urls": {}}}'
+            self.api._get_urls(uploads)
+            data = json.loads(post.call_args[0][1].decode())
+        self.assertEqual(
+            ['small', {'file': 'big', 'size': RESUMABLE_THRESHOLD}], data)
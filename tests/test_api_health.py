@@ -53,3 +53,33 @@ class HealthApiTest(JobServTest):
         self.assertEqual(3, len(d['health']['RUNNING']['worker2']))
 
         self.assertEqual(2, len(d['health']['QUEUED']))
+
+    def test_share_health(self):
+        self.create_projects('big', 'small', 'idle')
+        big, small = Project.query.filter(
+            Project.name.in_(['big', 'small'])).order_by(Project.name)
+        small.share_weight = 3
+        small.max_concurrency = 2
+        for p, active, queued in ((big, 6, 10), (small, 2, 1)):
+            b = Build.create(p)
+            for i in range(active + queued):
+                r = Run(b, 'run%d' % i)
+                if i < active:
+                    r.status = BuildStatus.RUNNING
+                db.session.add(r)
+        db.session.commit()
+
+        shares = self.get_json('/health/shares/')['shares']
+        self.assertEqual(['big', 'small'], sorted(shares))
+        self.assertEqual({
+            'share_weight': 1,
+            'max_concurrency': None,
+            'active': 6,
+            'queued': 10,
+            'fair_share': 0.25,
+            'share': 0.75,
+        }, shares['big'])
+        self.assertEqual(3, shares['small']['share_weight'])
+        self.assertEqual(2, shares['small']['max_concurrency'])
+        self.assertEqual(0.75, shares['small']['fair_share'])
+        self.assertEqual(0.25, shares['small']['share'])
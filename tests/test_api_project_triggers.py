@@ -1,7 +1,12 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 
-from jobserv.models import Project, ProjectTrigger, db
+import datetime
+import json
+
+from jobserv.flask import permissions
+from jobserv.models import (
+    PollerInstance, PollNudge, Project, ProjectTrigger, db)
 from tests import JobServTest
 
 
@@ -48,3 +53,52 @@ class ProjectTriggerAPITest(JobServTest):
 
         r = self.client.get('/projects/p/triggers/')
         self.assertEqual(401, r.status_code)
+
+    def _post_signed(self, url, data=None):
+        url = 'http://localhost' + url
+        headers = {'Content-type': 'application/json'}
+        permissions._sign(url, headers, 'POST')
+        return self.client.post(url, headers=headers, data=json.dumps(data))
+
+    def test_poll_nudges(self):
+        r = self.client.post('/project-triggers/nudges/',
+                             data=json.dumps({'url': 'repo'}))
+        self.assertEqual(401, r.status_code)
+
+        r = self._post_signed('/project-triggers/nudges/', {})
+        self.assertEqual(400, r.status_code, r.data)
+
+        for url in ('repo1', 'repo2', 'repo1'):
+            r = self._post_signed('/project-triggers/nudges/', {'url': url})
+            self.assertEqual(201, r.status_code, r.data)
+        self.assertEqual(2, PollNudge.query.count())
+
+        r = self._post_signed('/project-triggers/nudges/pop/')
+        self.assertEqual(200, r.status_code, r.data)
+        urls = json.loads(r.data.decode())['data']
+        self.assertEqual(['repo1', 'repo2'], sorted(urls))
+        self.assertEqual(0, PollNudge.query.count())
+
+    def test_poller_heartbeat(self):
+        r = self.client.post('/project-triggers/pollers/p1/')
+        self.assertEqual(401, r.status_code)
+
+        old = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        db.session.add(PollerInstance('dead', old))
+        db.session.commit()
+
+        r = self._post_signed('/project-triggers/pollers/p1/')
+        self.assertEqual(200, r.status_code, r.data)
+        r = self._post_signed('/project-triggers/pollers/p2/')
+        self.assertEqual(
+            ['p1', 'p2'], json.loads(r.data.decode())['data'])
+
+        # each live poller gets its own copy of a nudge
+        self._post_signed('/project-triggers/nudges/', {'url': 'repo'})
+        url = '/project-triggers/nudges/pop/'
+        r = self._post_signed(url, {'poller': 'p1'})
+        self.assertEqual(['repo'], json.loads(r.data.decode())['data'])
+        r = self._post_signed(url, {'poller': 'p1'})
+        self.assertEqual([], json.loads(r.data.decode())['data'])
+        r = self._post_signed(url, {'poller': 'p2'})
+        self.assertEqual(['repo'], json.loads(r.data.decode())['data'])
@@ -2,6 +2,7 @@
 # Author: Andy Doan <andy.doan@linaro.org>
 
 import contextlib
+import datetime
 import json
 import os
 import shutil
@@ -10,12 +11,14 @@ import tempfile
 from unittest.mock import Mock, patch
 
 from jobserv import permissions
+from jobserv.api.run import fail_run
 import jobserv.models
 import jobserv.storage.base
 
 from jobserv.storage import Storage
 from jobserv.models import (
-    Build, BuildStatus, Project, Run, Test, TestResult, db)
+    Build, BuildStatus, Project, Run, RunDuration, RunEvents, Test,
+    TestResult, Worker, db)
 
 from tests import JobServTest
 
@@ -513,6 +516,38 @@ class RunAPITest(JobServTest):
         db.session.refresh(r)
         self.assertEqual(BuildStatus.RUNNING, r.status)
 
+    @patch('jobserv.api.run.Storage')
+    @patch('jobserv.api.run.notify_build_complete')
+    def test_fail_run(self, build_complete, storage):
+        m = Mock()
+        m.get_project_definition.return_value = json.dumps({
+            'timeout': 5,
+            'triggers': [{
+                'name': 'git',
+                'type': 'git_poller',
+                'runs': [{'name': 'run0'}],
+                'email': {'users': 'f@f.com'},
+            }],
+        })
+        log = os.path.join(jobserv.storage.base.JOBS_DIR, 'console.log')
+        m.console_logfd.side_effect = lambda run, mode: open(log, mode)
+        m.get_run_definition.return_value = json.dumps({})
+        storage.return_value = m
+        r = Run(self.build, 'run0')
+        r.trigger = 'git'
+        r.status = BuildStatus.RUNNING
+        db.session.add(r)
+        db.session.commit()
+
+        fail_run(r, 'stuck\n')
+        db.session.refresh(r)
+        self.assertEqual(BuildStatus.FAILED, r.status)
+        self.assertEqual(BuildStatus.FAILED, self.build.status)
+        with open(log) as f:
+            self.assertEqual('stuck\n', f.read())
+        self.assertTrue(m.copy_log.called)
+        self.assertEqual('f@f.com', build_complete.call_args[0][1])
+
     @patch('jobserv.api.run.Storage')
     @patch('jobserv.api.run.notify_build_complete')
     def test_build_complete_email(self, build_complete, storage):
@@ -657,3 +692,54 @@ class RunAPITest(JobServTest):
         rundef = json.loads(m.set_run_definition.call_args[0][1])
         self.assertEqual('42', rundef['env']['buildparam'])
         self.assertEqual(8675309, run.queue_priority)
+
+    def test_run_eta(self):
+        proj_id = self.build.proj_id
+        for name, seconds in (('run0', 100), ('run1', 300), ('run2', 50)):
+            db.session.add(RunDuration(proj_id, name, 'amd64', seconds))
+        for name in ('run0', 'run1', 'run2', 'run3'):
+            r = Run(self.build, name)
+            r.host_tag = 'amd64'
+            db.session.add(r)
+        db.session.commit()
+
+        # no worker can take it
+        eta = self.get_json(self.urlbase + 'run2/eta')['eta']
+        self.assertEqual(50, eta['predicted_seconds'])
+        self.assertIsNone(eta['start'])
+
+        w = Worker('w1', 'd', 1, 1, 'amd64', 'k', 2, 'amd64')
+        w.enlisted = True
+        db.session.add(w)
+        r = Run.query.filter_by(name='run0').one()
+        r.set_status(BuildStatus.RUNNING)
+        db.session.commit()
+        started = datetime.datetime.utcnow() - datetime.timedelta(seconds=40)
+        RunEvents.query.update({'time': started})
+        db.session.commit()
+
+        # 60s left of run0 and 300s of run1 over 2 slots
+        before = datetime.datetime.utcnow()
+        eta = self.get_json(self.urlbase + 'run2/eta')['eta']
+        start = datetime.datetime.strptime(
+            eta['start'][:19], '%Y-%m-%dT%H:%M:%S')
+        expected = before + datetime.timedelta(seconds=180)
+        self.assertLess(abs((start - expected).total_seconds()), 2)
+        finish = datetime.datetime.strptime(
+            eta['finish'][:19], '%Y-%m-%dT%H:%M:%S')
+        self.assertLess(abs((finish - start).total_seconds() - 50), 2)
+
+        # unknown durations have no finish
+        eta = self.get_json(self.urlbase + 'run3/eta')['eta']
+        self.assertIsNone(eta['predicted_seconds'])
+        self.assertIsNone(eta['finish'])
+
+        eta = self.get_json(self.urlbase + 'run0/eta')['eta']
+        start = datetime.datetime.strptime(
+            eta['start'][:19], '%Y-%m-%dT%H:%M:%S')
+        self.assertLess(abs((start - started).total_seconds()), 1)
+
+        r.set_status(BuildStatus.PASSED)
+        db.session.commit()
+        resp = self.client.get(self.urlbase + 'run0/eta')
+        self.assertEqual(400, resp.status_code)
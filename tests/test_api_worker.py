@@ -7,7 +7,8 @@ import shutil
 import tempfile
 
 import jobserv.models
-from jobserv.models import Build, BuildStatus, Project, Run, Worker, db
+from jobserv.models import (
+    Build, BuildStatus, Project, Run, RunDuration, Worker, db)
 
 from unittest.mock import patch
 
@@ -58,16 +59,20 @@ class WorkerAPITest(JobServTest):
             ('Content-type', 'application/json'),
             ('Authorization', 'Token key'),
         ]
-        qs = 'num_available=1&foo=40'
+        qs = 'available_runners=1&mem_free=40&foo=bar'
         resp = self.client.get(
             '/workers/w1/', headers=headers, query_string=qs)
         self.assertEqual(200, resp.status_code)
         self.assertTrue(Worker.query.all()[0].online)
-        p = os.path.join(jobserv.models.WORKER_DIR, 'w1/pings.log')
-        with open(p) as f:
-            buf = f.read()
-            self.assertIn('num_available=1', buf)
-            self.assertIn('foo=40', buf)
+
+        data = self.get_json('/workers/w1/metrics/')['metrics']
+        self.assertEqual(1, len(data['times']))
+        self.assertEqual([1], data['series']['available_runners'])
+        self.assertEqual([40], data['series']['mem_free'])
+        self.assertEqual([None], data['series']['disk_free'])
+
+        resp = self.client.get('/workers/w1/metrics/?since=foo')
+        self.assertEqual(400, resp.status_code)
 
     def test_worker_log_event(self):
         w = Worker('w1', 'ubuntu', 12, 2, 'aarch64', 'key', 2, [])
@@ -170,6 +175,44 @@ class WorkerAPITest(JobServTest):
         data = json.loads(resp.data.decode())
         self.assertNotIn('run-defs', data['data']['worker'])
 
+    @patch('jobserv.models.WORKER_MAX_LOAD', 1.5)
+    @patch('jobserv.models.WORKER_MIN_DISK_FREE', 1000)
+    @patch('jobserv.api.worker.Run.pop_queued')
+    def test_worker_unhealthy(self, pop_queued):
+        pop_queued.return_value = None
+        w = Worker('w1', 'ubuntu', 12, 2, 'aarch64', 'key', 2, [])
+        w.enlisted = True
+        w.online = True
+        db.session.add(w)
+        db.session.commit()
+        headers = [
+            ('Content-type', 'application/json'),
+            ('Authorization', 'Token key'),
+        ]
+        qs = 'available_runners=1&disk_free=999&load_avg_5=3.1'
+        resp = self.client.get(
+            '/workers/w1/', headers=headers, query_string=qs)
+        self.assertEqual(200, resp.status_code)
+        self.assertFalse(pop_queued.called)
+        # the check-in's response reflects the metrics it reported
+        self.assertEqual(
+            'disk_free=999 < 1000, load_avg_5=3.10 > 3.00',
+            resp.json['data']['worker']['unhealthy'])
+        data = self.get_json('/workers/')['workers'][0]
+        self.assertEqual(
+            'disk_free=999 < 1000, load_avg_5=3.10 > 3.00',
+            data['unhealthy'])
+
+        # the load is relative to the number of CPUs
+        qs = 'available_runners=1&disk_free=1000&load_avg_5=3'
+        resp = self.client.get(
+            '/workers/w1/', headers=headers, query_string=qs)
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(pop_queued.called)
+        self.assertIsNone(resp.json['data']['worker']['unhealthy'])
+        data = self.get_json('/workers/')['workers'][0]
+        self.assertIsNone(data['unhealthy'])
+
     @patch('jobserv.api.worker.Storage')
     def test_worker_sync_builds(self, storage):
         """Ensure Projects with "synchronous_builds" are assigned properly.
@@ -311,6 +354,132 @@ class WorkerAPITest(JobServTest):
             [BuildStatus.QUEUED, BuildStatus.RUNNING],
             [x.status for x in Run.query])
 
+    def _queue_worker(self, storage, **kwargs):
+        rundef = {
+            'runner_url': 'foo',
+            'env': {}
+        }
+
+        def get_run_definition(run):
+            return json.dumps(dict(rundef, run_url='/' + run.name))
+        storage().get_run_definition.side_effect = get_run_definition
+        w = Worker('w1', 'ubuntu', 8 * 1024 * 1024 * 1024, 4, 'aarch64',
+                   'key', 2, ['aarch96'])
+        w.enlisted = True
+        w.online = True
+        for k, v in kwargs.items():
+            setattr(w, k, v)
+        db.session.add(w)
+        db.session.commit()
+
+    def _queue_run(self, build, name, **kwargs):
+        r = Run(build, name)
+        r.host_tag = 'aarch96'
+        for k, v in kwargs.items():
+            setattr(r, k, v)
+        db.session.add(r)
+        db.session.commit()
+        return r
+
+    def _pop_run(self):
+        """Check in as w1 and return the name of the run it's given"""
+        headers = [
+            ('Content-type', 'application/json'),
+            ('Authorization', 'Token key'),
+        ]
+        resp = self.client.get(
+            '/workers/w1/', headers=headers,
+            query_string='available_runners=1')
+        self.assertEqual(200, resp.status_code, resp.data)
+        data = json.loads(resp.data.decode())
+        rundefs = data['data']['worker'].get('run-defs')
+        if rundefs:
+            return json.loads(rundefs[0])['run_url'].split('/')[-1]
+
+    @patch('jobserv.api.worker.Storage')
+    def test_worker_pack_resources(self, storage):
+        """Runs are only given to a worker with room for their resources,
+           and a smaller run can use what's left."""
+        if db.engine.dialect.name == 'sqlite':
+            self.skipTest('Test requires MySQL')
+        self._queue_worker(storage)
+        self.create_projects('job-1')
+        b = Build.create(Project.query.all()[0])
+        self._queue_run(b, 'big', cpus=3)
+        self._queue_run(b, 'medium', cpus=2)
+        self._queue_run(b, 'small', cpus=1, memory=1024)
+        self._queue_run(b, 'huge-mem', memory=16 * 1024)
+
+        self.assertEqual('big', self._pop_run())
+        self.assertEqual('small', self._pop_run())
+        self.assertIsNone(self._pop_run())
+
+        # "big" completing frees room for "medium"
+        db.session.expire_all()
+        Run.query.filter_by(name='big').one().set_status(BuildStatus.PASSED)
+        db.session.commit()
+        self.assertEqual('medium', self._pop_run())
+
+    @patch('jobserv.models.QUEUE_POLICY', 'sjf')
+    @patch('jobserv.api.worker.Storage')
+    def test_worker_shortest_job_first(self, storage):
+        if db.engine.dialect.name == 'sqlite':
+            self.skipTest('Test requires MySQL')
+        self._queue_worker(storage)
+        self.create_projects('job-1')
+        p = Project.query.all()[0]
+        for name, seconds in (('long', 3600), ('short', 60), ('mid', 600)):
+            db.session.add(RunDuration(p.id, name, 'aarch96', seconds))
+        b = Build.create(p)
+        for name in ('long', 'short', 'mid'):
+            self._queue_run(b, name)
+
+        self.assertEqual('short', self._pop_run())
+        self.assertEqual('mid', self._pop_run())
+        self.assertEqual('long', self._pop_run())
+
+    @patch('jobserv.api.worker.Storage')
+    def test_worker_max_concurrency(self, storage):
+        if db.engine.dialect.name == 'sqlite':
+            self.skipTest('Test requires MySQL')
+        self._queue_worker(storage)
+        self.create_projects('job-1', 'job-2')
+        p1, p2 = Project.query.order_by(Project.name).all()
+        p1.max_concurrency = 1
+        b1 = Build.create(p1)
+        self._queue_run(b1, 'p1-a')
+        self._queue_run(b1, 'p1-b')
+        self._queue_run(Build.create(p2), 'p2-a')
+
+        # job-1 is at its limit once one of its runs is active
+        self.assertEqual('p1-a', self._pop_run())
+        self.assertEqual('p2-a', self._pop_run())
+        self.assertIsNone(self._pop_run())
+
+    @patch('jobserv.models.QUEUE_FAIR_SHARE', True)
+    @patch('jobserv.api.worker.Storage')
+    def test_worker_fair_share(self, storage):
+        if db.engine.dialect.name == 'sqlite':
+            self.skipTest('Test requires MySQL')
+        self._queue_worker(storage)
+        self.create_projects('job-1', 'job-2', 'job-3')
+        p1, p2, p3 = Project.query.order_by(Project.name).all()
+        p3.share_weight = 4
+
+        # job-1 and job-3 each have 2 active runs
+        for p in (p1, p3):
+            b = Build.create(p)
+            for x in range(2):
+                self._queue_run(b, 'active-%d' % x,
+                                status=BuildStatus.RUNNING)
+        for p in (p1, p2, p3):
+            self._queue_run(Build.create(p), p.name)
+
+        # job-2 has nothing running, then job-3 has the larger share
+        self.assertEqual('job-2', self._pop_run())
+        self.assertEqual('job-3', self._pop_run())
+        self.assertEqual('job-1', self._pop_run())
+
     def test_worker_create_bad(self):
         data = {
         }
@@ -0,0 +1,28 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+from unittest.mock import patch
+
+from jobserv.app import project_delete
+from jobserv.models import Build, Project, Run, RunDuration, db
+
+from tests import JobServTest
+
+
+class AppTest(JobServTest):
+    @patch('jobserv.retention.Storage')
+    def test_project_delete(self, storage):
+        storage()._list_tree.return_value = []
+        self.create_projects('proj-1', 'proj-2')
+        p1, p2 = Project.query.order_by(Project.name).all()
+        db.session.add(Run(Build.create(p1), 'run0'))
+        db.session.add(RunDuration(p1.id, 'run0', 'amd64', 10))
+        db.session.add(RunDuration(p2.id, 'run0', 'amd64', 20))
+        db.session.commit()
+        proj_2 = p2.id
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(project_delete, ['proj-1'], input='Y\n')
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual(['proj-2'], [x.name for x in Project.query])
+        self.assertEqual([proj_2], [x.proj_id for x in RunDuration.query])
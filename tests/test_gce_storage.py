@@ -0,0 +1,138 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import datetime
+import hashlib
+
+from unittest import mock
+
+from jobserv.models import Build, Run, Project, db
+from jobserv.storage import gce_storage
+
+from tests import JobServTest
+
+
+class GCEStorageTest(JobServTest):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('jobserv.storage.gce_storage.storage')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage = gce_storage.Storage()
+        self.bucket = self.storage.bucket
+
+        self.create_projects('gce-1')
+        self.proj = Project.query.filter_by(name='gce-1').one()
+        self.build = Build.create(self.proj)
+        self.run = Run(self.build, 'run1')
+        db.session.add(self.run)
+        db.session.commit()
+
+    def _blob(self, content, metadata=None, generation=12):
+        b = mock.Mock()
+        b.name = 'blobs/gce-1/' + hashlib.sha256(content).hexdigest()
+        b.size = len(content)
+        b.generation = generation
+        b.metadata = metadata
+        b.updated = gce_storage._utcnow()
+        b.download_as_string.side_effect = \
+            lambda start, end: content[start:end + 1]
+        self.bucket.get_blob.return_value = b
+        return b
+
+    def test_link_blob(self):
+        sha = hashlib.sha256(b'foo').hexdigest()
+        b = self._blob(b'foo')
+        self.assertTrue(self.storage._link_blob(self.run, 'foo.txt', sha))
+        self.bucket.get_blob.assert_called_once_with('blobs/gce-1/' + sha)
+        self.bucket.copy_blob.assert_called_once_with(
+            b, self.bucket, 'gce-1/1/run1/foo.txt', source_generation=12)
+        # the verification is remembered for this generation of the blob
+        self.assertEqual({'sha256': sha, 'sha256-generation': '12'},
+                         b.metadata)
+        self.assertTrue(b.patch.called)
+
+    def test_link_blob_verified(self):
+        sha = hashlib.sha256(b'foo').hexdigest()
+        b = self._blob(b'foo', {'sha256': sha, 'sha256-generation': '12'})
+        self.assertTrue(self.storage._link_blob(self.run, 'foo.txt', sha))
+        self.assertFalse(b.download_as_string.called)
+
+        # an upload replaced the blob since it was verified
+        b = self._blob(b'foo', {'sha256': sha, 'sha256-generation': '12'}, 13)
+        self.assertTrue(self.storage._link_blob(self.run, 'foo.txt', sha))
+        self.assertTrue(b.download_as_string.called)
+
+    def test_link_blob_mismatch(self):
+        sha = hashlib.sha256(b'foo').hexdigest()
+        b = self._blob(b'bad')
+        b.name = 'blobs/gce-1/' + sha
+        self.assertFalse(self.storage._link_blob(self.run, 'foo.txt', sha))
+        self.bucket.delete_blob.assert_called_once_with(b.name)
+        self.assertFalse(self.bucket.copy_blob.called)
+
+    def test_link_blob_missing(self):
+        self.bucket.get_blob.return_value = None
+        sha = hashlib.sha256(b'foo').hexdigest()
+        self.assertFalse(self.storage._link_blob(self.run, 'foo.txt', sha))
+        self.assertFalse(self.bucket.copy_blob.called)
+
+    @mock.patch.object(gce_storage, 'GCE_BLOB_VERIFY_MAX_BYTES', 2)
+    def test_link_blob_too_big(self):
+        sha = hashlib.sha256(b'foo').hexdigest()
+        b = self._blob(b'foo')
+        self.assertFalse(self.storage._link_blob(self.run, 'foo.txt', sha))
+        self.assertFalse(b.download_as_string.called)
+        self.assertFalse(self.bucket.delete_blob.called)
+
+        # a blob verified before the limit was lowered still links
+        b = self._blob(b'foo', {'sha256': sha, 'sha256-generation': '12'})
+        self.assertTrue(self.storage._link_blob(self.run, 'foo.txt', sha))
+
+    @mock.patch.object(gce_storage, 'GCE_BLOB_VERIFY_MAX_BYTES', 10)
+    def test_generate_signed_too_big(self):
+        self.bucket.get_blob.return_value = None
+        self.bucket.blob().generate_signed_url.return_value = 'put-url'
+        self.bucket.blob().create_resumable_upload_session.return_value = \
+            'session-url'
+        self.bucket.blob.reset_mock()
+        hashes = {'small': 'a' * 64, 'big': 'b' * 64}
+        urls = self.storage.generate_signed(
+            self.run, ['small', 'big'], 60, hashes, {'big': 11})
+
+        # the big file is uploaded straight to the run, it isn't a blob
+        self.assertEqual('a' * 64, urls['small']['sha256'])
+        self.assertEqual(
+            {'url': 'session-url', 'content-type': '', 'resumable': 'session'},
+            urls['big'])
+        self.assertEqual(
+            [mock.call('blobs/gce-1/' + 'a' * 64),
+             mock.call('gce-1/1/run1/big')],
+            self.bucket.blob.call_args_list)
+
+    def test_link_blob_touch(self):
+        sha = hashlib.sha256(b'foo').hexdigest()
+        b = self._blob(b'foo', {'sha256': sha, 'sha256-generation': '12'})
+        self.assertTrue(self.storage._link_blob(self.run, 'foo.txt', sha))
+        self.assertFalse(b.patch.called)
+
+        # a blob in use is kept from expiring
+        b.updated -= datetime.timedelta(days=2)
+        self.assertTrue(self.storage._link_blob(self.run, 'foo.txt', sha))
+        self.assertTrue(b.patch.called)
+
+    def test_purge_unreferenced_blobs(self):
+        now = gce_storage._utcnow()
+        blobs = []
+        for days in (0, 6, 8, 30):
+            b = mock.Mock(size=10, updated=now - datetime.timedelta(days))
+            b.name = 'blobs/gce-1/%d' % days
+            blobs.append(b)
+        self.bucket.list_blobs.return_value = blobs
+
+        with mock.patch.object(gce_storage, 'GCE_BLOB_MAX_AGE', 7):
+            self.assertEqual(20, self.storage.purge_unreferenced_blobs(now))
+        self.bucket.list_blobs.assert_called_once_with(prefix='blobs/')
+        self.assertEqual(
+            [mock.call('blobs/gce-1/8'), mock.call('blobs/gce-1/30')],
+            self.bucket.delete_blob.call_args_list)
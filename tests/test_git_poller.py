@@ -1,6 +1,10 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
+import os
 import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
 from unittest import TestCase, mock
 
@@ -122,6 +126,10 @@ def _fake_xml_content(
 class TestGitPoller(TestCase):
     def setUp(self):
         super().setUp()
+        # act as the only poller instance
+        p = mock.patch('jobserv.git_poller._heartbeat')
+        p.start().return_value = [git_poller.GIT_POLLER_NAME]
+        self.addCleanup(p.stop)
 
     @mock.patch('jobserv.git_poller.permissions')
     def test_get_project_triggers(self, perms):
@@ -144,31 +152,34 @@ class TestGitPoller(TestCase):
                          [(x.id, x.project) for x in project_triggers])
 
     @mock.patch('jobserv.git_poller._get_project_triggers')
-    @mock.patch('jobserv.git_poller.Storage')
-    def test_poll_remove(self, storage, get_project_triggers):
+    def test_poll_remove(self, get_project_triggers):
         get_project_triggers.return_value = {}
 
-        project_triggers = {}
-        git_poller._poll(project_triggers)
+        project_triggers = {
+            12: git_poller.PollerEntry(
+                git_poller.ProjectTrigger(12, 't', 'proj', 'user', 1)),
+        }
+        cache = mock.Mock()
+        git_poller._poll(project_triggers, cache, git_poller.PollScheduler())
         self.assertEqual({}, project_triggers)
+        cache.discard.assert_called_once_with(12)
 
     @mock.patch('jobserv.git_poller._get_projdef')
     @mock.patch('jobserv.git_poller._get_project_triggers')
-    @mock.patch('jobserv.git_poller.Storage')
-    def test_poll_add(self, storage, get_project_triggers, get_projdef):
+    def test_poll_add(self, get_project_triggers, get_projdef):
         get_project_triggers.return_value = {
             'foo': git_poller.ProjectTrigger(12, 't', 'proj', 'user', 1),
         }
         get_projdef.return_value = None  # prevents trying to really poll
 
         project_triggers = {}
-        git_poller._poll(project_triggers)
+        git_poller._poll(
+            project_triggers, mock.Mock(), git_poller.PollScheduler())
         self.assertEqual(['foo'], list(project_triggers.keys()))
 
     @mock.patch('jobserv.git_poller._get_projdef')
     @mock.patch('jobserv.git_poller._get_project_triggers')
-    @mock.patch('jobserv.git_poller.Storage')
-    def test_poll_updated(self, storage, get_project_triggers, get_projdef):
+    def test_poll_updated(self, get_project_triggers, get_projdef):
         project_triggers = {
             'foo': git_poller.PollerEntry(
                 git_poller.ProjectTrigger(12, 't', 'proj', 'user', 1)),
@@ -178,39 +189,399 @@ class TestGitPoller(TestCase):
         }
         get_projdef.return_value = None  # prevents trying to really poll
 
-        git_poller._poll(project_triggers)
+        git_poller._poll(
+            project_triggers, mock.Mock(), git_poller.PollScheduler())
         self.assertEqual(0, project_triggers['foo'].trigger.queue_priority)
         self.assertEqual('r', project_triggers['foo'].trigger.definition_repo)
 
-    @mock.patch('jobserv.git_poller.requests')
-    def test_get_refs(self, requests):
-        requests.get().status_code = 200
-        requests.get().text = '''ignore
-ignore
-004015f12d4181355604efa7b429fc3bcbae08d27f40 refs/heads/master
-004015f12d4181355604efa7b429fc3bcbae08d27f41 refs/pulls/123
-'''
+    @mock.patch('jobserv.git_poller._poll_project')
+    @mock.patch('jobserv.git_poller._get_projdef')
+    @mock.patch('jobserv.git_poller._get_project_triggers')
+    def test_poll_concurrent(self, get_project_triggers, get_projdef,
+                             poll_project):
+        get_project_triggers.return_value = {
+            x: git_poller.ProjectTrigger(x, 't', 'proj%d' % x, 'user', 1)
+            for x in range(4)
+        }
+        barrier = threading.Barrier(4, timeout=5)
+
+        def projdef(entry, cache):
+            barrier.wait()  # fails unless all 4 are polled at once
+            if entry.trigger.id == 2:
+                raise RuntimeError('one bad project')
+            return True
+        get_projdef.side_effect = projdef
+
+        cache = mock.Mock()
+        with mock.patch('jobserv.git_poller.GIT_POLLER_WORKERS', 4):
+            git_poller._poll({}, cache, git_poller.PollScheduler())
+        self.assertEqual(3, poll_project.call_count)
+        self.assertEqual(
+            ['0', '1', '3'],
+            sorted(str(x[0][0]) for x in cache.persist.call_args_list))
+
+    @mock.patch('jobserv.git_poller._poll_project')
+    @mock.patch('jobserv.git_poller._get_projdef')
+    def test_poll_scheduled(self, get_projdef, poll_project):
+        entries = {
+            1: git_poller.PollerEntry(
+                git_poller.ProjectTrigger(1, 't', 'proj', 'user', 1),
+                definition=True),
+        }
+        scheduler = git_poller.PollScheduler()
+        scheduler.repos['url1'] = git_poller.RepoSchedule(90, 0)
+        scheduler.repos['url2'] = git_poller.RepoSchedule(90, time.time() + 60)
+        scheduler.repos['gone'] = git_poller.RepoSchedule(90, 0)
+
+        def poll(refs_cache, entry, snapshots, logs, is_due):
+            for url in ('url1', 'url2'):
+                if is_due(url):
+                    snapshots.polled.add(url)
+                    snapshots.changed.add(url)
+        poll_project.side_effect = poll
+
+        git_poller._poll(entries, mock.Mock(), scheduler, refresh=False)
+        # the definition is only re-read on refresh cycles
+        self.assertEqual(0, get_projdef.call_count)
+        self.assertEqual(45, scheduler.repos['url1'].interval)
+        self.assertEqual(90, scheduler.repos['url2'].interval)
+        self.assertNotIn('gone', scheduler.repos)
+
+    @mock.patch('jobserv.git_poller.GIT_POLLER_INTERVAL', 100)
+    @mock.patch('jobserv.git_poller.GIT_POLLER_MIN_INTERVAL', 30)
+    @mock.patch('jobserv.git_poller.GIT_POLLER_MAX_INTERVAL', 150)
+    @mock.patch('jobserv.git_poller.GIT_POLLER_MAX_BACKOFF', 1000)
+    def test_poll_scheduler(self):
+        scheduler = git_poller.PollScheduler()
+        self.assertTrue(scheduler.is_due('url1', 0))
+        self.assertIsNone(scheduler.next_due())
+
+        # quiet repositories get polled less often, up to the max
+        scheduler.record('url1', 0, changed=False, failed=False)
+        self.assertEqual(125, scheduler.repos['url1'].interval)
+        self.assertFalse(scheduler.is_due('url1', 124))
+        self.assertTrue(scheduler.is_due('url1', 125))
+        scheduler.record('url1', 125, changed=False, failed=False)
+        self.assertEqual(150, scheduler.repos['url1'].interval)
+
+        # busy ones more often, down to the min
+        scheduler.record('url2', 0, changed=True, failed=False)
+        self.assertEqual(50, scheduler.repos['url2'].interval)
+        scheduler.record('url2', 50, changed=True, failed=False)
+        self.assertEqual(30, scheduler.repos['url2'].interval)
+        self.assertEqual(80, scheduler.next_due())
+
+        # failures back off exponentially and reset on success
+        for delay in (60, 120, 240, 480, 960, 1000):
+            scheduler.record('url2', 0, changed=False, failed=True)
+            self.assertEqual(delay, scheduler.repos['url2'].next_due)
+        scheduler.record('url2', 0, changed=False, failed=False)
+        self.assertEqual(0, scheduler.repos['url2'].failures)
+        self.assertEqual(37.5, scheduler.repos['url2'].next_due)
+
+        scheduler.forget_unpolled(300, {'url2'})
+        self.assertEqual(['url2'], list(scheduler.repos.keys()))
+
+    def test_poll_scheduler_nudge(self):
+        scheduler = git_poller.PollScheduler()
+        scheduler.repos['https://h/repo.git'] = git_poller.RepoSchedule(
+            90, 100)
+        self.assertFalse(scheduler.nudge('https://h/other', 10))
+        self.assertTrue(scheduler.nudge('https://h/repo/', 10))
+        self.assertEqual(10, scheduler.repos['https://h/repo.git'].next_due)
+
+    @mock.patch('jobserv.git_poller.GIT_POLLER_NUDGE_INTERVAL', 5)
+    @mock.patch('jobserv.git_poller._get_nudges')
+    @mock.patch('jobserv.git_poller.time')
+    def test_wait_nudged(self, time, get_nudges):
+        clock = [0]
+        time.time.side_effect = lambda: clock[0]
+
+        def sleep(secs):
+            clock[0] += secs
+        time.sleep.side_effect = sleep
+        get_nudges.side_effect = [[], ['unknown'], ['repo']]
+
+        scheduler = git_poller.PollScheduler()
+        scheduler.repos['repo'] = git_poller.RepoSchedule(90, 60)
+        git_poller._wait(scheduler, 60)
+        self.assertEqual(15, clock[0])
+        self.assertEqual(15, scheduler.repos['repo'].next_due)
+
+        # without nudges it sleeps until it's time
+        get_nudges.side_effect = None
+        get_nudges.return_value = []
+        git_poller._wait(scheduler, 42)
+        self.assertEqual(42, clock[0])
+
+    @mock.patch('jobserv.git_poller.ProjectDefinition.validate_data')
+    @mock.patch('jobserv.git_poller._session')
+    def test_get_projdef_cached(self, session, validate):
+        examples = os.path.join(
+            os.path.dirname(__file__), '../examples/projects')
+        with open(os.path.join(examples, 'python-github.yml')) as f:
+            content = f.read()
+        trigger = git_poller.ProjectTrigger(
+            1, 't', 'proj', 'user', 1, definition_repo='https://h/repo')
+        resp = session.get.return_value
+        resp.status_code = 200
+        resp.text = content
+        resp.content = content.encode()
+        resp.headers = {'ETag': 'e1', 'Last-Modified': 'yesterday'}
+
+        cache = {}
+        entry = git_poller.PollerEntry(trigger)
+        self.assertIsNotNone(git_poller._get_projdef(entry, cache))
+        self.assertEqual(1, validate.call_count)
+        self.assertEqual('https://h/repo/plain/proj.yml', cache['url'])
+        self.assertEqual('e1', cache['etag'])
+        headers = session.get.call_args[1]['headers']
+        self.assertNotIn('If-None-Match', headers)
+
+        # a restarted poller uses the persisted copy without validating it
+        entry = git_poller.PollerEntry(trigger)
+        resp.status_code = 304
+        projdef = git_poller._get_projdef(entry, cache)
+        self.assertEqual(projdef.timeout, entry.definition.timeout)
+        self.assertEqual(1, validate.call_count)
+        headers = session.get.call_args[1]['headers']
+        self.assertEqual('e1', headers['If-None-Match'])
+        self.assertEqual('yesterday', headers['If-Modified-Since'])
+
+        # servers without cache headers send the same content again
+        resp.status_code = 200
+        resp.headers = {}
+        git_poller._get_projdef(entry, cache)
+        self.assertEqual(1, validate.call_count)
+        self.assertIsNone(cache['etag'])
+
+        resp.text = content + '\n'
+        resp.content = resp.text.encode()
+        git_poller._get_projdef(entry, cache)
+        self.assertEqual(2, validate.call_count)
+
+    @mock.patch('jobserv.git_poller.GIT_POLLER_NAME', 'p2')
+    def test_shard(self):
+        triggers = {x: None for x in range(300)}
+        pollers = ['p1', 'p2', 'p3']
+        owned = {}
+        for name in pollers:
+            with mock.patch('jobserv.git_poller.GIT_POLLER_NAME', name):
+                owned[name] = set(git_poller._shard(triggers, pollers))
+        # every trigger has exactly one owner and the load is spread out
+        self.assertEqual(set(triggers), set.union(*owned.values()))
+        self.assertEqual(300, sum(len(x) for x in owned.values()))
+        for x in owned.values():
+            self.assertGreater(len(x), 50)
+
+        # when p3 goes away, only its triggers move
+        after = set(git_poller._shard(triggers, ['p1', 'p2']))
+        self.assertEqual(owned['p2'], after - owned['p3'])
+
+        # an instance always counts itself, even before jobserv does
+        self.assertEqual(
+            set(triggers), set(git_poller._shard(triggers, [])))
+
+    @mock.patch('jobserv.git_poller.GIT_POLLER_LEASE', 30)
+    @mock.patch('jobserv.git_poller.time')
+    def test_lease(self, time):
+        time.time.return_value = 100
+        lease = git_poller.PollerLease()
+        lease._thread = mock.Mock()  # as if the heartbeat thread was running
+        self.assertIsNone(lease.pollers())
+        self.assertFalse(lease.owns(1))
+
+        self.assertEqual([git_poller.GIT_POLLER_NAME], lease.renew())
+        self.assertEqual([git_poller.GIT_POLLER_NAME], lease.pollers())
+        self.assertTrue(lease.owns(1))
+
+        # another instance takes over some triggers
+        git_poller._heartbeat.return_value = ['p1', 'p2', 'p3']
+        lease.renew()
+        owned = [x for x in range(30) if lease.owns(x)]
+        self.assertGreater(len(owned), 0)
+        self.assertLess(len(owned), 30)
+
+        # a failed heartbeat keeps the old list until the lease lapses
+        git_poller._heartbeat.return_value = None
+        lease.renew()
+        time.time.return_value = 130
+        self.assertEqual(owned, [x for x in range(30) if lease.owns(x)])
+        time.time.return_value = 131
+        self.assertIsNone(lease.pollers())
+        self.assertFalse(lease.owns(owned[0]))
+
+    @mock.patch('jobserv.git_poller._trigger')
+    @mock.patch('jobserv.git_poller._get_repo_changes')
+    def test_poll_lost_owner(self, get_repo_changes, trigger):
+        entry = git_poller.PollerEntry(
+            git_poller.ProjectTrigger(1, 't', 'proj', 'user', 1),
+            definition=mock.Mock(triggers=[{
+                'name': 'git',
+                'type': 'git_poller',
+                'params': {'GIT_URL': 'url1', 'GIT_POLL_REFS': 'ref1'},
+            }]))
+        get_repo_changes.return_value = [{'GIT_SHA': 'sha1'}]
+        cache = mock.Mock()
+        logs = mock.Mock()
+
+        git_poller._poll_entry(cache, git_poller.RefSnapshots(), logs,
+                               lambda url: True, False, entry)
+        self.assertEqual(1, trigger.call_count)
+        cache.persist.assert_called_once_with(1)
+
+        # the trigger moved to another instance while changes were found
+        trigger.reset_mock()
+        cache.reset_mock()
+        other = git_poller.GIT_POLLER_NAME + '-other'
+        with mock.patch('jobserv.git_poller._owner') as owner:
+            owner.return_value = other
+            git_poller._poll_entry(cache, git_poller.RefSnapshots(), logs,
+                                   lambda url: True, False, entry)
+        self.assertFalse(trigger.called)
+        # its new owner has to find the changes, so they aren't persisted
+        self.assertFalse(cache.persist.called)
+        cache.discard.assert_called_once_with(1)
+
+    @mock.patch('jobserv.git_poller._host_semaphores', {})
+    @mock.patch('jobserv.git_poller.GIT_POLLER_HOST_LIMITS', {'b.com': 1})
+    @mock.patch('jobserv.git_poller.GIT_POLLER_HOST_CONCURRENCY', 2)
+    @mock.patch('jobserv.git_poller._session')
+    def test_host_concurrency(self, session):
+        active: Dict[str, int] = {}
+        peak: Dict[str, int] = {}
+        lock = threading.Lock()
+
+        def get(url, **kwargs):
+            with lock:
+                active[url] = active.get(url, 0) + 1
+                peak[url] = max(peak.get(url, 0), active[url])
+            time.sleep(0.05)
+            with lock:
+                active[url] -= 1
+        session.get.side_effect = get
+
+        urls = ['https://a.com'] * 6 + ['https://b.com'] * 3
+        with ThreadPoolExecutor(9) as pool:
+            list(pool.map(git_poller._http_get, urls))
+        self.assertEqual({'https://a.com': 2, 'https://b.com': 1}, peak)
+
+    @mock.patch('jobserv.git_poller._host_semaphores', {})
+    @mock.patch('jobserv.git_poller.GIT_POLLER_HOST_CONCURRENCY', 1)
+    @mock.patch('jobserv.git_poller._session')
+    def test_host_concurrency_stream(self, session):
+        session.get.side_effect = lambda url, **kwargs: mock.Mock()
+        resp = git_poller._http_get('https://a.com', stream=True)
+
+        # the streamed body is still being read, so the host is busy
+        with ThreadPoolExecutor(1) as pool:
+            f = pool.submit(git_poller._http_get, 'https://a.com')
+            try:
+                time.sleep(0.05)
+                self.assertFalse(f.done())
+                self.assertEqual(1, session.get.call_count)
+            finally:
+                resp.close()
+            f.result(timeout=5)
+        self.assertEqual(2, session.get.call_count)
+
+        # closing twice doesn't free a second slot
+        resp.close()
+        sem = git_poller._host_semaphore('https://a.com')
+        self.assertTrue(sem.acquire(blocking=False))
+        self.assertFalse(sem.acquire(blocking=False))
+
+    @mock.patch('jobserv.git_poller._session')
+    def test_get_refs(self, session):
+        pkt = git_poller._pkt_line
+        advertisement = b''.join([
+            pkt(b'# service=git-upload-pack\n'),
+            b'0000',
+            pkt(b'15f12d4181355604efa7b429fc3bcbae08d27f40 refs/heads/master'
+                b'\0multi_ack side-band-64k\n'),
+            pkt(b'15f12d4181355604efa7b429fc3bcbae08d27f41 refs/pulls/123\n'),
+            b'0000',
+        ])
+        session.get().status_code = 200
+        # the response arrives in chunks that split pkt-lines
+        session.get().iter_content.return_value = [
+            advertisement[i:i + 7] for i in range(0, len(advertisement), 7)]
         trigger = git_poller.ProjectTrigger(
             id=1, type='t', project='p', user='u', queue_priority=1)
         vals = []
-        for sha, ref in git_poller._get_refs('doesnot matter', trigger):
+        for sha, ref in git_poller._get_refs(
+                'doesnot matter', trigger, ['refs/heads/*']):
             vals.append((sha, ref))
         expected = [
             ('15f12d4181355604efa7b429fc3bcbae08d27f40', 'refs/heads/master'),
             ('15f12d4181355604efa7b429fc3bcbae08d27f41', 'refs/pulls/123'),
         ]
         self.assertEqual(expected, vals)
+        self.assertFalse(session.post.called)
+
+    @mock.patch('jobserv.git_poller._session')
+    def test_get_refs_v2(self, session):
+        pkt = git_poller._pkt_line
+        session.get().status_code = 200
+        session.get().iter_content.return_value = [b''.join([
+            pkt(b'# service=git-upload-pack\n'),
+            b'0000',
+            pkt(b'version 2\n'),
+            pkt(b'agent=git/github-g1234\n'),
+            pkt(b'ls-refs\n'),
+            pkt(b'fetch=shallow filter\n'),
+            b'0000',
+        ])]
+        session.post().status_code = 200
+        session.post().iter_content.return_value = [b''.join([
+            pkt(b'15f12d4181355604efa7b429fc3bcbae08d27f40 refs/heads/master'
+                b' symref-target:foo\n'),
+            pkt(b'15f12d4181355604efa7b429fc3bcbae08d27f41 refs/tags/v1\n'),
+            b'0000',
+        ])]
+        trigger = git_poller.ProjectTrigger(
+            id=1, type='t', project='p', user='u', queue_priority=1)
+        vals = list(git_poller._get_refs(
+            'https://example.com/repo', trigger,
+            ['refs/heads/master', 'refs/tags/v*']))
+        expected = [
+            ('15f12d4181355604efa7b429fc3bcbae08d27f40', 'refs/heads/master'),
+            ('15f12d4181355604efa7b429fc3bcbae08d27f41', 'refs/tags/v1'),
+        ]
+        self.assertEqual(expected, vals)
 
-    @mock.patch('jobserv.git_poller.requests')
-    def test_get_refs_fatal(self, requests):
-        requests.get().status_code = 500
-        requests.get().text = 'foobar'
+        args, kwargs = session.post.call_args
+        self.assertEqual('https://example.com/repo.git/git-upload-pack',
+                         args[0])
+        self.assertEqual('version=2', kwargs['headers']['Git-Protocol'])
+        self.assertEqual(b''.join([
+            pkt(b'command=ls-refs\n'),
+            b'0001',
+            pkt(b'ref-prefix refs/heads/master\n'),
+            pkt(b'ref-prefix refs/tags/v\n'),
+            b'0000',
+        ]), kwargs['data'])
+
+    def test_ref_prefixes(self):
+        self.assertEqual(
+            ['refs/heads/', 'refs/tags/v1.'],
+            git_poller._ref_prefixes(
+                ['refs/heads/*', 'refs/heads/ma?ter', 'refs/tags/v1.[0-9]']))
+        self.assertEqual([], git_poller._ref_prefixes(['refs/*', '*']))
+
+    @mock.patch('jobserv.git_poller._session')
+    def test_get_refs_fatal(self, session):
+        session.get().status_code = 500
+        session.get().text = 'foobar'
         trigger = git_poller.ProjectTrigger(
             id=1, type='t', project='p', user='u', queue_priority=1)
-        vals = []
-        for sha, ref in git_poller._get_refs('doesnot matter', trigger):
-            vals.append((sha, ref))
-        self.assertEqual([], vals)
+        with self.assertRaises(git_poller.RefsError):
+            list(git_poller._get_refs('doesnot matter', trigger, []))
+
+        # the poller treats it as a failed check of the repository
+        snapshots = git_poller.RefSnapshots()
+        self.assertEqual([], snapshots.get('doesnot matter', trigger, []))
+        self.assertEqual({'doesnot matter'}, snapshots.failed)
 
     @mock.patch('jobserv.git_poller._get_refs')
     def test_repo_changes_first_run(self, get_refs):
@@ -223,13 +594,13 @@ ignore
         ]
         cache = {}
         change_params = git_poller._get_repo_changes(
-            cache, 'url1', refs, trigger)
+            cache, 'url1', refs, trigger, git_poller.RefSnapshots())
         self.assertEqual([], list(change_params))
         self.assertEqual({'url1': {'ref1': 'sha1'}}, cache)
 
         refs = ['refs1', 'ref2']
         change_params = git_poller._get_repo_changes(
-            cache, 'url1', refs, trigger)
+            cache, 'url1', refs, trigger, git_poller.RefSnapshots())
         self.assertEqual([], list(change_params))
         self.assertEqual({'url1': {'ref1': 'sha1', 'ref2': 'sha2'}}, cache)
 
@@ -244,7 +615,7 @@ ignore
         ]
         cache = {'url1': {'ref1': 'oldsha', 'ref2': 'sha2'}}
         change_params = git_poller._get_repo_changes(
-            cache, 'url1', refs, trigger)
+            cache, 'url1', refs, trigger, git_poller.RefSnapshots())
         expected = [{
             'GIT_URL': 'url1',
             'GIT_OLD_SHA': 'oldsha',
@@ -253,6 +624,37 @@ ignore
         }]
         self.assertEqual(expected, list(change_params))
 
+    @mock.patch('jobserv.git_poller._get_refs')
+    def test_ref_snapshots(self, get_refs):
+        get_refs.return_value = iter([('sha1', 'ref1')])
+        t1 = git_poller.ProjectTrigger(1, 't', 'p1', 'u', 1)
+        t2 = git_poller.ProjectTrigger(2, 't', 'p2', 'u', 1)
+        t3 = git_poller.ProjectTrigger(
+            3, 't', 'p3', 'u', 1, secrets={'githubtok': 'tok'})
+
+        snapshots = git_poller.RefSnapshots()
+        with ThreadPoolExecutor(4) as pool:
+            found = list(pool.map(
+                lambda x: snapshots.get('url1', x, ['ref1']), [t1, t2] * 4))
+        self.assertEqual([[('sha1', 'ref1')]] * 8, found)
+        self.assertEqual(1, get_refs.call_count)
+
+        # triggers with different credentials might see different refs
+        get_refs.return_value = iter([])
+        self.assertEqual([], snapshots.get('url1', t3, ['ref1']))
+        self.assertEqual(2, get_refs.call_count)
+
+        # each trigger still tracks its own last seen SHAs
+        cache1 = {'url1': {'ref1': 'old'}}
+        cache2 = {'url1': {'ref1': 'sha1'}}
+        changes = git_poller._get_repo_changes(
+            cache1, 'url1', ['ref1'], t1, snapshots)
+        self.assertEqual(['sha1'], [x['GIT_SHA'] for x in changes])
+        changes = git_poller._get_repo_changes(
+            cache2, 'url1', ['ref1'], t2, snapshots)
+        self.assertEqual([], list(changes))
+        self.assertEqual(2, get_refs.call_count)
+
     @mock.patch.object(git_poller.permissions, 'internal_post')
     @mock.patch('jobserv.git_poller._github_log')
     def test_trigger_skip_github(self, github_log, poster):
@@ -297,11 +699,161 @@ ignore
         self.assertTrue(cgit_log.called)
         self.assertIs(poster.called, False)
 
-    @mock.patch('jobserv.git_poller.requests')
-    def test_cgit_log_skip_head_title(self, requests):
+    def test_match_paths(self):
+        files = ['README.md', 'fw/main.c', 'fw/docs/index.rst', 'tools/x.py']
+        paths = {'include': ['fw/*'], 'exclude': ['fw/docs/*']}
+        self.assertEqual(['fw/main.c'], git_poller._match_paths(files, paths))
+        paths = {'exclude': ['*.md', '*.rst']}
+        self.assertEqual(['fw/main.c', 'tools/x.py'],
+                         git_poller._match_paths(files, paths))
+        self.assertEqual([], git_poller._match_paths(
+            ['README.md'], {'include': ['fw/*']}))
+
+    @mock.patch.object(git_poller.permissions, 'internal_post')
+    @mock.patch('jobserv.git_poller._cgit_log')
+    @mock.patch('jobserv.git_poller._changed_files')
+    def test_trigger_paths(self, changed_files, cgit_log, poster):
+        cgit_log.return_value = ('log', False)
+        poster.return_value.status_code = 201
+        entry = _fake_entry()
+        entry.definition._data['triggers'] = [
+            {'name': 'fake', 'paths': {'include': ['src/*']}}]
+        params = _fake_change_params(url='https://h/repo')
+
+        changed_files.return_value = ['docs/index.md']
+        git_poller._trigger(entry, 'fake', params)
+        self.assertFalse(poster.called)
+
+        changed_files.return_value = ['docs/index.md', 'src/main.c']
+        git_poller._trigger(entry, 'fake', params)
+        data = poster.call_args[1]['json']
+        self.assertEqual(
+            'docs/index.md\nsrc/main.c', data['params']['GIT_CHANGED_FILES'])
+        self.assertNotIn('GIT_CHANGED_FILES', params)
+
+        # too many files, or too long a list, for the run's environment
+        for files in (['src/%d.c' % x for x in range(301)],
+                      ['src/' + 'x' * 1024 + '%d.c' % x for x in range(70)]):
+            poster.reset_mock()
+            changed_files.return_value = files
+            git_poller._trigger(entry, 'fake', params)
+            data = poster.call_args[1]['json']
+            self.assertNotIn('GIT_CHANGED_FILES', data['params'])
+
+        # we build when the changes can't be listed
+        poster.reset_mock()
+        changed_files.return_value = None
+        git_poller._trigger(entry, 'fake', params)
+        self.assertTrue(poster.called)
+
+    @mock.patch('jobserv.git_poller._session')
+    def test_github_changed_files(self, session):
+        session.get.return_value.status_code = 200
+        session.get.return_value.json.return_value = {'files': [
+            {'filename': 'a'},
+            {'filename': 'b', 'previous_filename': 'c'},
+        ]}
+        params = _fake_change_params(url='https://github.com/o/r.git')
+        files = git_poller._changed_files(_fake_trigger(), params)
+        self.assertEqual(['a', 'b', 'c'], files)
+        self.assertEqual('https://api.github.com/repos/o/r/compare/oldfake...'
+                         'fake', session.get.call_args[0][0])
+
+        files = [{'filename': str(x)} for x in range(300)]
+        session.get.return_value.json.return_value = {'files': files}
+        self.assertIsNone(git_poller._changed_files(_fake_trigger(), params))
+
+    @mock.patch('jobserv.git_poller._session')
+    def test_cgit_changed_files(self, session):
+        session.get.return_value.status_code = 200
+        session.get.return_value.iter_lines.return_value = [
+            b'diff --git a/foo/bar.c b/foo/bar.c',
+            b'index 1234..5678 100644',
+            b'+diff --git a/not/a/file b/not/a/file',
+            b'diff --git a/old.txt b/new.txt',
+        ]
+        params = _fake_change_params(url='https://h/repo')
+        self.assertEqual(['foo/bar.c', 'new.txt', 'old.txt'],
+                         git_poller._changed_files(_fake_trigger(), params))
+        self.assertEqual('https://h/repo.git/rawdiff/',
+                         session.get.call_args[0][0])
+
+        session.get.return_value.status_code = 404
+        self.assertIsNone(git_poller._changed_files(_fake_trigger(), params))
+
+        # a page without diff headers isn't a cgit rawdiff
+        session.get.return_value.status_code = 200
+        session.get.return_value.iter_lines.return_value = [b'<html>']
+        self.assertIsNone(git_poller._changed_files(_fake_trigger(), params))
+
+        # hosts already found not to be cgit aren't asked
+        session.get.reset_mock()
+        with mock.patch.dict(git_poller._cgit_repos, {'https://h': False}):
+            self.assertIsNone(
+                git_poller._changed_files(_fake_trigger(), params))
+        self.assertFalse(session.get.called)
+
+    @mock.patch.object(git_poller.permissions, 'internal_post')
+    @mock.patch('jobserv.git_poller._commit_log')
+    def test_commit_logs(self, commit_log, poster):
+        commit_log.return_value = ('abcdef1 message', False)
+        poster.return_value.status_code = 201
+        t1 = _fake_trigger()
+        t2 = _fake_trigger()
+        t2.secrets = {'githubtok': 'tok'}
+        change = _fake_change_params()
+
+        with ThreadPoolExecutor(2) as pool:
+            logs = git_poller.CommitLogs(pool)
+            for entry in (_fake_entry(), _fake_entry()):
+                git_poller._trigger(entry, 'fake', change, logs)
+            self.assertEqual(1, commit_log.call_count)
+            data = poster.call_args[1]['json']
+            self.assertIn('abcdef1 message', data['reason'])
+
+            # other credentials might not see the same commits
+            logs.get(t1, change).result()
+            logs.get(t2, change).result()
+            self.assertEqual(2, commit_log.call_count)
+            self.assertEqual(2, logs.fetches)
+
+    @mock.patch('jobserv.git_poller.LOG_PAGE_SIZE', 2)
+    @mock.patch('jobserv.git_poller._session')
+    def test_github_log_paginated(self, session):
+        def commit(sha):
+            return {'sha': sha, 'commit': {'message': 'msg ' + sha}}
+        pages = {
+            1: [commit('fake'), commit('sha2')],
+            2: [commit('sha3'), commit('oldfake')],
+            3: [commit('never')],
+        }
+
+        def get(url, auth, params):
+            resp = mock.Mock(status_code=200)
+            resp.json.return_value = pages[params['page']]
+            return resp
+        session.get.side_effect = get
+
+        gitlog, skipped = git_poller._github_log(
+            _fake_trigger(), _fake_change_params())
+        self.assertEqual('fake msg fake\nsha2 msg sha2\nsha3 msg sha3\n',
+                         gitlog)
+        self.assertEqual(2, session.get.call_count)
+
+        # stops after LOG_MAX_COMMITS when the old SHA isn't found
+        pages[2] = [commit('sha3'), commit('sha4')]
+        session.get.reset_mock()
+        with mock.patch('jobserv.git_poller.LOG_MAX_COMMITS', 4):
+            gitlog, skipped = git_poller._github_log(
+                _fake_trigger(), _fake_change_params())
+        self.assertEqual(2, session.get.call_count)
+        self.assertTrue(gitlog.endswith('sha4 msg sha4\n...\n'))
+
+    @mock.patch('jobserv.git_poller._session')
+    def test_cgit_log_skip_head_title(self, session):
         head_sha = "fakeheadid"
         response_mock = mock.Mock()
-        requests.get.return_value = response_mock
+        session.get.return_value = response_mock
         response_mock.status_code = 200
         response_mock.text = _fake_xml_content(
             skip_head_title=True,
@@ -313,11 +865,11 @@ ignore
 
         self.assertEqual(actual_skipped, True)
 
-    @mock.patch('jobserv.git_poller.requests')
-    def test_cgit_log_skip_head_content(self, requests):
+    @mock.patch('jobserv.git_poller._session')
+    def test_cgit_log_skip_head_content(self, session):
         head_sha = "fakeheadid"
         response_mock = mock.Mock()
-        requests.get.return_value = response_mock
+        session.get.return_value = response_mock
         response_mock.status_code = 200
         response_mock.text = _fake_xml_content(
             skip_head_content=True,
@@ -329,11 +881,11 @@ ignore
 
         self.assertEqual(actual_skipped, True)
 
-    @mock.patch('jobserv.git_poller.requests')
-    def test_cgit_log_not_skip_other_title(self, requests):
+    @mock.patch('jobserv.git_poller._session')
+    def test_cgit_log_not_skip_other_title(self, session):
         head_sha = "fakeheadid"
         response_mock = mock.Mock()
-        requests.get.return_value = response_mock
+        session.get.return_value = response_mock
         response_mock.status_code = 200
         response_mock.text = _fake_xml_content(
             skip_other_title=True,
@@ -345,11 +897,11 @@ ignore
 
         self.assertEqual(actual_skipped, False)
 
-    @mock.patch('jobserv.git_poller.requests')
-    def test_cgit_log_not_skip_other_content(self, requests):
+    @mock.patch('jobserv.git_poller._session')
+    def test_cgit_log_not_skip_other_content(self, session):
         head_sha = "fakeheadid"
         response_mock = mock.Mock()
-        requests.get.return_value = response_mock
+        session.get.return_value = response_mock
         response_mock.status_code = 200
         response_mock.text = _fake_xml_content(
             skip_other_content=True,
@@ -361,11 +913,11 @@ ignore
 
         self.assertEqual(actual_skipped, False)
 
-    @mock.patch('jobserv.git_poller.requests')
-    def test_github_log_skip_head_message(self, requests):
+    @mock.patch('jobserv.git_poller._session')
+    def test_github_log_skip_head_message(self, session):
         head_sha = "fakeheadid"
         response_mock = mock.Mock()
-        requests.get.return_value = response_mock
+        session.get.return_value = response_mock
         response_mock.status_code = 200
         response_mock.json.return_value = _fake_github_content(
             head_sha=head_sha, skip_head_content=True)
@@ -376,11 +928,11 @@ ignore
 
         self.assertEqual(actual_skipped, True)
 
-    @mock.patch('jobserv.git_poller.requests')
-    def test_github_log_not_skip_other_message(self, requests):
+    @mock.patch('jobserv.git_poller._session')
+    def test_github_log_not_skip_other_message(self, session):
         head_sha = "fakeheadid"
         response_mock = mock.Mock()
-        requests.get.return_value = response_mock
+        session.get.return_value = response_mock
         response_mock.status_code = 200
         response_mock.json.return_value = _fake_github_content(
             head_sha=head_sha, skip_other_content=True)
@@ -391,11 +943,11 @@ ignore
 
         self.assertEqual(actual_skipped, False)
 
-    @mock.patch('jobserv.git_poller.requests')
-    def test_github_log_not_skip(self, requests):
+    @mock.patch('jobserv.git_poller._session')
+    def test_github_log_not_skip(self, session):
         head_sha = "fakeheadid"
         response_mock = mock.Mock()
-        requests.get.return_value = response_mock
+        session.get.return_value = response_mock
         response_mock.status_code = 200
         response_mock.json.return_value = _fake_github_content(
             head_sha=head_sha, skip_head_content=False,
@@ -407,11 +959,11 @@ ignore
 
         self.assertEqual(actual_skipped, False)
 
-    @mock.patch('jobserv.git_poller.requests')
-    def test_gitlab_skip_head_title(self, requests):
+    @mock.patch('jobserv.git_poller._session')
+    def test_gitlab_skip_head_title(self, session):
         head_sha = "fakeheadid"
         response_mock = mock.Mock()
-        requests.get.return_value = response_mock
+        session.get.return_value = response_mock
         response_mock.status_code = 200
         response_mock.json.return_value = _fake_gitlab_content(
             head_sha=head_sha, skip_head_title=True)
@@ -422,11 +974,11 @@ ignore
 
         self.assertEqual(actual_skipped, True)
 
-    @mock.patch('jobserv.git_poller.requests')
-    def test_gitlab_skip_head_content(self, requests):
+    @mock.patch('jobserv.git_poller._session')
+    def test_gitlab_skip_head_content(self, session):
         head_sha = "fakeheadid"
         response_mock = mock.Mock()
-        requests.get.return_value = response_mock
+        session.get.return_value = response_mock
         response_mock.status_code = 200
         response_mock.json.return_value = _fake_gitlab_content(
             head_sha=head_sha, skip_head_content=True)
@@ -437,11 +989,11 @@ ignore
 
         self.assertEqual(actual_skipped, True)
 
-    @mock.patch('jobserv.git_poller.requests')
-    def test_gitlab_not_skip_other_title(self, requests):
+    @mock.patch('jobserv.git_poller._session')
+    def test_gitlab_not_skip_other_title(self, session):
         head_sha = "fakeheadid"
         response_mock = mock.Mock()
-        requests.get.return_value = response_mock
+        session.get.return_value = response_mock
         response_mock.status_code = 200
         response_mock.json.return_value = _fake_gitlab_content(
             head_sha=head_sha, skip_other_title=True)
@@ -452,11 +1004,11 @@ ignore
 
         self.assertEqual(actual_skipped, False)
 
-    @mock.patch('jobserv.git_poller.requests')
-    def test_gitlab_not_skip_other_content(self, requests):
+    @mock.patch('jobserv.git_poller._session')
+    def test_gitlab_not_skip_other_content(self, session):
         head_sha = "fakeheadid"
         response_mock = mock.Mock()
-        requests.get.return_value = response_mock
+        session.get.return_value = response_mock
         response_mock.status_code = 200
         response_mock.json.return_value = _fake_gitlab_content(
             head_sha=head_sha, skip_other_content=True)
@@ -1,10 +1,15 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 
+import hashlib
+import io
 import json
 import os
 import shutil
+import tarfile
 import tempfile
+import time
+import zipfile
 
 import jobserv.storage.local_storage
 
@@ -59,6 +64,59 @@ class LocalStorageTest(JobServTest):
         r = self.client.get('/projects/local-1/builds/1/runs/run1/file1.txt')
         self.assertEqual((200, b'a1'), (r.status_code, r.data))
 
+    @mock.patch('jobserv.api.run.Storage')
+    def test_archive(self, storage):
+        storage.return_value = self.storage
+        path = self.storage._get_run_path(self.run)
+        self.storage._create_from_string(os.path.join(path, 'f1.txt'), 'a1')
+        self.storage._create_from_string(os.path.join(path, 'sub/f2.img'), 'b')
+
+        url = '/projects/local-1/builds/1/runs/run1/.artifacts.tar.gz'
+        r = self.client.get(url)
+        self.assertEqual(200, r.status_code, r.data)
+        self.assertIn('local-1-1-run1.tar.gz',
+                      r.headers['Content-Disposition'])
+        with tarfile.open(fileobj=io.BytesIO(r.data), mode='r:gz') as tf:
+            self.assertEqual(['f1.txt', 'sub/f2.img'], sorted(tf.getnames()))
+            self.assertEqual(b'a1', tf.extractfile('f1.txt').read())
+
+        url = '/projects/local-1/builds/1/runs/run1/.artifacts.zip'
+        r = self.client.get(url, query_string='glob=*.img')
+        self.assertEqual(200, r.status_code, r.data)
+        with zipfile.ZipFile(io.BytesIO(r.data)) as zf:
+            self.assertEqual(['sub/f2.img'], zf.namelist())
+            self.assertEqual(b'b', zf.read('sub/f2.img'))
+
+        # build archives put each run in its own directory
+        r = self.client.get('/projects/local-1/builds/1/.artifacts.tar')
+        self.assertEqual(200, r.status_code, r.data)
+        with tarfile.open(fileobj=io.BytesIO(r.data)) as tf:
+            self.assertEqual(
+                ['run1/f1.txt', 'run1/sub/f2.img'], sorted(tf.getnames()))
+
+        self.run.status = BuildStatus.RUNNING
+        db.session.commit()
+        url = '/projects/local-1/builds/1/runs/run1/.artifacts.tar'
+        self.assertEqual(404, self.client.get(url).status_code)
+
+    @mock.patch('jobserv.storage.local_storage.UPLOAD_CHUNK_SIZE', 3)
+    def test_archive_stream(self):
+        data = os.urandom(1500)
+        path = self.storage._get_run_path(self.run)
+        self.storage._create_from_string(os.path.join(path, 'f1.txt'), 'a1')
+        with open(self.storage._get_local(path + 'big.bin'), 'wb') as f:
+            f.write(data)
+
+        chunks = list(self.storage.archive_artifacts([self.run], 'tar'))
+        self.assertGreater(len(chunks), 500)  # generated incrementally
+        with tarfile.open(fileobj=io.BytesIO(b''.join(chunks))) as tf:
+            self.assertEqual(data, tf.extractfile('big.bin').read())
+
+        chunks = self.storage.archive_artifacts([self.run], 'zip')
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as zf:
+            self.assertEqual(data, zf.read('big.bin'))
+            self.assertEqual(b'a1', zf.read('f1.txt'))
+
     @mock.patch('jobserv.api.run.Storage')
     def test_upload(self, storage):
         self.run.status = BuildStatus.RUNNING
@@ -95,3 +153,264 @@ class LocalStorageTest(JobServTest):
         db.session.commit()
         r = self.client.get('/projects/local-1/builds/1/runs/run1/foo.txt')
         self.assertEqual((200, b'foo-content'), (r.status_code, r.data))
+
+    def _signed_upload_url(self, path, **item):
+        headers = [
+            ('Authorization', 'Token %s' % self.run.api_key),
+            ('Content-type', 'application/json'),
+        ]
+        url = '/projects/local-1/builds/1/runs/run1/create_signed'
+        if item:
+            item['file'] = path
+        data = json.dumps([item or path])
+        r = self.client.post(url, data=data, headers=headers)
+        self.assertEqual(200, r.status_code, r.data)
+        return json.loads(r.data.decode())['data']['urls'][path]
+
+    @mock.patch('jobserv.api.run.Storage')
+    def test_upload_sha256(self, storage):
+        self.run.status = BuildStatus.RUNNING
+        db.session.commit()
+        storage.return_value = self.storage
+
+        urldata = self._signed_upload_url('foo.txt')
+        headers = {
+            'Content-type': urldata['content-type'],
+            'X-Content-SHA256': hashlib.sha256(b'foo').hexdigest(),
+        }
+        r = self.client.put(urldata['url'], data=b'bad', headers=headers)
+        self.assertEqual(400, r.status_code, r.data)
+        p = os.path.join(self.storage._get_run_path(self.run), 'foo.txt')
+        with self.assertRaises(FileNotFoundError):
+            self.storage._get_as_string(p)
+        # the failed upload must not leave temporary files behind
+        self.assertEqual([], os.listdir(os.path.join(self.tmpdir, '.uploads')))
+
+        r = self.client.put(urldata['url'], data=b'foo', headers=headers)
+        self.assertEqual(200, r.status_code, r.data)
+        self.assertEqual('foo', self.storage._get_as_string(p))
+
+    @mock.patch('jobserv.api.run.Storage')
+    def test_upload_dedup(self, storage):
+        self.run.status = BuildStatus.RUNNING
+        run2 = Run(self.build, 'run2')
+        run2.status = BuildStatus.RUNNING
+        db.session.add(run2)
+        db.session.commit()
+        storage.return_value = self.storage
+
+        sha = hashlib.sha256(b'foo').hexdigest()
+        upload = json.dumps([{'file': 'foo.txt', 'sha256': sha}])
+        headers = [
+            ('Authorization', 'Token %s' % self.run.api_key),
+            ('Content-type', 'application/json'),
+        ]
+        url = '/projects/local-1/builds/1/runs/run1/create_signed'
+        r = self.client.post(url, data=upload, headers=headers)
+        self.assertEqual(200, r.status_code, r.data)
+        urldata = json.loads(r.data.decode())['data']['urls']['foo.txt']
+        self.assertEqual(sha, urldata['sha256'])
+
+        headers = {
+            'Content-type': urldata['content-type'],
+            'X-Content-SHA256': sha,
+        }
+        r = self.client.put(urldata['url'], data=b'foo', headers=headers)
+        self.assertEqual(200, r.status_code, r.data)
+
+        # the second run has the same content and shouldn't upload it
+        headers = [
+            ('Authorization', 'Token %s' % run2.api_key),
+            ('Content-type', 'application/json'),
+        ]
+        url = '/projects/local-1/builds/1/runs/run2/create_signed'
+        r = self.client.post(url, data=upload, headers=headers)
+        self.assertEqual(200, r.status_code, r.data)
+        urldata = json.loads(r.data.decode())['data']['urls']['foo.txt']
+        self.assertEqual({'content-type': 'text/plain', 'exists': True},
+                         urldata)
+
+        p1 = os.path.join(
+            self.tmpdir, self.storage._get_run_path(self.run), 'foo.txt')
+        p2 = os.path.join(
+            self.tmpdir, self.storage._get_run_path(run2), 'foo.txt')
+        self.assertTrue(os.path.samefile(p1, p2))
+        self.assertEqual(3, os.stat(p1).st_nlink)
+
+        # blobs are private to the project that uploaded them
+        self.create_projects('local-2')
+        b = Build.create(Project.query.filter_by(name='local-2').one())
+        other = Run(b, 'run1')
+        db.session.add(other)
+        db.session.commit()
+        self.assertFalse(self.storage._link_blob(other, 'foo.txt', sha))
+
+        # blobs are only purged once nothing references them
+        self.assertEqual(0, self.storage.purge_unreferenced_blobs())
+        os.unlink(p1)
+        os.unlink(p2)
+        self.assertEqual(3, self.storage.purge_unreferenced_blobs())
+        self.assertFalse(self.storage._link_blob(self.run, 'foo.txt', sha))
+
+        r = self.client.post(
+            url, headers=headers, data=json.dumps([{'file': 'foo.txt',
+                                                    'sha256': '../bad'}]))
+        self.assertEqual(400, r.status_code, r.data)
+
+    @mock.patch('jobserv.api.run.Storage')
+    def test_upload_resumable(self, storage):
+        self.run.status = BuildStatus.RUNNING
+        db.session.commit()
+        storage.return_value = self.storage
+
+        data = os.urandom(100)
+        sha = hashlib.sha256(data).hexdigest()
+        urldata = self._signed_upload_url('big.bin', size=100, sha256=sha)
+        self.assertEqual('ranges', urldata['resumable'])
+        headers = {
+            'Content-type': urldata['content-type'],
+            'X-Content-SHA256': sha,
+        }
+
+        def put(start, end, body=None):
+            headers['Content-Range'] = 'bytes %d-%d/100' % (start, end)
+            if body is None:
+                body = data[start:end + 1]
+            return self.client.put(urldata['url'], data=body, headers=headers)
+
+        # parts can arrive in any order
+        r = put(60, 99)
+        self.assertEqual(308, r.status_code, r.data)
+        self.assertNotIn('Range', r.headers)
+        self.assertEqual('60-99', r.headers['X-Received-Ranges'])
+        r = put(0, 19)
+        self.assertEqual(308, r.status_code, r.data)
+        self.assertEqual('bytes=0-19', r.headers['Range'])
+        self.assertEqual('0-19,60-99', r.headers['X-Received-Ranges'])
+
+        # a short part isn't recorded
+        r = put(20, 59, data[20:30])
+        self.assertEqual(400, r.status_code, r.data)
+        headers['Content-Range'] = 'bytes */100'
+        r = self.client.put(urldata['url'], data=b'', headers=headers)
+        self.assertEqual(308, r.status_code, r.data)
+        self.assertEqual('0-19,60-99', r.headers['X-Received-Ranges'])
+
+        p = self.storage._get_run_path(self.run, 'big.bin')
+        with self.assertRaises(FileNotFoundError):
+            self.storage._get_raw(p)
+        r = put(20, 59)
+        self.assertEqual(201, r.status_code, r.data)
+        self.assertEqual(data, self.storage._get_raw(p))
+        self.assertTrue(self.storage._link_blob(self.run, 'big.bin', sha))
+        self.assertEqual([], os.listdir(os.path.join(self.tmpdir, '.uploads')))
+
+        # a new upload of the path doesn't see the old one's parts
+        urldata = self._signed_upload_url('big.bin', size=100)
+        del headers['X-Content-SHA256']
+        r = put(0, 9)
+        self.assertEqual('0-9', r.headers['X-Received-Ranges'])
+        r = put(0, 99, b'x' * 10)
+        self.assertEqual(400, r.status_code, r.data)
+        headers['Content-Range'] = 'bytes 0-9/50'
+        r = self.client.put(urldata['url'], data=data[:10], headers=headers)
+        self.assertEqual(400, r.status_code, r.data)
+
+    @mock.patch('jobserv.storage.local_storage.LOCAL_UPLOAD_MAX_AGE', 2)
+    def test_purge_abandoned_uploads(self):
+        uploads = os.path.join(self.tmpdir, '.uploads')
+        os.makedirs(uploads, exist_ok=True)
+        now = time.time()
+        for name, days in (('new.part', 1), ('old.part', 3),
+                           ('old.ranges', 3), ('old.tmp', 5)):
+            path = os.path.join(uploads, name)
+            with open(path, 'w') as f:
+                f.write('1234')
+            mtime = now - days * 24 * 3600
+            os.utime(path, (mtime, mtime))
+
+        self.assertEqual(12, self.storage.purge_unreferenced_blobs(now))
+        self.assertEqual(['new.part'], os.listdir(uploads))
+
+    def test_git_poller_cache(self):
+        legacy = {'1': {'url1': {'ref1': 'sha1'}}, '2': {}}
+        self.storage._create_from_string(
+            'git_poller_cache.json', json.dumps(legacy))
+
+        cache = self.storage.git_poller_cache()
+        with mock.patch.object(self.storage, '_create_from_string',
+                               wraps=self.storage._create_from_string) as c:
+            self.assertEqual(legacy['1'], cache.get(1))
+            # the legacy file was split into shards
+            self.assertFalse(os.path.exists(
+                os.path.join(self.tmpdir, 'git_poller_cache.json')))
+            self.assertEqual(
+                ['1.json', '2.json'],
+                sorted(os.listdir(self.tmpdir + '/git_poller_cache')))
+            c.reset_mock()
+
+            self.assertEqual({}, cache.get(3))
+            cache.persist()
+            self.assertEqual(1, c.call_count)  # only the new shard
+            cache.get(1)['url1']['ref1'] = 'sha2'
+            cache.persist(3)
+            self.assertEqual(1, c.call_count)
+            cache.persist()
+            self.assertEqual(2, c.call_count)
+
+            cache.get_projdef(1)['etag'] = 'abc'
+            cache.persist(1)
+            self.assertEqual(3, c.call_count)
+
+        cache = self.storage.git_poller_cache()
+        self.assertEqual({'url1': {'ref1': 'sha2'}}, cache.get(1))
+        self.assertEqual({'etag': 'abc'}, cache.get_projdef(1))
+        self.assertEqual({}, cache.get_projdef(2))
+
+    @mock.patch('jobserv.storage.local_storage.UPLOAD_CHUNK_SIZE', 7)
+    def test_stream_to_file(self):
+        data = os.urandom(100)
+        for stream in (io.BytesIO(data), io.BufferedReader(io.BytesIO(data))):
+            out = io.BytesIO()
+            h = hashlib.sha256()
+            total = jobserv.storage.local_storage._stream_to_file(
+                stream, out, h)
+            self.assertEqual(100, total)
+            self.assertEqual(data, out.getvalue())
+            self.assertEqual(hashlib.sha256(data).hexdigest(), h.hexdigest())
+
+        class ReadOnly(object):
+            def __init__(self, data):
+                self.buf = io.BytesIO(data)
+
+            def read(self, size):
+                return self.buf.read(size)
+
+        out = io.BytesIO()
+        jobserv.storage.local_storage._stream_to_file(ReadOnly(data), out)
+        self.assertEqual(data, out.getvalue())
+
+    @mock.patch('jobserv.api.run.Storage')
+    def test_upload_throughput(self, storage):
+        if not os.environ.get('BENCHMARK'):
+            self.skipTest('Set BENCHMARK=1 to measure upload throughput')
+        self.run.status = BuildStatus.RUNNING
+        db.session.commit()
+        storage.return_value = self.storage
+
+        size = int(os.environ.get('BENCHMARK_UPLOAD_MB', '256')) * 1024 * 1024
+        urldata = self._signed_upload_url('big.bin')
+        headers = {'Content-type': urldata['content-type']}
+        src = os.path.join(self.tmpdir, 'src.bin')
+        with open(src, 'wb') as f:
+            f.truncate(size)
+
+        with open(src, 'rb') as f:
+            start = time.time()
+            r = self.client.put(urldata['url'], data=f, headers=headers)
+            elapsed = time.time() - start
+        self.assertEqual(200, r.status_code, r.data)
+        # the streaming upload should manage at least 50MB/s
+        mb = size / 1024 / 1024
+        self.assertLess(elapsed, mb / 50, 'uploaded %dMB in %.2fs: %.1f MB/s'
+                        % (mb, elapsed, mb / elapsed))
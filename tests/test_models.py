@@ -1,18 +1,25 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 
+import datetime
 import unittest.mock
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Query
 
 from jobserv.models import (
     db,
+    fair_share,
     get_cumulative_status,
+    shortest_job_first,
     Build,
     BuildStatus,
     Project,
     Run,
+    RunDuration,
+    RunEvents,
     Test,
     TestResult,
+    Worker,
 )
 
 from tests import JobServTest
@@ -192,6 +199,147 @@ class RunTest(JobServTest):
         finally:
             jobserv.models.BUILD_URL_FMT = orig
 
+    def test_worker_resources(self):
+        mb = 1024 * 1024
+        w = Worker('w1', 'd', 4096 * mb, 4, 'amd64', 'k', 4, 'amd64')
+        db.session.add(w)
+        for i, status in enumerate(
+                (BuildStatus.RUNNING, BuildStatus.UPLOADING,
+                 BuildStatus.PASSED)):
+            r = Run(self.build, 'run%d' % i)
+            r.worker_name = 'w1'
+            r.status = status
+            r.cpus = 1.5
+            r.memory = 1024
+            db.session.add(r)
+        r = Run(self.build, 'no-request')
+        r.worker_name = 'w1'
+        r.status = BuildStatus.RUNNING
+        db.session.add(r)
+        db.session.commit()
+
+        used = w.resources_used()
+        self.assertEqual((3, 2048), used)
+        self.assertTrue(w.fits(used, None, None))
+        self.assertTrue(w.fits(used, 1, 2048))
+        self.assertFalse(w.fits(used, 1.5, None))
+        self.assertFalse(w.fits(used, None, 2049))
+
+    def _run_for(self, name, seconds, cancel=False,
+                 status=BuildStatus.PASSED):
+        r = Run(self.build, name)
+        r.host_tag = 'amd64'
+        db.session.add(r)
+        db.session.commit()
+        r.set_status(BuildStatus.RUNNING)
+        db.session.commit()
+        started = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=seconds)
+        RunEvents.query.filter_by(run_id=r.id).update({'time': started})
+        db.session.refresh(r)
+        if cancel:
+            r.set_status(BuildStatus.CANCELLING)
+        r.set_status(status)
+        db.session.commit()
+
+    def test_duration_prediction(self):
+        self._run_for('name1', 100)
+        key = (self.proj.id, 'name1', 'amd64')
+        predicted = RunDuration.predict([key])[key]
+        self.assertAlmostEqual(100, predicted, 0)
+
+        # a moving average of the durations
+        self.build = Build.create(self.proj)
+        self._run_for('name1', 200)
+        predicted = RunDuration.predict([key])[key]
+        self.assertAlmostEqual(130, predicted, 0)
+        self.assertEqual(2, RunDuration.query.one().samples)
+
+        # cancelled and failed runs and other host tags don't count
+        self.build = Build.create(self.proj)
+        self._run_for('name1', 500, cancel=True)
+        self.assertEqual(2, RunDuration.query.one().samples)
+        self.build = Build.create(self.proj)
+        self._run_for('name1', 5, status=BuildStatus.FAILED)
+        self.assertEqual(2, RunDuration.query.one().samples)
+        self.assertEqual({}, RunDuration.predict(
+            [(self.proj.id, 'name1', 'armhf')]))
+
+    def test_duration_unique(self):
+        db.session.add(RunDuration(self.proj.id, 'name1', 'amd64', 10))
+        db.session.commit()
+        db.session.add(RunDuration(self.proj.id, 'name1', 'amd64', 20))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+        # a row added by a concurrent completion is updated instead
+        real_update = Query.update
+        raced = []
+
+        def update(q, *args, **kwargs):
+            if q.column_descriptions[0]['entity'] is RunDuration and \
+                    not raced:
+                raced.append(q)
+                return 0  # the row didn't exist yet
+            return real_update(q, *args, **kwargs)
+
+        with unittest.mock.patch.object(Query, 'update', update):
+            self._run_for('name1', 100)
+        self.assertTrue(raced)
+        d = RunDuration.query.one()
+        self.assertEqual(2, d.samples)
+        self.assertAlmostEqual(37, d.seconds, 0)
+
+    @unittest.mock.patch('jobserv.models.QUEUE_SJF_AGING', 2)
+    def test_shortest_job_first(self):
+        for name, seconds in (('long', 3600), ('short', 60), ('mid', 600)):
+            db.session.add(RunDuration(self.proj.id, name, 'amd64', seconds))
+        db.session.commit()
+        now = datetime.datetime.utcnow()
+
+        def _candidate(run_id, name, priority=0, waited=0):
+            queued = now - datetime.timedelta(seconds=waited)
+            return (run_id, self.proj.id, name, 'amd64', priority, queued)
+
+        candidates = [_candidate(1, 'long'), _candidate(2, 'short'),
+                      _candidate(3, 'mid')]
+        self.assertEqual(2, shortest_job_first(candidates, now))
+
+        # waiting ages a run ahead of shorter ones
+        candidates[0] = _candidate(1, 'long', waited=1800)
+        self.assertEqual(1, shortest_job_first(candidates, now))
+
+        # unknown runs are assumed to take the average, 2100s here
+        candidates = [_candidate(1, 'long'), _candidate(4, 'unknown'),
+                      _candidate(3, 'mid')]
+        self.assertEqual(3, shortest_job_first(candidates, now))
+        candidates[1] = _candidate(4, 'unknown', waited=1000)
+        self.assertEqual(4, shortest_job_first(candidates, now))
+
+        # queue priority comes first
+        candidates = [_candidate(1, 'long', 1), _candidate(2, 'short')]
+        self.assertEqual(1, shortest_job_first(candidates, now))
+
+    def test_fair_share(self):
+        # project 1 has 4 runs active and project 2 has 1, both queued runs
+        # for project 1 are older than project 2's
+        candidates = [(1, 1, 'a', 't', 0, None), (2, 1, 'b', 't', 0, None),
+                      (3, 2, 'c', 't', 0, None), (4, 2, 'd', 't', 0, None)]
+        active = {1: 4, 2: 1}
+        self.assertEqual(
+            [3, 4], [x[0] for x in fair_share(candidates, active, {})])
+
+        # a weight of 4 entitles project 1 to more
+        weights = {1: 4}
+        self.assertEqual(
+            [1, 2], [x[0] for x in fair_share(candidates, active, weights)])
+
+        # priority comes first
+        candidates[0] = (1, 1, 'a', 't', 1, None)
+        self.assertEqual(
+            [1], [x[0] for x in fair_share(candidates, active, {})])
+
     def test_build_status_queued(self):
         db.session.add(Run(self.build, 'name1'))
         db.session.add(Run(self.build, 'name2'))
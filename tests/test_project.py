@@ -240,6 +240,30 @@ class ProjectSchemaTest(JobServTest):
             self.assertEqual('aarch6*', data['host-tag'])
             self.assertEqual('aarch6*', dbrun.host_tag)
 
+    def test_resources_rundef(self):
+        with open(os.path.join(self.examples, 'resources.yml')) as f:
+            data = yaml.safe_load(f)
+        proj = ProjectDefinition.validate_data(data)
+        dbrun = Mock()
+        dbrun.build.project.name = 'jobserv'
+        dbrun.build.build_id = 1
+        dbrun.api_key = '123'
+        dbrun.name = 'kernel'
+        trigger = proj._data['triggers'][0]
+        rundef = json.loads(proj.get_run_definition(
+            dbrun, trigger['runs'][0], trigger, {}, {}))
+        self.assertEqual({'cpus': 8, 'memory': 8192}, rundef['resources'])
+        self.assertEqual(8, dbrun.cpus)
+        self.assertEqual(8192, dbrun.memory)
+
+        proj.get_run_definition(dbrun, trigger['runs'][1], trigger, {}, {})
+        self.assertEqual(0.5, dbrun.cpus)
+        self.assertIsNone(dbrun.memory)
+
+        data['triggers'][0]['runs'][0]['resources']['cpus'] = 0
+        with self.assertRaisesRegex(Exception, 'cpus'):
+            ProjectDefinition.validate_data(data)
+
     def test_host_tag_rundef_loopon(self):
         with open(os.path.join(self.examples, 'host-tag.yml')) as f:
             data = yaml.safe_load(f)
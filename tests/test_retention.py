@@ -0,0 +1,135 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import datetime
+import os
+import shutil
+import tempfile
+
+from unittest import mock
+
+import jobserv.storage.local_storage
+
+from jobserv.models import (
+    Build, BuildEvents, BuildStatus, Project, Run, RunEvents, Test,
+    TestResult, db)
+from jobserv.retention import (
+    apply_retention, delete_builds, expired_builds, _RateLimiter)
+
+from tests import JobServTest
+
+
+class RetentionTest(JobServTest):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.storage = jobserv.storage.local_storage.Storage()
+        self.storage.artifacts = self.tmpdir
+        p = mock.patch('jobserv.retention.Storage')
+        p.start().return_value = self.storage
+        self.addCleanup(p.stop)
+
+        self.create_projects('proj-1')
+        self.proj = Project.query.filter_by(name='proj-1').one()
+        now = datetime.datetime.utcnow()
+        for i in range(1, 6):
+            b = Build(self.proj, i)
+            b.status = BuildStatus.PASSED
+            db.session.add(b)
+            db.session.flush()
+            e = BuildEvents(b, BuildStatus.QUEUED)
+            e.time = now - datetime.timedelta(days=10 - i)
+            db.session.add(e)
+
+            r = Run(b, 'run')
+            r.status = BuildStatus.PASSED
+            db.session.add(r)
+            db.session.flush()
+            db.session.add(RunEvents(r, BuildStatus.PASSED))
+            t = Test(r, 'test', 'context')
+            db.session.add(t)
+            db.session.flush()
+            db.session.add(TestResult(t, 'result', 'context'))
+
+            self.storage._create_from_string(
+                self.storage._get_run_path(r, 'artifact.txt'), 'x' * i)
+        db.session.commit()
+
+    def _build_ids(self, builds):
+        return [x.build_id for x in builds]
+
+    def test_expired_none(self):
+        self.assertEqual([], expired_builds(self.proj))
+
+    def test_expired_count(self):
+        self.proj.retention_builds = 2
+        b = Build.query.filter_by(build_id=2).one()
+        b.status = BuildStatus.PROMOTED
+        db.session.commit()
+        self.assertEqual([1, 3], self._build_ids(expired_builds(self.proj)))
+
+    def test_expired_days(self):
+        self.proj.retention_days = 8
+        b = Build.query.filter_by(build_id=1).one()
+        b.status = BuildStatus.RUNNING
+        db.session.commit()
+        self.assertEqual([2], self._build_ids(expired_builds(self.proj)))
+
+        # either limit expires a build
+        self.proj.retention_builds = 2
+        self.assertEqual(
+            [2, 3], self._build_ids(expired_builds(self.proj)))
+
+    def test_delete_builds(self):
+        builds = Build.query.filter(Build.build_id.in_([1, 3])).all()
+        report = delete_builds(builds, dry_run=True)
+        self.assertEqual(2, report.builds)
+        self.assertEqual(2, report.runs)
+        self.assertEqual(2, report.tests)
+        self.assertEqual(2, report.test_results)
+        self.assertEqual(2, report.artifacts)
+        self.assertEqual(4, report.artifact_bytes)
+        self.assertEqual(5, Build.query.count())
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'proj-1/1')))
+
+        report2 = delete_builds(builds)
+        self.assertEqual(report, report2)
+        self.assertEqual([2, 4, 5], self._build_ids(
+            Build.query.order_by(Build.id)))
+        self.assertEqual(3, Run.query.count())
+        self.assertEqual(3, RunEvents.query.count())
+        self.assertEqual(3, Test.query.count())
+        self.assertEqual(3, TestResult.query.count())
+        self.assertEqual(3, BuildEvents.query.count())
+        self.assertEqual(
+            ['2', '4', '5'], sorted(os.listdir(self.tmpdir + '/proj-1')))
+
+    @mock.patch('jobserv.retention.DELETE_CHUNK_SIZE', 1)
+    @mock.patch('jobserv.retention.BUILD_BATCH_SIZE', 1)
+    def test_apply_retention(self):
+        self.create_projects('proj-2')
+        self.proj.retention_builds = 3
+        db.session.commit()
+
+        reports = list(apply_retention(dry_run=True))
+        self.assertEqual(1, len(reports))
+        self.assertEqual('proj-1', reports[0][0].name)
+        self.assertEqual(2, reports[0][1].builds)
+        self.assertEqual(5, Build.query.count())
+
+        reports = list(apply_retention())
+        self.assertEqual(2, reports[0][1].builds)
+        self.assertEqual([3, 4, 5], self._build_ids(
+            Build.query.order_by(Build.id)))
+
+    def test_rate_limiter(self):
+        with mock.patch('jobserv.retention.time') as time:
+            time.time.return_value = 10
+            limiter = _RateLimiter(100)
+            for _ in range(3):
+                limiter.wait()
+            delays = [x[0][0] for x in time.sleep.call_args_list]
+        self.assertEqual(2, len(delays))
+        self.assertAlmostEqual(0.01, delays[0])
+        self.assertAlmostEqual(0.02, delays[1])
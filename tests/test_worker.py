@@ -3,6 +3,7 @@
 
 import datetime
 import os
+import random
 import shutil
 import tempfile
 import time
@@ -10,14 +11,15 @@ import time
 import jobserv.models
 import jobserv.worker
 
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 from jobserv.models import (
-    db, Build, BuildStatus, Project, Run, RunEvents, Worker)
+    db, Build, BuildStatus, Project, Run, RunEvents, Surge, Worker)
 from jobserv.settings import SURGE_SUPPORT_RATIO
 from jobserv import worker as worker_module
 from jobserv.worker import (
-    _check_queue, _check_stuck, _check_workers, _check_cancelled)
+    Monitor, _check_queue, _check_stuck, _check_workers, _check_cancelled,
+    _surges)
 
 from tests import JobServTest
 
@@ -26,8 +28,6 @@ class TestWorkerMonitor(JobServTest):
     def setUp(self):
         super().setUp()
         jobserv.models.WORKER_DIR = tempfile.mkdtemp()
-        jobserv.worker.SURGE_FILE = os.path.join(
-            jobserv.models.WORKER_DIR, 'enable_surges')
         self.addCleanup(shutil.rmtree, jobserv.models.WORKER_DIR)
         self.worker = Worker('w1', 'd', 1, 1, 'amd64', 'k', 1, 'amd64')
         self.worker.enlisted = True
@@ -35,6 +35,9 @@ class TestWorkerMonitor(JobServTest):
         db.session.add(self.worker)
         db.session.commit()
 
+    def _surges(self):
+        return [x.tag for x in Surge.query.order_by(Surge.tag)]
+
     def test_offline_no_pings(self):
         _check_workers()
         db.session.refresh(self.worker)
@@ -42,46 +45,53 @@ class TestWorkerMonitor(JobServTest):
 
     def test_offline(self):
         self.worker.ping()
-        offline = time.time() - 81  # 81 seconds old
-        os.utime(self.worker.pings_log, (offline, offline))
+        _check_workers()
+        db.session.refresh(self.worker)
+        self.assertTrue(self.worker.online)
+
+        offline = datetime.timedelta(seconds=81)
+        self.worker.last_seen = datetime.datetime.utcnow() - offline
+        db.session.commit()
         _check_workers()
         db.session.refresh(self.worker)
         self.assertFalse(self.worker.online)
 
-    @patch('jobserv.worker.WORKER_ROTATE_PINGS_LOG')
-    def test_rotate(self, rotate):
-        # enable rotation
-        rotate.return_value = True
-        # create a big file
+    def test_offline_surge(self):
+        self.worker.surges_only = True
         self.worker.ping()
-        with open(self.worker.pings_log, 'a') as f:
-            f.write('1' * 1024 * 1024)
+        late = datetime.timedelta(seconds=81)
+        self.worker.last_seen = datetime.datetime.utcnow() - late
+        db.session.commit()
         _check_workers()
-        self.assertEqual(0, os.stat(self.worker.pings_log).st_size)
-        # there should be two files now
-        self.assertEqual(2, len(
-            os.listdir(os.path.dirname(self.worker.pings_log))))
-
-        # we should still be online
         db.session.refresh(self.worker)
         self.assertTrue(self.worker.online)
 
-    def test_truncate(self):
-        # rotation is disabled by default:
+        self.worker.last_seen -= datetime.timedelta(seconds=40)
+        db.session.commit()
+        _check_workers()
+        db.session.refresh(self.worker)
+        self.assertFalse(self.worker.online)
 
+    @patch('jobserv.models.WORKER_ROTATE_PINGS_LOG', True)
+    def test_rotate(self):
         # create a big file
         self.worker.ping()
         with open(self.worker.pings_log, 'a') as f:
             f.write('1' * 1024 * 1024)
-        _check_workers()
-        self.assertEqual(0, os.stat(self.worker.pings_log).st_size)
+        self.worker.ping()
+        self.assertFalse(os.path.exists(self.worker.pings_log))
+        self.worker.ping()
+        self.assertEqual(1, len(open(self.worker.pings_log).readlines()))
         # there should be two files now
-        self.assertEqual(1, len(
-            os.listdir(os.path.dirname(self.worker.pings_log))))
+        logs = os.listdir(os.path.dirname(self.worker.pings_log))
+        self.assertEqual(2, len([x for x in logs if 'pings.log' in x]))
 
-        # we should still be online
-        db.session.refresh(self.worker)
-        self.assertTrue(self.worker.online)
+    def test_no_pings_log(self):
+        # rotation is disabled by default, metrics only go in the buffer
+        self.worker.ping(mem_free=42)
+        self.assertFalse(os.path.exists(self.worker.pings_log))
+        times, series = self.worker.metrics.query()
+        self.assertEqual([42], series['mem_free'])
 
     def test_surge_simple(self):
         self.create_projects('proj1')
@@ -92,13 +102,43 @@ class TestWorkerMonitor(JobServTest):
             db.session.add(r)
         db.session.commit()
         _check_queue()
-        self.assertTrue(os.path.exists(jobserv.worker.SURGE_FILE + '-amd64'))
+        self.assertIn('amd64', self._surges())
 
         db.session.delete(Run.query.all()[0])
         db.session.commit()
         worker_module.DETECT_FLAPPING = False
         _check_queue()
-        self.assertFalse(os.path.exists(jobserv.worker.SURGE_FILE + '-amd64'))
+        self.assertNotIn('amd64', self._surges())
+
+    def test_surge_unhealthy(self):
+        self.create_projects('proj1')
+        b = Build.create(Project.query.all()[0])
+        r = Run(b, 'run0')
+        r.host_tag = 'amd64'
+        db.session.add(r)
+        db.session.commit()
+        _check_queue()
+        self.assertEqual([], self._surges())
+
+        # an unhealthy worker can't take the run
+        self.worker.unhealthy = 'disk_free=1 < 1000'
+        db.session.commit()
+        _check_queue()
+        self.assertEqual(['amd64'], self._surges())
+
+    def test_surge_no_tags(self):
+        self.assertEqual({'amd64': 1}, _surges(
+            {None: 3, 'amd64': 1}, [['w1', None]], 0))
+
+        # runs and workers without host tags don't break the queue check
+        self.worker.host_tags = None
+        self.create_projects('proj1')
+        b = Build.create(Project.query.all()[0])
+        for x in range(SURGE_SUPPORT_RATIO + 1):
+            db.session.add(Run(b, 'run%d' % x))
+        db.session.commit()
+        _check_queue()
+        self.assertEqual([], self._surges())
 
     def test_surge_complex(self):
         # we'll have two amd64 workers and one armhf
@@ -124,8 +164,8 @@ class TestWorkerMonitor(JobServTest):
 
         db.session.commit()
         _check_queue()
-        self.assertFalse(os.path.exists(jobserv.worker.SURGE_FILE + '-amd64'))
-        self.assertTrue(os.path.exists(jobserv.worker.SURGE_FILE + '-armhf'))
+        self.assertNotIn('amd64', self._surges())
+        self.assertIn('armhf', self._surges())
 
         # get us under surge for armhf
         db.session.delete(Run.query.filter(Run.host_tag == 'armhf').first())
@@ -138,18 +178,95 @@ class TestWorkerMonitor(JobServTest):
         db.session.commit()
         worker_module.DETECT_FLAPPING = False
         _check_queue()
-        self.assertTrue(os.path.exists(jobserv.worker.SURGE_FILE + '-amd64'))
-        self.assertFalse(os.path.exists(jobserv.worker.SURGE_FILE + '-armhf'))
+        self.assertIn('amd64', self._surges())
+        self.assertNotIn('armhf', self._surges())
 
         # make sure we know about deleted workers
         worker.deleted = True
         db.session.commit()
         _check_queue()
-        self.assertTrue(os.path.exists(jobserv.worker.SURGE_FILE + '-armhf'))
+        self.assertIn('armhf', self._surges())
+
+    def test_surge_wildcard(self):
+        self.worker.host_tags = 'aarch64'
+        worker = Worker('w2', 'd', 1, 1, 'amd64', 'k', 1, 'amd64')
+        worker.enlisted = True
+        worker.online = True
+        surger = Worker('w3', 'd', 1, 1, 'armhf', 'k', 1, 'aarch64')
+        surger.surges_only = True
+        db.session.add_all([worker, surger])
+        self.create_projects('proj1')
+        b = Build.create(Project.query.all()[0])
+        for x in range(SURGE_SUPPORT_RATIO):
+            r = Run(b, 'any%d' % x)
+            r.host_tag = '*'
+            db.session.add(r)
+            r = Run(b, 'arm%d' % x)
+            r.host_tag = 'aarch*'
+            db.session.add(r)
+        db.session.commit()
+
+        # the "*" runs fit on w2, leaving w1 for the aarch* runs
+        _check_queue()
+        self.assertEqual([], self._surges())
+        self.assertFalse(surger.in_queue_surge())
+
+        r = Run(b, 'arm')
+        r.host_tag = 'aarch*'
+        db.session.add(r)
+        db.session.commit()
+        _check_queue()
+        self.assertEqual(['aarch*'], self._surges())
+
+        # surge workers match the wildcard
+        self.assertTrue(surger.in_queue_surge())
+
+    def test_surge_cache(self):
+        self.worker.surges_only = True
+        db.session.add(Surge('amd64', 'msgid'))
+        db.session.commit()
+        self.assertTrue(self.worker.in_queue_surge())
+
+        # check-ins read a cached copy of the surges
+        Surge.query.delete()
+        db.session.commit()
+        with patch('jobserv.models.time') as time:
+            time.time.return_value = Surge._cache[0]
+            self.assertTrue(self.worker.in_queue_surge())
+            time.time.return_value += 1
+            self.assertFalse(self.worker.in_queue_surge())
+
+    def test_surges(self):
+        hosts = [['w1', 'amd64'], ['w2', 'amd64', 'gpu'], ['w3', 'armhf']]
+        self.assertEqual({}, _surges({'amd64': 1, 'gpu': 1}, hosts, 1))
+        self.assertEqual({'gpu': 1}, _surges({'gpu': 2}, hosts, 1))
+        # w2 is kept for the gpu run even though amd64 sorts first
+        self.assertEqual(
+            {'amd64': 1}, _surges({'amd64': 2, 'gpu': 1}, hosts, 1))
+        self.assertEqual({'*': 1}, _surges({'*': 4}, hosts, 1))
+        self.assertEqual({'riscv': 3}, _surges({'riscv': 3}, hosts, 1))
+
+    def test_surges_benchmark(self):
+        """10k queued runs and 500 workers should take well under a second."""
+        rand = random.Random(1)
+        arches = ['amd64', 'aarch64', 'armhf', 'riscv64', 'ppc64le']
+        tags = arches + ['gpu-%d' % x for x in range(20)] + ['a*', '*64']
+        queued = {}
+        for _ in range(10000):
+            tag = rand.choice(tags)
+            queued[tag] = queued.get(tag, 0) + 1
+        hosts = [['w%d' % x, rand.choice(arches), rand.choice(tags[5:25])]
+                 for x in range(500)]
+
+        start = time.time()
+        surges = _surges(queued, hosts, 10)
+        self.assertLess(time.time() - start, 1)
+        # 500 workers * 10 slots leaves about half the runs queued
+        self.assertAlmostEqual(5000, sum(surges.values()), delta=500)
 
     @patch('jobserv.worker.notify_run_terminated')
-    @patch('jobserv.worker._update_run')
-    def test_stuck(self, update_run, notify):
+    @patch('jobserv.worker.fail_run')
+    def test_stuck(self, fail_run, notify):
         """Ensure stuck runs are failed."""
         self.create_projects('proj1')
         b = Build.create(Project.query.all()[0])
@@ -174,10 +291,17 @@ class TestWorkerMonitor(JobServTest):
 
         _check_stuck()
         self.assertEqual('bla', notify.call_args[0][0].name)
-        self.assertEqual('bla', update_run.call_args[0][0].name)
+        self.assertEqual('bla', fail_run.call_args[0][0].name)
+
+        # only the latest event counts
+        fail_run.reset_mock()
+        db.session.add(RunEvents(r, BuildStatus.CANCELLING))
+        db.session.commit()
+        _check_stuck()
+        self.assertFalse(fail_run.called)
 
-    @patch('jobserv.worker._update_run')
-    def test_cancelled(self, update):
+    @patch('jobserv.worker.fail_run')
+    def test_cancelled(self, fail_run):
         """Ensure runs that were cancelled before they were assigned to a
            worker are failed."""
         self.create_projects('proj1')
@@ -189,4 +313,87 @@ class TestWorkerMonitor(JobServTest):
 
         _check_cancelled()
 
-        self.assertEqual('FAILED', update.call_args[1]['status'])
+        self.assertEqual('bla', fail_run.call_args[0][0].name)
+
+    @patch('jobserv.worker.fail_run')
+    def test_oversized(self, fail_run):
+        """Ensure runs no worker has the resources for are failed."""
+        w = Worker('w2', 'd', 4096 * 1024 * 1024, 4, 'amd64', 'k', 1, 'amd64')
+        w.enlisted = True
+        w.online = False
+        db.session.add(w)
+        self.create_projects('proj1')
+        b = Build.create(Project.query.all()[0])
+        for name, tag, cpus, memory in (('fits', 'amd64', 2, 1024),
+                                        ('cpus', 'amd64', 8, None),
+                                        ('memory', 'amd*', None, 8192),
+                                        ('no-request', 'amd64', None, None),
+                                        ('no-worker', 'arm64', 8, None)):
+            r = Run(b, name)
+            r.host_tag = tag
+            r.cpus = cpus
+            r.memory = memory
+            db.session.add(r)
+        db.session.commit()
+
+        _check_queue()
+        self.assertEqual(['cpus', 'memory'],
+                         sorted(x[0][0].name for x in fail_run.call_args_list))
+        self.assertIn('has the 8 cpus requested',
+                      fail_run.call_args_list[0][0][1])
+
+    @patch('jobserv.worker.time')
+    def test_monitor_schedule(self, time):
+        time.time.return_value = 1000
+        m = Monitor()
+        m.checks = {x: Mock() for x in m.checks}
+        self.assertEqual(worker_module.QUEUE_POLL_INTERVAL, m.tick())
+        for check in m.checks.values():
+            self.assertEqual(1, check.call_count)
+
+        # only the checks that are due run
+        time.time.return_value = 1030
+        m.tick()
+        self.assertEqual(2, m.checks['workers'].call_count)
+        self.assertEqual(2, m.checks['cancelled'].call_count)
+        self.assertEqual(1, m.checks['queue'].call_count)
+        self.assertEqual(1, m.checks['stuck'].call_count)
+
+        # a failing check doesn't stop the others
+        time.time.return_value = 1060
+        m.checks['workers'].side_effect = RuntimeError()
+        m.tick()
+        self.assertEqual(3, m.checks['cancelled'].call_count)
+
+    @patch('jobserv.worker.time')
+    def test_monitor_queue_changed(self, time):
+        time.time.return_value = 1000
+        m = Monitor()
+        m.checks = {x: Mock() for x in m.checks}
+        m.tick()
+        queue = m.checks['queue']
+
+        time.time.return_value = 1005
+        m.tick()
+        self.assertEqual(1, queue.call_count)
+
+        # a new run triggers a check, but not before QUEUE_MIN_INTERVAL
+        self.create_projects('proj1')
+        b = Build.create(Project.query.all()[0])
+        db.session.add(Run(b, 'run0'))
+        db.session.commit()
+        m.tick()
+        self.assertEqual(1, queue.call_count)
+        time.time.return_value = 1010
+        m.tick()
+        self.assertEqual(2, queue.call_count)
+        time.time.return_value = 1025
+        m.tick()
+        self.assertEqual(2, queue.call_count)
+
+        # so does a status change
+        r = Run.query.one()
+        r.set_status(BuildStatus.RUNNING)
+        db.session.commit()
+        m.tick()
+        self.assertEqual(3, queue.call_count)
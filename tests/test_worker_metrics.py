@@ -0,0 +1,70 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from jobserv.worker_metrics import FIELDS, RESOLUTION, PingMetrics
+
+
+class PingMetricsTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'w1/metrics.bin')
+
+    def test_empty(self):
+        times, series = PingMetrics(self.path).query()
+        self.assertEqual([], times)
+        self.assertEqual([], series['mem_free'])
+
+    def test_query(self):
+        m = PingMetrics(self.path)
+        for i in range(10):
+            m.add(1000 + i * RESOLUTION, {'mem_free': i, 'load_avg_1': '0.5'})
+        # fixed width records in a file that only grows as slots are used
+        self.assertLessEqual(
+            os.stat(self.path).st_size, 60 * (1000 // RESOLUTION + 10))
+
+        now = 1000 + 9 * RESOLUTION
+        times, series = m.query(since=1000 + 5 * RESOLUTION, now=now)
+        self.assertEqual([1100, 1120, 1140, 1160, 1180], times)
+        self.assertEqual([5, 6, 7, 8, 9], series['mem_free'])
+        self.assertEqual([0.5] * 5, series['load_avg_1'])
+        self.assertEqual([None] * 5, series['disk_free'])
+        self.assertEqual(set(FIELDS), set(series))
+
+    def test_downsample(self):
+        m = PingMetrics(self.path)
+        for i in range(6):
+            m.add(1200 + i * RESOLUTION, {'mem_free': i})
+        m.add(1200 + 7 * RESOLUTION, {'disk_free': 1})
+        times, series = m.query(since=0, step=60, now=2000)
+        self.assertEqual([1200, 1260, 1320], times)
+        self.assertEqual([1, 4, None], series['mem_free'])
+        self.assertEqual([None, None, 1], series['disk_free'])
+
+    def test_wrap(self):
+        m = PingMetrics(self.path, slots=4)
+        for i in range(10):
+            m.add(i * RESOLUTION, {'mem_free': i})
+        self.assertEqual(4 * 52, os.stat(self.path).st_size)
+
+        # only the last lap is kept
+        times, series = m.query(now=9 * RESOLUTION)
+        self.assertEqual([6, 7, 8, 9], series['mem_free'])
+
+        # slots that haven't been written in this lap are skipped
+        times, series = m.query(now=11 * RESOLUTION)
+        self.assertEqual([8, 9], series['mem_free'])
+
+    def test_sparse(self):
+        m = PingMetrics(self.path, slots=10)
+        m.add(8 * RESOLUTION, {'mem_free': 8})
+        m.add(11 * RESOLUTION, {'mem_free': 11})
+        times, series = m.query(since=5 * RESOLUTION, now=12 * RESOLUTION)
+        self.assertEqual([8 * RESOLUTION, 11 * RESOLUTION], times)
+        self.assertEqual([8, 11], series['mem_free'])